@@ -1,19 +1,30 @@
 import os
-import time
 import json
+import socket
 import asyncio
 import websockets
-import subprocess
 import jinja2
 import ipaddress
 from dotenv import load_dotenv
-from utils import load_config
+from link_probe import ProbeSink, probe_peer
+from supervisor import EventBatcher, ProcessSupervisor
+from utils import PACKET_OVERHEAD, STEP_RECORD, WORKER_READY, load_config, \
+    parse_step_record, read_link_speed, read_mtu
 
 load_dotenv()
 
 COORD_IP = os.getenv("COORD_IP")
 COORD_PORT = os.getenv("COORD_PORT")
 
+AGGMAP_PIN_PATH = "/sys/fs/bpf/aggregator_map"
+TELEMETRY_BATCH = 100
+TELEMETRY_INTERVAL = 1.0
+
+probe_sink = None
+supervisor = None
+telemetry = None
+background_tasks = set()
+
 
 def ipv4_to_hex(addr: str) -> str:
     return f"0x{int(ipaddress.IPv4Address(addr)):08X}"
@@ -44,6 +55,8 @@ def write_agg_config(
         "scale_factor": data["scale_factor"],
         "gradient_size": data["gradient_size"],
         "fragment_size": data["fragment_size"],
+        "lane_bits": data.get("lane_bits", 32),
+        "if_index": socket.if_nametoindex(data.get("ifname", "ens3")),
     }
     
     ids = [str(child["id"]) for child in data.get("children", [])]
@@ -78,33 +91,186 @@ def write_agg_config(
         f.write(file_content)
 
 
+def check_packet_size(data: dict):
+    """Returns why this node cannot take the packets the coordinator sized
+    for the fabric, None if it can.
+
+    gradient_size is the same on every node, since parent and child have to
+    agree on the packet layout, so it comes resolved from the smallest MTU
+    of the fabric. A node whose own interface is smaller would drop them.
+    """
+    if data["gradient_size"] == "auto":
+        return "gradient_size was not resolved by the coordinator"
+    ifname = data.get("ifname", "ens3")
+    try:
+        mtu = read_mtu(ifname)
+    except OSError as e:
+        return f"Cannot read the MTU of {ifname}: {e}"
+    packet = data["gradient_size"] * data.get("lane_bits", 32) // 8 + PACKET_OVERHEAD
+    if packet > mtu:
+        return f"MTU {mtu} of {ifname} is smaller than the {packet} byte packets of the fabric"
+    print(f"MTU {mtu}: {data['gradient_size']} gradients per packet")
+    return None
+
+
+def resolve_pacing(data: dict):
+    """Replaces an "auto" pacing_rate_mbps with this node's share of its parent.
+
+    The parent's RX queue takes the bursts of all its children at once, so
+    each child gets the link speed (or link_mbps) divided by their number.
+    """
+    if data.get("pacing", "off") == "off" or data.get("pacing_rate_mbps") != "auto":
+        return
+
+    link_mbps = data.get("link_mbps") or read_link_speed(data.get("ifname", "ens3"))
+    if link_mbps is None:
+        print("Link speed unknown, set link_mbps to pace automatically")
+        data["pacing"] = "off"
+        return
+
+    data["pacing_rate_mbps"] = link_mbps / max(1, data.get("siblings", 1))
+    print(f"Pacing at {data['pacing_rate_mbps']:,.0f} Mbit/s")
+
+
 async def update_local_config(data: dict):
+    """Writes the configs of this node, returns why it refused to, if so."""
+    error = check_packet_size(data)
+    if error:
+        return error
+    resolve_pacing(data)
     write_local_config(data)
     write_agg_config(data)
+    return None
 
 
-async def run_ebpf_progs():
-    try:       
-        subprocess.Popen("./scripts/run.sh", shell=True)
-        subprocess.Popen("python3 worker.py", shell=True)
-    except Exception as e:
-        print(f"Error running program: {e}")
+def track(coro):
+    """Runs coro in the background, keeping a reference until it is done."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
-async def run_train_progs(prog_type: str):
-    config = load_config("local_config.json")
-    if not config['children']:
-        time.sleep(5)
-    try:       
-        subprocess.Popen(f"python3 worker.py {prog_type}", shell=True)
-    except Exception as e:
-        print(f"Error running program: {e}")
 
+async def send_event(websocket, event_type: str, data: any):
+    await websocket.send(json.dumps({"event": event_type, "data": data}))
+
+
+async def report_state(websocket, state: str, **data):
+    print(f"State: {state}")
+    await send_event(websocket, "status", {"state": state, **data})
+
+
+async def ack(websocket, event: dict, message: str, ok: bool = True, **data):
+    print(message)
+    await websocket.send(json.dumps({
+        "event": "ack",
+        "id": event.get("id"),
+        "data": {"ok": ok, "message": message, **data},
+    }))
+
+
+def local_ifname() -> str:
+    """The data interface of local_config.json, which the scripts attach to."""
+    if not os.path.exists("local_config.json"):
+        return "ens3"
+    return load_config("local_config.json").get("ifname", "ens3")
+
+
+async def xdp_attached(ifname: str) -> bool:
+    proc = await asyncio.create_subprocess_exec(
+        "ip", "link", "show", "dev", ifname, stdout=asyncio.subprocess.PIPE
+    )
+    out, _ = await proc.communicate()
+    return b"xdp" in out
+
+
+async def attach_ebpf(websocket):
+    """Builds and attaches the eBPF programs, then reports what came up."""
+    ifname = local_ifname()
+    await supervisor.start("ebpf", ["./scripts/run.sh", ifname])
+    code = await supervisor.wait("ebpf")
+    if code != 0:
+        await report_state(websocket, "ebpf_failed", code=code, reason="run.sh failed")
+        return
+
+    # run.sh exits 0 even when one of its steps failed
+    missing = []
+    if await xdp_attached(ifname):
+        await report_state(websocket, "ebpf_attached")
+    else:
+        missing.append(f"no XDP program on {ifname}")
+    if os.path.exists(AGGMAP_PIN_PATH):
+        await report_state(websocket, "map_pinned")
+    else:
+        missing.append(f"{AGGMAP_PIN_PATH} not pinned")
+    if missing:
+        await report_state(websocket, "ebpf_failed", reason="; ".join(missing))
+
+
+async def run_ebpf_progs(websocket):
+    track(attach_ebpf(websocket))
+
+
+async def run_train_progs(websocket, prog_type: str):
+    """Starts the worker, which reports ready and waits for release_training."""
+    async def on_line(line: str) -> bool:
+        if line.startswith(STEP_RECORD):
+            await telemetry.add(parse_step_record(line))
+            return True
+        if line != WORKER_READY:
+            return False
+        await report_state(websocket, "worker_ready")
+        return True
+
+    await supervisor.start(
+        "worker", ["python3", "worker.py", prog_type],
+        env={"AGENT_BARRIER": "1", "AGENT_TELEMETRY": "1"}, stdin=True, on_line=on_line,
+    )
+
+
+async def release_training() -> bool:
+    return await supervisor.write("worker", b"go\n")
+
+
+async def clean_progs() -> int:
+    await supervisor.kill("worker")
+    await supervisor.start("clean", ["./scripts/clean.sh", local_ifname()])
+    return await supervisor.wait("clean")
+
+
+def format_procs(procs: list) -> str:
+    if not procs:
+        return "No processes."
+    return "; ".join(
+        f"{proc['name']} (pid {proc['pid']}): "
+        + ("running" if proc["running"] else f"exited {proc['code']}")
+        + (f" after {proc['runtime']:.1f}s" if proc["runtime"] is not None else "")
+        for proc in procs
+    )
+
+
+async def measure_links(websocket, data: dict):
+    """Probes every target while answering the probes of others, streaming
+    one link_probe event per target."""
+    global probe_sink
+    if probe_sink is None or probe_sink.port != data["port"]:
+        if probe_sink is not None:
+            probe_sink.close()
+        probe_sink = ProbeSink(data["port"])
+
+    loop = asyncio.get_running_loop()
+
+    async def probe(target: dict):
+        result = {"src": data["id"], "dst": target["id"]}
+        try:
+            result.update(await loop.run_in_executor(
+                None, probe_peer, target["addr"], data["port"], data["duration"]
+            ))
+        except OSError as e:
+            result["error"] = str(e)
+        await send_event(websocket, "link_probe", result)
+
+    await asyncio.gather(*(probe(target) for target in data["targets"]))
 
-async def clean_progs():
-    try:
-        subprocess.run("./scripts/clean.sh", shell=True, check=True) 
-    except Exception as e:
-        print(f"Error running program: {e}")
 
 async def handle_server_messages(websocket):
     try:
@@ -116,46 +282,75 @@ async def handle_server_messages(websocket):
             print(f"Received event: {event_type}, data: {data}")
 
             if event_type == "update_local_config":
-                await update_local_config(data)
-                banner = "Updated!"
-                await websocket.send(banner)
-                print(banner)
+                error = await update_local_config(data)
+                if error:
+                    await ack(websocket, event, error, ok=False)
+                else:
+                    await ack(websocket, event, "Updated!")
+
+            elif event_type == "read_mtu":
+                try:
+                    mtu = read_mtu(data["ifname"])
+                    await ack(websocket, event, f"MTU {mtu}", mtu=mtu)
+                except OSError as e:
+                    await ack(websocket, event, f"Cannot read the MTU: {e}", ok=False)
             
             elif event_type == "run_ebpf_progs":
-                await run_ebpf_progs()
-                banner = "Run ebpf!"
-                await websocket.send(banner)
-                print(banner)
+                await run_ebpf_progs(websocket)
+                await ack(websocket, event, "Run ebpf!")
             
             elif event_type == "run_ebpf_train":
-                await run_train_progs("ebpf")
-                banner = "Run ebpf training!"
-                await websocket.send(banner)
-                print(banner)
+                await run_train_progs(websocket, "ebpf")
+                await ack(websocket, event, "Run ebpf training!")
             
             elif event_type == "run_torch_ddp_train":
-                await run_train_progs("torch_ddp")
-                banner = "Run torch ddp training!"
-                await websocket.send(banner)
-                print(banner)
+                await run_train_progs(websocket, "torch_ddp")
+                await ack(websocket, event, "Run torch ddp training!")
             
             elif event_type == "run_torch_tcp_train":
-                await run_train_progs("torch_tcp")
-                banner = "Run torch tcp training!"
-                await websocket.send(banner)
-                print(banner)
+                await run_train_progs(websocket, "torch_tcp")
+                await ack(websocket, event, "Run torch tcp training!")
+
+            elif event_type == "release_training":
+                if await release_training():
+                    await ack(websocket, event, "Training released!")
+                else:
+                    await ack(websocket, event, "No worker waiting.", ok=False)
             
             elif event_type == "clean_progs":
-                await clean_progs()
-                await websocket.send("Cleaned!")
-                print("Cleaned!")
+                code = await clean_progs()
+                if code == 0:
+                    await ack(websocket, event, "Cleaned!")
+                else:
+                    await ack(websocket, event, f"clean.sh exited with {code}.", ok=False)
+
+            elif event_type == "list_procs":
+                procs = supervisor.status()
+                await ack(websocket, event, format_procs(procs), procs=procs)
+
+            elif event_type == "kill_proc":
+                if await supervisor.kill(data["name"]):
+                    await ack(websocket, event, f"Killed {data['name']}!")
+                else:
+                    await ack(websocket, event, f"{data['name']} is not running.", ok=False)
+
+            elif event_type == "restart_proc":
+                try:
+                    await supervisor.restart(data["name"])
+                    await ack(websocket, event, f"Restarted {data['name']}!")
+                except KeyError:
+                    await ack(websocket, event, f"{data['name']} was never started.", ok=False)
             
+            elif event_type == "measure_links":
+                await measure_links(websocket, data)
+                await ack(websocket, event, "Measured links!")
+
             elif event_type == "ping":
-                print("Sending back to server: Pong!")
-                await websocket.send("Pong!")
+                await ack(websocket, event, "Pong!")
             
             elif event_type == "kill_agent":
-                print("Client is shutting down.")
+                await ack(websocket, event, "Client is shutting down.")
+                await supervisor.close()
                 return False
             
             elif event_type == "shutdown":
@@ -170,9 +365,17 @@ async def handle_server_messages(websocket):
     
 
 async def main():
+    global supervisor, telemetry
     try:
         async with websockets.connect(f"ws://{COORD_IP}:{COORD_PORT}") as websocket:
             print("Connected to server.")
+            supervisor = ProcessSupervisor(
+                lambda event_type, data: send_event(websocket, event_type, data)
+            )
+            telemetry = EventBatcher(
+                lambda event_type, data: send_event(websocket, event_type, data),
+                "telemetry", "records", TELEMETRY_BATCH, TELEMETRY_INTERVAL,
+            )
             while True:
                 is_running = await handle_server_messages(websocket)
                 if not is_running:
@@ -0,0 +1,204 @@
+"""
+Compares the all-reduce of every worker backend on one host.
+
+    python3 -m benchmarks.allreduce [steps] [workers,...] [backend[:compression],...] [model ...]
+
+Every run spawns one process per rank with gloo on loopback, in a scratch
+directory whose local_config.json is main_config.json's train_config sized
+to the model. The backends are the real worker classes: `ebpf` is
+UsrEbpfWorker, which quantizes, sends and polls like EbpfWorker, but
+aggregates in a userspace thread instead of XDP. Its CPU time thus
+includes the aggregator's, which XDP takes off the worker.
+
+A step sums the parameters, runs backward and aggregates, so apart from
+the all-reduce the backends do the same trivial work. Latency is that of
+the slowest rank, CPU time the mean over ranks. Bandwidth is the bytes a
+rank sends per step over the p50 latency; the fp32 figure is the
+uncompressed gradients averaged in that time. A torch backend can be
+given a comm_compression, e.g. `torch_ddp:powersgd`, to compare its bytes
+per step with the int32 lanes of `ebpf`. Results are written to
+benchmarks/results/allreduce-<commit>.json.
+"""
+import os
+import sys
+import json
+import math
+import time
+import tempfile
+import subprocess
+import multiprocessing as mp
+import numpy as np
+
+from utils import gradient_size_for_mtu, load_config
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+BACKENDS = ("ebpf", "torch_tcp", "torch_ddp")
+MODELS = ("convnet", "resnet18", "resnet52")
+MASTER_PORT = 41500
+AGG_PORT = 41600
+WARMUP_STEPS = 2
+
+
+def run_rank(backend: str, model_type: str, rank: int, world_size: int, steps: int,
+             workdir: str, master_port: int, results):
+    # the worker modules read local_config.json on import
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import torch
+    import torch.distributed as dist
+    from models import MODEL_CLASSES, BaseModel
+    from workers import TorchDDPWorker, TorchTCPWorker, UsrEbpfWorker
+
+    class ParamSum(BaseModel):
+        """Sums the parameters of a model, so backward yields its gradients
+        without any compute."""
+
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self):
+            return sum(p.sum() for p in self.model.parameters())
+
+    torch.set_num_threads(1)
+    workers = {"ebpf": UsrEbpfWorker, "torch_tcp": TorchTCPWorker, "torch_ddp": TorchDDPWorker}
+    backend, _, compression = backend.partition(":")
+    model = ParamSum(MODEL_CLASSES[model_type]())
+    if compression:
+        worker = workers[backend](model, compression=compression)
+    else:
+        worker = workers[backend](model)
+    worker.setup(rank, world_size, "127.0.0.1", master_port)
+    grad_arena = model.grad_arena is not None
+
+    latencies, cpu_times = [], []
+    for step in range(WARMUP_STEPS + steps):
+        dist.barrier()
+        start_time, start_cpu = time.perf_counter(), time.process_time()
+        model.zero_grad(set_to_none=not grad_arena)
+        worker.model().backward()
+        worker.aggregate(step)
+        if step >= WARMUP_STEPS:
+            latencies.append(time.perf_counter() - start_time)
+            cpu_times.append(time.process_time() - start_cpu)
+
+    # the userspace aggregators must outlive every rank's last resend
+    dist.barrier()
+    results[rank] = (latencies, cpu_times, worker.bytes_per_step)
+    dist.destroy_process_group()
+
+
+def run(backend: str, model_type: str, world_size: int, steps: int, run_id: int,
+        train_config: dict) -> dict:
+    from models import MODEL_CLASSES
+
+    param_count = MODEL_CLASSES[model_type]().num_gradients
+    gradient_size = train_config["gradient_size"]
+    if gradient_size == "auto":
+        gradient_size = gradient_size_for_mtu(1500, train_config.get("lane_bits", 32))
+
+    ctx = mp.get_context("spawn")
+    manager = ctx.Manager()
+    results = manager.dict()
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, "local_config.json"), "w") as f:
+            json.dump({
+                **train_config,
+                "id": 0,
+                "ifname": "lo",
+                "model_type": model_type,
+                "worker_num": world_size,
+                "gradient_size": gradient_size,
+                "fragment_size": math.ceil(param_count / gradient_size),
+                "port": AGG_PORT + run_id,
+                "powersgd_start_iter": WARMUP_STEPS,
+            }, f)
+
+        procs = [
+            ctx.Process(target=run_rank, args=(backend, model_type, rank, world_size, steps,
+                        workdir, MASTER_PORT + run_id, results))
+            for rank in range(world_size)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+    if len(results) < world_size:
+        return {"backend": backend, "model": model_type, "workers": world_size,
+                "error": "a rank failed"}
+
+    lat = np.max([results[rank][0] for rank in range(world_size)], axis=0)
+    cpu = np.mean([results[rank][1] for rank in range(world_size)], axis=0)
+    p50 = float(np.percentile(lat, 50))
+    return {
+        "backend": backend,
+        "model": model_type,
+        "workers": world_size,
+        "params": param_count,
+        "bytes_per_step": results[0][2],
+        "latency_p50": p50,
+        "latency_p95": float(np.percentile(lat, 95)),
+        "latency_p99": float(np.percentile(lat, 99)),
+        # what the backend sends, compressed and with packet headers
+        "bandwidth_mbps": results[0][2] * 8 / p50 / 1e6,
+        # the fp32 gradients it averages in that time
+        "effective_mbps": param_count * 4 * 8 / p50 / 1e6,
+        "cpu_time": float(np.mean(cpu)),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    world_sizes = [int(n) for n in sys.argv[2].split(",")] if len(sys.argv) > 2 else [2, 4]
+    backends = sys.argv[3].split(",") if len(sys.argv) > 3 else list(BACKENDS)
+    model_types = sys.argv[4:] or list(MODELS)
+    train_config = load_config("main_config.json")["train_config"]
+
+    entries = []
+    for model_type in model_types:
+        for world_size in world_sizes:
+            for backend in backends:
+                entry = run(backend, model_type, world_size, steps, len(entries), train_config)
+                entries.append(entry)
+                if "error" in entry:
+                    print(f"{model_type:>9} x{world_size} {backend:>18}: {entry['error']}")
+                    continue
+                print(
+                    f"{model_type:>9} x{world_size} {backend:>18}: "
+                    f"p50 {entry['latency_p50']*1e3:8.1f}ms, "
+                    f"p95 {entry['latency_p95']*1e3:8.1f}ms, "
+                    f"p99 {entry['latency_p99']*1e3:8.1f}ms, "
+                    f"{entry['bandwidth_mbps']:8.0f} Mbit/s "
+                    f"({entry['effective_mbps']:.0f} fp32), "
+                    f"cpu {entry['cpu_time']*1e3:8.1f}ms, "
+                    f"{entry['bytes_per_step'] / 2**20:.2f} MB/step"
+                )
+
+    commit = git_commit()
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"allreduce-{commit}.json")
+    with open(path, "w") as f:
+        json.dump({
+            "commit": commit,
+            "measured_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "cpus": os.cpu_count(),
+            "steps": steps,
+            "results": entries,
+        }, f, indent=4)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Reports all-reduce throughput of every model in MODEL_CLASSES.
+
+    python3 -m benchmarks.model_throughput [workers] [steps] [model ...]
+
+Each model is sized the way gen_system_config.py sizes it: its parameter
+count rounded up to whole fragments. The all-reduce runs on the userspace
+aggregator over loopback, so absolute numbers are far below XDP, but the
+fragments per step, the bytes on the wire and the padding that a fixed
+fragment_size would add are the same.
+"""
+import sys
+import math
+import multiprocessing as mp
+import numpy as np
+
+from models import MODEL_CLASSES
+from usr_aggregator import TX_MODE_GSO, run_allreduce
+from utils import PACKET_OVERHEAD, gradient_size_for_mtu, load_config
+
+PORT = 41300
+
+
+def allreduce_latencies(world_size: int, steps: int, gradient_size: int,
+                        fragment_size: int) -> np.ndarray:
+    manager = mp.Manager()
+    results = manager.dict()
+    barrier = mp.Barrier(world_size)
+    procs = [
+        mp.Process(target=run_allreduce, args=(rank, world_size, 2, steps,
+                   gradient_size, fragment_size, PORT, TX_MODE_GSO, 0.0,
+                   1, barrier, results))
+        for rank in range(world_size)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    # a step is done once the slowest rank has the result
+    return np.max([results[rank][0] for rank in range(world_size)], axis=0)
+
+
+def main():
+    world_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    model_types = sys.argv[3:] or list(MODEL_CLASSES)
+
+    config = load_config("main_config.json")["train_config"]
+    lane_bits = config.get("lane_bits", 32)
+    gradient_size = config["gradient_size"]
+    if gradient_size == "auto":
+        gradient_size = gradient_size_for_mtu(1500, lane_bits)
+    fixed_size = config["fragment_size"]
+
+    for model_type in model_types:
+        param_count = MODEL_CLASSES[model_type]().num_gradients
+        fragment_size = math.ceil(param_count / gradient_size)
+        wire_bytes = fragment_size * (gradient_size * lane_bits // 8 + PACKET_OVERHEAD)
+
+        lat = allreduce_latencies(world_size, steps, gradient_size, fragment_size)
+        step_time = np.percentile(lat, 50)
+
+        padding = ""
+        if isinstance(fixed_size, int):
+            padding = f", fixed fragment_size {fixed_size} " \
+                f"({fixed_size / fragment_size:.1f}x the fragments)"
+
+        print(
+            f"{model_type:>10}: "
+            f"{param_count:,} params, "
+            f"{fragment_size} fragments, "
+            f"{wire_bytes / 2**20:.2f} MB/step, "
+            f"p50 {step_time*1e3:.1f}ms, "
+            f"{fragment_size / step_time:,.0f} fragments/s, "
+            f"{param_count / step_time / 1e6:.2f} Mparams/s"
+            f"{padding}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Compares drop rate and step time with and without pacing under incast.
+
+    python3 -m benchmarks.pacing [workers] [rate_mbps] [rcvbuf_kb] [steps]
+
+All workers but the root are children of rank 0, so their bursts meet in
+one socket buffer. A small rcvbuf stands in for the RX ring of an
+aggregator in XDP_MODE_SKB. The drop rate is the share of fragments
+resent after a timeout. scripts/pacing_bench.sh also shapes the interface
+with scripts/limit_bandwidth.sh while this runs.
+"""
+import sys
+import multiprocessing as mp
+import numpy as np
+
+from usr_aggregator import PACING_BUCKET, PACING_OFF, TX_MODE_SENDMMSG, run_allreduce
+
+PORT = 41400
+GRADIENT_SIZE = 350
+FRAGMENT_SIZE = 2000
+
+
+def run(world_size: int, steps: int, pacing: tuple, rcvbuf: int) -> tuple:
+    manager = mp.Manager()
+    results = manager.dict()
+    barrier = mp.Barrier(world_size)
+    procs = [
+        mp.Process(target=run_allreduce, args=(rank, world_size, world_size - 1, steps,
+                   GRADIENT_SIZE, FRAGMENT_SIZE, PORT, TX_MODE_SENDMMSG, 0.0, 1,
+                   barrier, results), kwargs={"pacing": pacing, "rcvbuf": rcvbuf})
+        for rank in range(world_size)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    lat = np.max([results[rank][0] for rank in range(world_size)], axis=0)
+    resent = sum(results[rank][3][1] for rank in range(world_size))
+    sent = world_size * steps * FRAGMENT_SIZE
+    return lat, resent / sent
+
+
+def main():
+    world_size = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    rate_mbps = float(sys.argv[2]) if len(sys.argv) > 2 else 1000.0
+    rcvbuf = int(sys.argv[3]) * 1024 if len(sys.argv) > 3 else 256 * 1024
+    steps = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+
+    # every child gets its share of the root's link
+    share = rate_mbps / max(1, world_size - 1)
+    for name, pacing in [("off", (PACING_OFF, 0.0, 8)), ("bucket", (PACING_BUCKET, share, 8))]:
+        lat, drop_rate = run(world_size, steps, pacing, rcvbuf)
+        print(
+            f"pacing {name:>6}: "
+            f"p50 {np.percentile(lat, 50)*1e3:8.1f}ms, "
+            f"p99 {np.percentile(lat, 99)*1e3:8.1f}ms, "
+            f"resent {drop_rate:6.2%} of the fragments"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Sweeps the all-reduce step time over gradient_size (lanes per packet).
+
+    python3 -m benchmarks.payload_sweep [workers] [steps] [gradients]
+
+The same number of gradients (2M by default) is split into packets of
+every size below, up to what a 9000-byte jumbo frame holds, and reduced on
+the userspace aggregator over loopback. Per-packet costs dominate there
+as they do in send_all_fragments and the XDP program, so the trend carries
+over even though the absolute numbers do not.
+"""
+import sys
+import math
+import numpy as np
+
+from benchmarks.model_throughput import allreduce_latencies
+from utils import PACKET_OVERHEAD, gradient_size_for_mtu
+
+GRADIENT_SIZES = [64, 128, 256, 350, 512, 1024, 1400, gradient_size_for_mtu(9000)]
+
+
+def main():
+    world_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    gradients = int(sys.argv[3]) if len(sys.argv) > 3 else 2_000_000
+
+    for gradient_size in GRADIENT_SIZES:
+        fragment_size = math.ceil(gradients / gradient_size)
+        packet_size = gradient_size * 4 + PACKET_OVERHEAD
+
+        lat = allreduce_latencies(world_size, steps, gradient_size, fragment_size)
+        step_time = np.percentile(lat, 50)
+        print(
+            f"gradient_size {gradient_size:>5} ({packet_size:>5} B packets): "
+            f"{fragment_size:>6} fragments, "
+            f"p50 {step_time*1e3:8.1f}ms, "
+            f"{gradients / step_time / 1e6:6.2f} Mgradients/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
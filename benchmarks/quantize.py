@@ -0,0 +1,93 @@
+"""
+Compares the per-step allocations and time of the original
+EbpfWorker.prepare_gradients/pull against FixedPointQuantizer.
+
+    python3 -m benchmarks.quantize [model_type]
+"""
+import sys
+import time
+import torch
+
+from torch.profiler import profile, ProfilerActivity
+from models import ConvNet, ResNet18, ResNet52
+from quantizer import FixedPointQuantizer
+
+GRADIENT_SIZE = 350
+FRAGMENT_SIZE = 33400
+SCALE_FACTOR = 1e8
+WORKER_NUM = 2
+STEPS = 20
+
+MODELS = {
+    "convnet": ConvNet,
+    "resnet18": ResNet18,
+    "resnet52": ResNet52,
+}
+
+
+def legacy_step(grads: torch.Tensor, agg_buf: torch.Tensor) -> torch.Tensor:
+    grads = grads * SCALE_FACTOR
+    grads = torch.clamp(grads, -2**31, 2**31 - 1)
+    grads_int32 = grads.to(torch.int32)
+
+    total_size = FRAGMENT_SIZE * GRADIENT_SIZE
+    if grads_int32.numel() < total_size:
+        pad_size = total_size - grads_int32.numel()
+        grads_int32 = torch.nn.functional.pad(grads_int32, (0, pad_size))
+
+    out = agg_buf.to(torch.float32) / SCALE_FACTOR
+    out.div_(WORKER_NUM)
+    return out
+
+
+def fused_step(quantizer: FixedPointQuantizer, grads: torch.Tensor,
+               agg_buf: torch.Tensor, out: torch.Tensor) -> torch.Tensor:
+    quantizer.quantize(grads)
+    return quantizer.dequantize(agg_buf, out, WORKER_NUM)
+
+
+def measure(fn) -> tuple:
+    fn()  # warm up persistent buffers
+
+    start_time = time.perf_counter()
+    for _ in range(STEPS):
+        fn()
+    elapsed = (time.perf_counter() - start_time) / STEPS
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    allocated = sum(
+        max(evt.self_cpu_memory_usage, 0) for evt in prof.key_averages()
+    )
+    return elapsed, allocated
+
+
+def main():
+    model_type = sys.argv[1] if len(sys.argv) > 1 else "resnet18"
+    numel = sum(p.numel() for p in MODELS[model_type]().parameters())
+    total_size = FRAGMENT_SIZE * GRADIENT_SIZE
+    if numel > total_size:
+        print(f"{model_type} has {numel:,} parameters, more than {total_size:,} lanes")
+        return
+
+    grads = torch.randn(numel) * 1e-3
+    agg_buf = torch.randint(-2**20, 2**20, (total_size,), dtype=torch.int32)
+    quantizer = FixedPointQuantizer(total_size, SCALE_FACTOR)
+    out = torch.empty(numel)
+
+    results = {
+        "legacy": measure(lambda: legacy_step(grads, agg_buf)),
+        "fused": measure(lambda: fused_step(quantizer, grads, agg_buf, out)),
+    }
+
+    print(f"Model: {model_type}, parameters: {numel:,}")
+    for name, (elapsed, allocated) in results.items():
+        print(
+            f"{name:>8}: "
+            f"time/step {elapsed*1e3:.3f}ms, "
+            f"allocated/step {allocated / (1024 ** 2):.2f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
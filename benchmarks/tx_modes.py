@@ -0,0 +1,71 @@
+"""
+Reports packets per second of every send_all_fragments transmit mode.
+
+    python3 -m benchmarks.tx_modes [ifname] [batch] [threads] [cpu,...]
+
+Needs eBOT/agg_map_lib.so built for this node. Fragments are sent with an
+iteration number the aggregator never reaches, so XDP drops them and the
+pinned aggregator_map is left untouched. With several threads the rate of
+every sender thread is listed as well. `gso` only shows the raw send rate:
+the TC redirect sees its super-packets unsegmented, so EbpfWorker does not
+train with it.
+"""
+import sys
+import numpy as np
+
+from ctypes import cdll, c_char_p, c_double, c_int, POINTER
+from utils import load_config
+
+ROUNDS = 10
+TX_MODES = {"sendto": 0, "sendmmsg": 1, "gso": 2}
+
+
+def main():
+    ifname = sys.argv[1] if len(sys.argv) > 1 else "ens3"
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    cpus = [int(cpu) for cpu in sys.argv[4].split(",")] if len(sys.argv) > 4 else []
+    config = load_config("local_config.json")
+    total_size = config["fragment_size"] * config["gradient_size"]
+
+    clib = cdll.LoadLibrary("./eBOT/agg_map_lib.so")
+    clib.init_socket.argtypes = [c_char_p]
+    clib.init_sender.argtypes = [c_int, c_int]
+    clib.send_all_fragments.argtypes = [c_int, POINTER(c_int)]
+    clib.get_tx_pps.restype = c_double
+    clib.init_sender_pool.argtypes = [c_int, POINTER(c_int), c_int]
+    clib.get_thread_pps.argtypes = [POINTER(c_double), c_int]
+
+    if clib.init_socket(ifname.encode("utf-8")) < 0:
+        return
+
+    grads = np.zeros(total_size, dtype=np.int32)
+    grads_c = grads.ctypes.data_as(POINTER(c_int))
+    for name, mode in TX_MODES.items():
+        used = clib.init_sender(mode, batch)
+        if used != mode:
+            print(f"{name:>8}: unavailable")
+            continue
+        # the pool sockets pick up the mode when they are opened
+        clib.init_sender_pool(threads, (c_int * len(cpus))(*cpus), len(cpus))
+
+        rates = []
+        thread_rates = []
+        for _ in range(ROUNDS):
+            clib.send_all_fragments(2**31 - 1, grads_c)
+            rates.append(clib.get_tx_pps())
+            pps = (c_double * threads)()
+            thread_rates.append(pps[:clib.get_thread_pps(pps, threads)])
+        print(
+            f"{name:>8}: "
+            f"{np.median(rates):,.0f} packets/s "
+            f"({config['fragment_size']} fragments, batch {batch}, {threads} threads)"
+        )
+        for i, pps in enumerate(np.median(thread_rates, axis=0) if threads > 1 else []):
+            print(f"{'':>8}  thread {i}: {pps:,.0f} packets/s")
+
+    clib.close_socket()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Gradient compression for the torch backends, picked by `comm_compression`
+in train_config:
+
+* `none`: fp32 gradients, as wide as the int32 lanes of the eBPF path.
+* `fp16`/`bf16`: gradients are divided by the world size, so fp16 sums
+  cannot overflow, cast and summed in that precision.
+* `powersgd`: every gradient with more than one dimension is viewed as an
+  n x m matrix M and sent as two rank r factors, P = M Q (n x r) and
+  Q = M^T P (m x r), with the residual carried into the next step
+  (Vogels et al., PowerSGD). Matrices too small to shrink by
+  MIN_COMPRESSION_RATE, and all vectors, are sent uncompressed. The first
+  `powersgd_start_iter` steps are not compressed.
+
+TorchDDPWorker registers the matching DDP comm hook from torch, and
+TorchTCPWorker does the same on its own buckets and with `PowerSGD` below.
+"""
+import torch
+import torch.distributed as dist
+
+COMPRESSION_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+COMPRESSION_MODES = ("none", "fp16", "bf16", "powersgd")
+MIN_COMPRESSION_RATE = 2
+
+
+def check_compression(mode: str) -> str:
+    if mode not in COMPRESSION_MODES:
+        raise ValueError(f"unknown comm_compression {mode}, expected one of {COMPRESSION_MODES}")
+    return mode
+
+
+def _matrix_shape(p: torch.Tensor) -> tuple:
+    return p.shape[0], p.numel() // p.shape[0]
+
+
+def _should_compress(p: torch.Tensor, rank: int) -> bool:
+    if p.dim() <= 1:
+        return False
+    n, m = _matrix_shape(p)
+    return (n + m) * rank * MIN_COMPRESSION_RATE < n * m
+
+
+def compressed_bytes(params, mode: str, rank: int = 1) -> int:
+    """Bytes of the gradients of params that one compressed all-reduce sends."""
+    total = 0
+    for p in params:
+        if not p.requires_grad:
+            continue
+        if mode in COMPRESSION_DTYPES:
+            total += p.numel() * COMPRESSION_DTYPES[mode].itemsize
+        elif mode == "powersgd" and _should_compress(p, rank):
+            n, m = _matrix_shape(p)
+            total += (n + m) * rank * p.element_size()
+        else:
+            total += p.numel() * p.element_size()
+    return total
+
+
+def ddp_comm_hook(mode: str, rank: int, start_iter: int) -> tuple:
+    """(state, hook) for DistributedDataParallel.register_comm_hook, None for `none`."""
+    from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+
+    if mode == "fp16":
+        return None, default_hooks.fp16_compress_hook
+    if mode == "bf16":
+        return None, default_hooks.bf16_compress_hook
+    if mode == "powersgd":
+        state = powerSGD_hook.PowerSGDState(
+            process_group=None,
+            matrix_approximation_rank=rank,
+            # DDP rebuilds its buckets after the first step
+            start_powerSGD_iter=max(2, start_iter),
+            min_compression_rate=MIN_COMPRESSION_RATE,
+        )
+        return state, powerSGD_hook.powerSGD_hook
+    return None
+
+
+class PowerSGD:
+    """PowerSGD averaging of the gradients of params over the default group.
+
+    Every P and every Q of a step is packed into one flat tensor, so a step
+    takes two all-reduces, plus one overlapping them for the uncompressed
+    gradients. Q starts from the same seed on every rank and is reused as
+    the starting point of the next step.
+    """
+
+    def __init__(self, params, rank: int = 1, start_iter: int = 0, seed: int = 0):
+        self._rank = rank
+        self._start_iter = start_iter
+        self._step = 0
+        params = [p for p in params if p.requires_grad]
+        self._matrices = [p for p in params if _should_compress(p, rank)]
+        self._vectors = [p for p in params if not _should_compress(p, rank)]
+
+        generator = torch.Generator().manual_seed(seed)
+        self._qs = []
+        self._errors = []
+        for p in self._matrices:
+            n, m = _matrix_shape(p)
+            q = torch.randn(m, rank, generator=generator).to(p.device, p.dtype)
+            self._qs.append(torch.linalg.qr(q).Q)
+            self._errors.append(torch.zeros(n, m, dtype=p.dtype, device=p.device))
+
+    @staticmethod
+    def _all_reduce_flat(tensors: list, async_op: bool = False):
+        """Sums tensors across ranks through one flat buffer, returns
+        (buffer, handle) to unpack with _unpack."""
+        flat = torch.cat([t.reshape(-1) for t in tensors])
+        return flat, dist.all_reduce(flat, op=dist.ReduceOp.SUM, async_op=async_op)
+
+    @staticmethod
+    def _unpack(flat: torch.Tensor, tensors: list):
+        offset = 0
+        for t in tensors:
+            t.copy_(flat[offset:offset + t.numel()].view_as(t))
+            offset += t.numel()
+
+    @staticmethod
+    def _fill_missing_grads(params: list):
+        # every rank has to send the same tensors, and a parameter without
+        # a grad on this rank may have one on another
+        for p in params:
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)
+
+    def all_reduce(self, world_size: int):
+        self._fill_missing_grads(self._vectors + self._matrices)
+        grads = [p.grad for p in self._vectors + self._matrices]
+        if self._step < self._start_iter or not self._matrices:
+            self._step += 1
+            flat, _ = self._all_reduce_flat(grads)
+            self._unpack(flat.div_(world_size), grads)
+            return
+        self._step += 1
+
+        vectors = [p.grad for p in self._vectors]
+        if vectors:
+            vector_flat, vector_handle = self._all_reduce_flat(vectors, async_op=True)
+
+        ms = []
+        for p, error in zip(self._matrices, self._errors):
+            error += p.grad.view_as(error)
+            ms.append(error)
+        ps = [m @ q for m, q in zip(ms, self._qs)]
+        flat, _ = self._all_reduce_flat(ps)
+        self._unpack(flat, ps)
+        ps = [torch.linalg.qr(p).Q for p in ps]
+
+        qs = [m.t() @ p for m, p in zip(ms, ps)]
+        flat, _ = self._all_reduce_flat(qs)
+        self._unpack(flat.div_(world_size), qs)
+
+        for param, m, p, q in zip(self._matrices, ms, ps, qs):
+            approx = p @ q.t()
+            # m is the error buffer, what is left of it is sent next step
+            m -= approx
+            param.grad.copy_(approx.view_as(param.grad))
+        self._qs = qs
+
+        if vectors:
+            vector_handle.wait()
+            self._unpack(vector_flat.div_(world_size), vectors)
@@ -0,0 +1,160 @@
+"""
+Preprocessed datasets for the training workers, built by utils.prepare_data.
+
+The first use of a dataset decodes and resizes every image once and
+writes it as a uint8 .npy array in `data_dir`/cache, one file per dataset,
+split and image size. Later runs memory-map these files, so a batch is a
+single gather from the page cache; only the conversion to float and the
+normalization, both vectorized over the batch, are left per step.
+
+Batches are produced by a torch DataLoader over `MemmapBatches`, whose
+items are whole batches. With `num_workers` > 0 the next `prefetch_factor`
+batches of every worker are loaded in the background, also while the
+worker exchanges gradients.
+"""
+import os
+import numpy as np
+import torch
+from filelock import FileLock
+from torch.utils.data import BatchSampler, DataLoader, Dataset, DistributedSampler, SequentialSampler
+
+# data_type -> image size of the cache and the per channel mean and std
+DATASET_SPECS = {
+    "mnist": {"size": 28, "mean": (0.1307,), "std": (0.3081,)},
+    "cifar10": {"size": 224, "mean": (0.5, 0.5, 0.5), "std": (0.5, 0.5, 0.5)},
+}
+# images resized per chunk while building a cache
+BUILD_CHUNK = 256
+
+
+def cache_paths(cache_dir: str, data_type: str, train: bool) -> tuple:
+    """Paths of the image and label arrays of one split."""
+    split = "train" if train else "test"
+    name = f"{data_type}-{split}-{DATASET_SPECS[data_type]['size']}"
+    return os.path.join(cache_dir, f"{name}.npy"), os.path.join(cache_dir, f"{name}-labels.npy")
+
+
+def _load_raw(data_type: str, data_dir: str, train: bool) -> tuple:
+    """Images as uint8 (N, C, H, W) and labels of a torchvision dataset."""
+    from torchvision import datasets
+
+    if data_type == "mnist":
+        dataset = datasets.MNIST(data_dir, train=train, download=True)
+        return dataset.data.unsqueeze(1), np.asarray(dataset.targets, dtype=np.int64)
+    if data_type == "cifar10":
+        dataset = datasets.CIFAR10(data_dir, train=train, download=True)
+        images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2)
+        return images, np.asarray(dataset.targets, dtype=np.int64)
+    raise ValueError(f"unknown dataset {data_type}")
+
+
+def build_cache(data_type: str, data_dir: str, train: bool, cache_dir: str):
+    images_path, labels_path = cache_paths(cache_dir, data_type, train)
+    images, labels = _load_raw(data_type, data_dir, train)
+    size = DATASET_SPECS[data_type]["size"]
+
+    # written under temporary names, so a cache file is always complete
+    tmp_path = f"{images_path}.{os.getpid()}.tmp"
+    out = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.uint8, shape=(len(images), images.shape[1], size, size)
+    )
+    for start in range(0, len(images), BUILD_CHUNK):
+        chunk = images[start:start + BUILD_CHUNK]
+        if chunk.shape[-1] != size:
+            chunk = torch.nn.functional.interpolate(
+                chunk.float(), size=(size, size), mode="bilinear", antialias=True,
+                align_corners=False,
+            ).round_().clamp_(0, 255).to(torch.uint8)
+        out[start:start + len(chunk)] = chunk.numpy()
+    out.flush()
+    del out
+
+    np.save(f"{labels_path}.{os.getpid()}.tmp.npy", labels)
+    os.replace(f"{labels_path}.{os.getpid()}.tmp.npy", labels_path)
+    os.replace(tmp_path, images_path)
+
+
+def open_cache(data_type: str, data_dir: str, train: bool) -> tuple:
+    """Memory-mapped (images, labels) of one split, building the cache first
+    if needed."""
+    data_dir = os.path.expanduser(data_dir)
+    cache_dir = os.path.join(data_dir, "cache")
+    images_path, labels_path = cache_paths(cache_dir, data_type, train)
+    if not os.path.exists(images_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # only processes building the same dataset wait for each other
+        with FileLock(os.path.join(cache_dir, f"{data_type}.lock")):
+            if not os.path.exists(images_path):
+                print(f"Building the {data_type} cache in {cache_dir}")
+                build_cache(data_type, data_dir, train, cache_dir)
+    return np.load(images_path, mmap_mode="r"), np.load(labels_path)
+
+
+class MemmapBatches(Dataset):
+    """Whole batches of a cached split, indexed by lists of sample indices.
+
+    The memmap is reopened in every DataLoader worker, so the workers share
+    the page cache instead of a pickled copy of the data.
+    """
+
+    def __init__(self, data_type: str, data_dir: str, train: bool):
+        self._data_type = data_type
+        self._data_dir = data_dir
+        self._train = train
+        self._images, self.labels = open_cache(data_type, data_dir, train)
+
+        spec = DATASET_SPECS[data_type]
+        # x / 255 normalized as x * scale + bias
+        std = torch.tensor(spec["std"]).view(1, -1, 1, 1)
+        self._scale = 1.0 / (255.0 * std)
+        self._bias = -torch.tensor(spec["mean"]).view(1, -1, 1, 1) / std
+
+    def __getstate__(self) -> dict:
+        # a pickled memmap would be a copy of the whole split
+        return {**self.__dict__, "_images": None}
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __getitem__(self, indices: list) -> tuple:
+        if self._images is None:
+            self._images, _ = open_cache(self._data_type, self._data_dir, self._train)
+        # sorted indices read the file front to back, the order within a
+        # batch does not matter
+        indices = np.sort(np.asarray(indices))
+        images = torch.from_numpy(self._images[indices])
+        inputs = torch.empty(images.shape, dtype=torch.float32)
+        inputs.copy_(images).mul_(self._scale).add_(self._bias)
+        return inputs, torch.from_numpy(self.labels[indices])
+
+
+def make_loader(dataset: MemmapBatches, batch_size: int, sampler=None, num_workers: int = 0,
+                pin_memory: bool = False, prefetch_factor: int = 2) -> DataLoader:
+    if sampler is None:
+        sampler = SequentialSampler(dataset)
+    return DataLoader(
+        dataset,
+        # the dataset returns whole batches
+        batch_size=None,
+        sampler=BatchSampler(sampler, batch_size, drop_last=False),
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        persistent_workers=num_workers > 0,
+    )
+
+
+def distributed_loader(dataset: MemmapBatches, rank: int, world_size: int,
+                       batch_size: int, **kwargs) -> DataLoader:
+    """Loader over the shard of rank, shuffled like DistributedSampler."""
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank)
+    return make_loader(dataset, batch_size, sampler, **kwargs)
+
+
+def shard_loader(dataset: MemmapBatches, rank: int, world_size: int,
+                 batch_size: int, **kwargs) -> DataLoader:
+    """Loader over a contiguous 1/world_size of dataset, in order. Unlike
+    DistributedSampler, no samples are repeated to even out the shards."""
+    start = len(dataset) * rank // world_size
+    end = len(dataset) * (rank + 1) // world_size
+    return make_loader(dataset, batch_size, range(start, end), **kwargs)
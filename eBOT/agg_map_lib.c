@@ -1,13 +1,68 @@
+#define _GNU_SOURCE
 #include <stdio.h>
 #include <unistd.h>
 #include <stdlib.h>
+#include <errno.h>
+#include <time.h>
+#include <sched.h>
+#include <pthread.h>
+#include <net/if.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/uio.h>
 
 #include <bpf/bpf.h>
+#include <bpf/libbpf.h>
 #include <xdp/libxdp.h>
 #include "agg_common.h"
 
 
+#ifndef SOL_UDP
+#define SOL_UDP 17
+#endif
+#ifndef UDP_SEGMENT
+#define UDP_SEGMENT 103
+#endif
+
+#define TX_MODE_SENDTO   0
+#define TX_MODE_SENDMMSG 1
+#define TX_MODE_GSO      2
+
+#define TX_BATCH_MAX     1024
+#define TX_HEADER_SIZE   (sizeof(uint32_t) * 5)
+#define TX_GRADS_SIZE    (GRADIENT_SIZE * sizeof(lane_t))
+#define TX_PAYLOAD_SIZE  (TX_HEADER_SIZE + TX_GRADS_SIZE)
+#define GSO_MAX_SEGS     64
+#define GSO_MAX_BYTES    65000
+#define TX_THREADS_MAX   64
+#define TX_POOL_MIN      256 // smaller sends stay on the calling thread
+
+#define PACING_OFF       0
+#define PACING_BUCKET    1
+#define PACING_SPIN_SEC  100e-6 // shorter waits spin instead of sleeping
+#define WIRE_OVERHEAD    (14 + 20 + 8) // ethernet, ip and udp headers
+
+#define MAP_READ_LOOKUP  0
+#define MAP_READ_BATCH   1
+#define MAP_READ_MMAP    2
+
+#define AGG_MAP_STRIDE   ((sizeof(struct agg_map) + 7) & ~7UL)
+#define LOOKUP_BATCH     1024
+#define DONE_TIMEOUT_MS  10
+
+#define RETX_STAT_TIMEOUTS 0
+#define RETX_STAT_RESENT   1
+#define RETX_STAT_NUM      (2 + STAT_NUM)
+
 static char *aggmap_path = "/sys/fs/bpf/aggregator_map";
+static char *completion_path = "/sys/fs/bpf/completion_map";
+static char *stats_path = "/sys/fs/bpf/stats_map";
+
+static double now_sec() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
 
 int get_aggmap_fd() {
     int agg_fd = bpf_obj_get(aggmap_path);
@@ -25,36 +80,390 @@ struct agg_map get_aggmap(int agg_fd, int frag_id) {
     return map;
 }
 
-int* busy_polling(int agg_fd, int prev_iter) {
-    static int all_grads[FRAGMENT_SIZE * GRADIENT_SIZE];
-    struct agg_map map;
-    bool updated[FRAGMENT_SIZE] = { false };
+static int all_grads[FRAGMENT_SIZE * GRADIENT_SIZE];
+static bool updated[FRAGMENT_SIZE];
+static int frag_first = 0;
+static int frag_end = FRAGMENT_SIZE;
+static int frag_count = FRAGMENT_SIZE;
+static int updated_count = 0;
+static int polling_iter = -1;
+
+static int map_read_mode = MAP_READ_LOOKUP;
+static uint8_t *aggmap_mmap = NULL;
+static size_t aggmap_mmap_size = 0;
+static __u32 batch_keys[LOOKUP_BATCH];
+static struct agg_map batch_values[LOOKUP_BATCH];
+
+int* get_grads_buffer() {
+    return all_grads;
+}
+
+/*
+ * Limits sending and polling to fragments [first, first + count). Every
+ * fragment counts its own iterations, so a range that is reduced on its
+ * own (the evaluation counts past the model) never falls out of step with
+ * the rest. Returns the number of fragments in the range.
+ */
+int set_fragment_range(int first, int count) {
+    if (first < 0) first = 0;
+    if (first > FRAGMENT_SIZE - 1) first = FRAGMENT_SIZE - 1;
+    if (count < 1) count = 1;
+    if (count > FRAGMENT_SIZE - first) count = FRAGMENT_SIZE - first;
+    frag_first = first;
+    frag_end = first + count;
+    frag_count = count;
+    polling_iter = -1;
+    return frag_count;
+}
+
+/*
+ * Limits sending and polling to fragments [0, count), the ones holding the
+ * model's gradients.
+ */
+int set_fragment_count(int count) {
+    return set_fragment_range(0, count);
+}
+
+/*
+ * Picks how poll_fragments reads aggregator_map: a shared mapping of the
+ * BPF_F_MMAPABLE array (no syscalls, no copies), bpf_map_lookup_batch over
+ * fragment ranges, or one bpf_map_lookup_elem per fragment. Returns the
+ * mode in use.
+ */
+int init_map_reader(int agg_fd) {
+    long page_size = sysconf(_SC_PAGESIZE);
+    size_t size = AGG_MAP_STRIDE * FRAGMENT_SIZE;
+    size = (size + page_size - 1) / page_size * page_size;
+
+    void *addr = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, agg_fd, 0);
+    if (addr != MAP_FAILED) {
+        aggmap_mmap = addr;
+        aggmap_mmap_size = size;
+        map_read_mode = MAP_READ_MMAP;
+        return map_read_mode;
+    }
+
+    __u32 out_batch, count = 1;
+    if (bpf_map_lookup_batch(agg_fd, NULL, &out_batch, batch_keys,
+                batch_values, &count, NULL) == 0 || errno == ENOENT)
+        map_read_mode = MAP_READ_BATCH;
+    else
+        map_read_mode = MAP_READ_LOOKUP;
+
+    return map_read_mode;
+}
+
+void* get_aggmap_mmap() {
+    return aggmap_mmap;
+}
+
+size_t get_aggmap_stride() {
+    return AGG_MAP_STRIDE;
+}
+
+static inline bool fragment_done(const struct agg_map *map, int prev_iter) {
+    return map->lock == 0 && map->iter == prev_iter + 1 && map->lflag == 1;
+}
+
+static inline void mark_fragment(int frag_id, const __u32 *grads, int *ready, int *count) {
+    // with the mmap reader python reads grads in place
+    if (grads)
+        memcpy(all_grads + frag_id * GRADIENT_SIZE, grads,
+                GRADIENT_SIZE * sizeof(int32_t));
+
+    updated[frag_id] = true;
+    updated_count++;
+    ready[(*count)++] = frag_id;
+}
+
+static int sweep_mmap(int prev_iter, int *ready, int max_ready) {
     int count = 0;
 
-    memset(all_grads, 0, sizeof(all_grads));
+    for (int frag_id = frag_first; frag_id < frag_end; frag_id++) {
+        if (updated[frag_id]) continue;
 
-    while (count < FRAGMENT_SIZE) {
-	    for (int frag_id = 0; frag_id < FRAGMENT_SIZE; frag_id++) {
-	        if (updated[frag_id]) continue;
+        struct agg_map *map = (struct agg_map *)(aggmap_mmap + frag_id * AGG_MAP_STRIDE);
+        if (!fragment_done(map, prev_iter)) continue;
 
-            bpf_map_lookup_elem(agg_fd, &frag_id, &map);
+        __sync_synchronize();
+        map->lflag = 0;
+        mark_fragment(frag_id, NULL, ready, &count);
+        if (count == max_ready)
+            break;
+    }
 
-            if (map.lock == 1) continue;
+    return count;
+}
+
+/*
+ * lflag is left set here: iter alone tells the iterations apart and
+ * writing the whole value back would double the syscalls again.
+ */
+static int sweep_batch(int agg_fd, int prev_iter, int *ready, int max_ready) {
+    int count = 0;
 
-            if (map.iter == prev_iter + 1 && map.lflag == 1) {
-                for (size_t i = 0; i < GRADIENT_SIZE; i++) {
-                    int32_t val = map.grads[i];
-                    all_grads[frag_id * GRADIENT_SIZE + i] = map.grads[i];
-                }
+    for (int first = frag_first; first < frag_end; first += LOOKUP_BATCH) {
+        __u32 prev_key = first - 1, out_batch;
+        __u32 nkeys = frag_end - first < LOOKUP_BATCH ? frag_end - first : LOOKUP_BATCH;
+        bool pending = false;
 
-                map.lflag = 0;
-                bpf_map_update_elem(agg_fd, &frag_id, &map, 0);
-                
-                updated[frag_id] = true;
-                count++;
+        for (int frag_id = first; frag_id < first + nkeys; frag_id++) {
+            if (!updated[frag_id]) {
+                pending = true;
+                break;
             }
         }
-        usleep(5);
+        if (!pending) continue;
+
+        if (bpf_map_lookup_batch(agg_fd, first ? &prev_key : NULL, &out_batch,
+                    batch_keys, batch_values, &nkeys, NULL) < 0 && errno != ENOENT)
+            continue;
+
+        for (__u32 i = 0; i < nkeys; i++) {
+            int frag_id = batch_keys[i];
+            if (frag_id >= frag_end || updated[frag_id] || !fragment_done(&batch_values[i], prev_iter))
+                continue;
+
+            mark_fragment(frag_id, batch_values[i].grads, ready, &count);
+            if (count == max_ready)
+                return count;
+        }
+    }
+
+    return count;
+}
+
+static int sweep_lookup(int agg_fd, int prev_iter, int *ready, int max_ready) {
+    struct agg_map map;
+    int count = 0;
+
+    for (int frag_id = frag_first; frag_id < frag_end; frag_id++) {
+        if (updated[frag_id]) continue;
+
+        bpf_map_lookup_elem(agg_fd, &frag_id, &map);
+
+        if (!fragment_done(&map, prev_iter)) continue;
+
+        map.lflag = 0;
+        bpf_map_update_elem(agg_fd, &frag_id, &map, 0);
+
+        mark_fragment(frag_id, map.grads, ready, &count);
+        if (count == max_ready)
+            break;
+    }
+
+    return count;
+}
+
+static struct ring_buffer *done_rb = NULL;
+static int done_agg_fd = -1;
+static int done_spin_us = 0;
+static int done_queue[FRAGMENT_SIZE];
+static int done_head = 0;
+static int done_tail = 0;
+
+static int handle_done(void *ctx, void *data, size_t len) {
+    const struct agg_done *rec = data;
+    __u32 frag_id = rec->fid;
+
+    if (len < sizeof(*rec) || frag_id < frag_first || frag_id >= frag_end)
+        return 0;
+    if (rec->iter != polling_iter + 1 || updated[frag_id])
+        return 0;
+
+    if (map_read_mode == MAP_READ_MMAP) {
+        struct agg_map *map = (struct agg_map *)(aggmap_mmap + frag_id * AGG_MAP_STRIDE);
+        if (!fragment_done(map, polling_iter))
+            return 0;
+        map->lflag = 0;
+    } else {
+        struct agg_map map;
+        if (bpf_map_lookup_elem(done_agg_fd, &frag_id, &map) < 0 ||
+                !fragment_done(&map, polling_iter))
+            return 0;
+        memcpy(all_grads + frag_id * GRADIENT_SIZE, map.grads,
+                GRADIENT_SIZE * sizeof(int32_t));
+    }
+
+    updated[frag_id] = true;
+    updated_count++;
+    done_queue[done_tail++] = frag_id;
+    return 0;
+}
+
+/*
+ * Subscribes to the completion records the XDP aggregator publishes into
+ * completion_map. poll_fragments then spins on the ring for spin_us and
+ * sleeps in epoll afterwards instead of rescanning every fragment.
+ */
+int init_notifier(int agg_fd, int spin_us) {
+    int fd = bpf_obj_get(completion_path);
+    if (fd < 0) {
+        printf("Failed to get completion_map fd, fd = %d\n", fd);
+        return -1;
+    }
+
+    done_rb = ring_buffer__new(fd, handle_done, NULL, NULL);
+    if (!done_rb) {
+        fprintf(stderr, "Failed to create ring buffer\n");
+        close(fd);
+        return -1;
+    }
+
+    done_agg_fd = agg_fd;
+    done_spin_us = spin_us;
+    return 0;
+}
+
+void close_notifier() {
+    if (done_rb) {
+        ring_buffer__free(done_rb);
+        done_rb = NULL;
+    }
+}
+
+static int drain_done(int *ready, int max_ready) {
+    int count = 0;
+
+    while (done_head < done_tail && count < max_ready)
+        ready[count++] = done_queue[done_head++];
+
+    return count;
+}
+
+static int wait_done(int agg_fd, int prev_iter, int *ready, int max_ready) {
+    int count = drain_done(ready, max_ready);
+    if (count)
+        return count;
+
+    double spin_end = now_sec() + done_spin_us * 1e-6;
+    do {
+        ring_buffer__consume(done_rb);
+        if ((count = drain_done(ready, max_ready)))
+            return count;
+    } while (now_sec() < spin_end);
+
+    if (ring_buffer__poll(done_rb, DONE_TIMEOUT_MS) > 0)
+        return drain_done(ready, max_ready);
+
+    // quiet for a while, records may have been dropped on a full ring
+    if (map_read_mode == MAP_READ_MMAP)
+        return sweep_mmap(prev_iter, ready, max_ready);
+    if (map_read_mode == MAP_READ_BATCH)
+        return sweep_batch(agg_fd, prev_iter, ready, max_ready);
+    return sweep_lookup(agg_fd, prev_iter, ready, max_ready);
+}
+
+static int retx_timeout_us = 0;
+static int retx_max_timeout_us = 0;
+static int retx_limit = 0;
+static int retx_rounds = 0;
+static double retx_deadline = 0;
+static uint64_t retx_stats[2];
+
+static int resend_missing(int step);
+
+/*
+ * Enables loss recovery in poll_fragments: once fragments of an iteration
+ * have completed but no further one does for timeout_us, the fragments
+ * still missing are sent again and the timeout doubles up to
+ * max_timeout_us. Until the first fragment completes, a slow peer cannot
+ * be told from a loss, so the first resend waits max_timeout_us. After
+ * `limit` retransmit rounds without progress polling fails (limit 0
+ * retries forever, timeout_us 0 disables).
+ */
+void init_retransmit(int timeout_us, int max_timeout_us, int limit) {
+    retx_timeout_us = timeout_us;
+    retx_max_timeout_us = max_timeout_us > timeout_us ? max_timeout_us : timeout_us;
+    retx_limit = limit;
+}
+
+static void arm_deadline(int progressed) {
+    retx_rounds = 0;
+    retx_deadline = now_sec() + (progressed ? retx_timeout_us : retx_max_timeout_us) * 1e-6;
+}
+
+static int check_deadline(int prev_iter) {
+    double now = now_sec();
+    if (now < retx_deadline)
+        return 0;
+
+    if (retx_limit > 0 && retx_rounds >= retx_limit) {
+        fprintf(stderr, "Iteration %d: %d fragments lost after %d retransmits\n",
+                prev_iter, frag_count - updated_count, retx_rounds);
+        return -1;
+    }
+
+    retx_stats[RETX_STAT_TIMEOUTS]++;
+    resend_missing(prev_iter);
+
+    long timeout_us = (long)retx_timeout_us << (retx_rounds < 16 ? retx_rounds + 1 : 16);
+    if (timeout_us > retx_max_timeout_us)
+        timeout_us = retx_max_timeout_us;
+    retx_deadline = now + timeout_us * 1e-6;
+    retx_rounds++;
+    return 0;
+}
+
+/*
+ * Blocks until at least one fragment of iteration prev_iter + 1 is done
+ * and writes its id into ready. Returns the number of ids written (at most
+ * max_ready), 0 once every fragment is done, or -1 when the retransmit
+ * limit is hit. Except for the mmap reader, the fragment's grads are
+ * copied into all_grads.
+ */
+int poll_fragments(int agg_fd, int prev_iter, int *ready, int max_ready) {
+    int count = 0;
+
+    if (polling_iter != prev_iter) {
+        memset(updated, 0, sizeof(updated));
+        updated_count = 0;
+        done_head = done_tail = 0;
+        polling_iter = prev_iter;
+        arm_deadline(0);
+    }
+
+    while (count == 0 && (updated_count < frag_count || done_head < done_tail)) {
+        if (done_rb)
+            count = wait_done(agg_fd, prev_iter, ready, max_ready);
+        else if (map_read_mode == MAP_READ_MMAP)
+            count = sweep_mmap(prev_iter, ready, max_ready);
+        else if (map_read_mode == MAP_READ_BATCH)
+            count = sweep_batch(agg_fd, prev_iter, ready, max_ready);
+        else
+            count = sweep_lookup(agg_fd, prev_iter, ready, max_ready);
+
+        if (count > 0) {
+            if (retx_timeout_us > 0)
+                arm_deadline(1);
+            break;
+        }
+
+        if (retx_timeout_us > 0 && check_deadline(prev_iter) < 0)
+            return -1;
+
+        if (!done_rb)
+            usleep(5);
+    }
+
+    return count;
+}
+
+int* busy_polling(int agg_fd, int prev_iter) {
+    static int ready[FRAGMENT_SIZE];
+    int count;
+
+    while ((count = poll_fragments(agg_fd, prev_iter, ready, FRAGMENT_SIZE)) != 0) {
+        if (count < 0)
+            return NULL;
+        if (map_read_mode != MAP_READ_MMAP)
+            continue;
+
+        for (int i = 0; i < count; i++) {
+            struct agg_map *map = (struct agg_map *)(aggmap_mmap + ready[i] * AGG_MAP_STRIDE);
+            memcpy(all_grads + ready[i] * GRADIENT_SIZE, map->grads,
+                    GRADIENT_SIZE * sizeof(int32_t));
+        }
     }
 
     return all_grads;
@@ -64,20 +473,30 @@ int* busy_polling(int agg_fd, int prev_iter) {
 static int sockfd = -1;
 static struct sockaddr_in dest_addr;
 
-int init_socket(const char *ifname) {
-    sockfd = socket(AF_INET, SOCK_DGRAM, 0);
-    if (sockfd < 0) {
+static char tx_ifname[IF_NAMESIZE];
+
+static int open_socket(const char *ifname) {
+    int fd = socket(AF_INET, SOCK_DGRAM, 0);
+    if (fd < 0) {
         perror("socket");
         return -1;
     }
 
-    if (setsockopt(sockfd, SOL_SOCKET, SO_BINDTODEVICE, ifname, strlen(ifname) + 1) < 0) {
+    if (setsockopt(fd, SOL_SOCKET, SO_BINDTODEVICE, ifname, strlen(ifname) + 1) < 0) {
         perror("SO_BINDTODEVICE");
-        close(sockfd);
-        sockfd = -1;
+        close(fd);
         return -1;
     }
 
+    return fd;
+}
+
+int init_socket(const char *ifname) {
+    sockfd = open_socket(ifname);
+    if (sockfd < 0)
+        return -1;
+    snprintf(tx_ifname, sizeof(tx_ifname), "%s", ifname);
+
     memset(&dest_addr, 0, sizeof(dest_addr));
     dest_addr.sin_family = AF_INET;
     dest_addr.sin_port = htons(PORT);
@@ -86,30 +505,150 @@ int init_socket(const char *ifname) {
     return 0;
 }
 
-int send_all_fragments(int step, const int32_t *grads) {
+static int tx_mode = TX_MODE_SENDTO;
+static int tx_batch = 1;
+static const lane_t *tx_grads = NULL;
+static const int32_t *tx_exps = NULL;
+static int tx_step = -1;
+static uint32_t tx_headers[FRAGMENT_SIZE][5];
+static struct iovec tx_iovs[FRAGMENT_SIZE][2];
+static struct mmsghdr tx_msgs[TX_BATCH_MAX];
+static double tx_pps = 0;
+
+/*
+ * Selects the transmit path and builds every fragment header once.
+ * Returns the mode actually in use (GSO falls back to sendmmsg when
+ * the kernel rejects UDP_SEGMENT).
+ */
+int init_sender(int mode, int batch) {
     if (sockfd < 0) {
         fprintf(stderr, "Socket not initialized\n");
         return -1;
     }
-    
-    static uint8_t payload[sizeof(uint32_t) * 4 + GRADIENT_SIZE * sizeof(int32_t)];
+
+    if (batch < 1) batch = 1;
+    if (batch > TX_BATCH_MAX) batch = TX_BATCH_MAX;
 
     for (int frag_id = 0; frag_id < FRAGMENT_SIZE; frag_id++) {
-        uint32_t header[4];
+        tx_headers[frag_id][0] = htonl(HOST_ID);
+        tx_headers[frag_id][1] = htonl(frag_id);
+        tx_headers[frag_id][2] = htonl(0); //bcast_id
+        tx_headers[frag_id][3] = 0;
+        tx_headers[frag_id][4] = 0;
+        tx_iovs[frag_id][0].iov_base = tx_headers[frag_id];
+        tx_iovs[frag_id][0].iov_len = TX_HEADER_SIZE;
+        tx_iovs[frag_id][1].iov_len = TX_GRADS_SIZE;
+    }
+
+    if (mode == TX_MODE_GSO) {
+        int gso_size = TX_PAYLOAD_SIZE;
+        if (setsockopt(sockfd, SOL_UDP, UDP_SEGMENT, &gso_size, sizeof(gso_size)) < 0) {
+            perror("UDP_SEGMENT");
+            mode = TX_MODE_SENDMMSG;
+        }
+    }
+
+    tx_mode = mode;
+    tx_batch = batch;
+    return tx_mode;
+}
+
+/*
+ * Points the sender at the per-fragment exponents of the narrow lane
+ * modes. They are read on every send, so the caller can update them in
+ * place between iterations. NULL sends exponent 0.
+ */
+void set_lane_exponents(const int32_t *exps) {
+    tx_exps = exps;
+}
+
+double get_tx_pps() {
+    return tx_pps;
+}
+
+/*
+ * Token bucket in bytes per second, filled from `last` on. Senders block
+ * until a whole syscall's worth of packets is covered, so with pacing on
+ * the syscalls are cut down to tx_burst packets.
+ */
+struct pacer {
+    double rate;
+    double tokens;
+    double last;
+};
+
+static int pacing_mode = PACING_OFF;
+static double pacing_rate = 0; // bytes per second of this node
+static double pacing_offset = 0;
+static int tx_burst = 0;
+static struct pacer tx_pacer;
+
+static void sleep_until(double deadline) {
+    double now = now_sec();
+    if (deadline - now > PACING_SPIN_SEC) {
+        double wake = deadline - PACING_SPIN_SEC / 2;
+        struct timespec ts = {
+            .tv_sec = (time_t)wake,
+            .tv_nsec = (long)((wake - (time_t)wake) * 1e9),
+        };
+        clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &ts, NULL);
+    }
+    while (now_sec() < deadline)
+        ;
+}
+
+/*
+ * Starts a send with an empty bucket that fills from pacing_offset on, so
+ * siblings sending at the same moment take turns instead of colliding.
+ */
+static void pacer_start(struct pacer *p, double rate) {
+    p->rate = rate;
+    p->tokens = 0;
+    p->last = now_sec() + pacing_offset;
+}
+
+static void pacer_wait(struct pacer *p, int packets) {
+    if (pacing_mode != PACING_BUCKET || p->rate <= 0)
+        return;
+
+    double bytes = (double)packets * (TX_PAYLOAD_SIZE + WIRE_OVERHEAD);
+    double now = now_sec();
+    if (now > p->last) {
+        // idle time does not add up beyond one syscall
+        p->tokens += (now - p->last) * p->rate;
+        if (p->tokens > bytes) p->tokens = bytes;
+        p->last = now;
+    }
+    if (p->tokens < bytes) {
+        double ready = p->last + (bytes - p->tokens) / p->rate;
+        sleep_until(ready);
+        p->tokens = bytes;
+        p->last = ready;
+    }
+    p->tokens -= bytes;
+}
+
+static int send_sendto(int fd, struct pacer *pacer, int step, const lane_t *grads,
+        int first, int count) {
+    uint8_t payload[TX_PAYLOAD_SIZE];
+
+    for (int frag_id = first; frag_id < first + count; frag_id++) {
+        pacer_wait(pacer, 1);
+
+        uint32_t header[5];
         header[0] = htonl(HOST_ID);
         header[1] = htonl(frag_id);
         header[2] = htonl(0); //bcast_id
         header[3] = htonl(step);
+        header[4] = htonl(tx_exps ? tx_exps[frag_id] : 0);
 
         size_t grad_offset = frag_id * GRADIENT_SIZE;
-        size_t grad_bytes = GRADIENT_SIZE * sizeof(int32_t);
-        size_t payload_size = sizeof(header) + grad_bytes;
 
         memcpy(payload, header, sizeof(header));
 
-        memcpy(payload + sizeof(header), grads + grad_offset, grad_bytes);
+        memcpy(payload + sizeof(header), grads + grad_offset, TX_GRADS_SIZE);
 
-        ssize_t sent = sendto(sockfd, payload, payload_size, 0,
+        ssize_t sent = sendto(fd, payload, TX_PAYLOAD_SIZE, 0,
                 (struct sockaddr *)&dest_addr, sizeof(dest_addr));
         if (sent < 0) {
             perror("sendto");
@@ -120,7 +659,406 @@ int send_all_fragments(int step, const int32_t *grads) {
     return 0;
 }
 
+/*
+ * Sends `segs` fragments per message and `tx_batch` messages per syscall.
+ * Headers and grads are gathered straight from tx_iovs, nothing is copied.
+ * Only the fragments' own headers are written, so threads sending disjoint
+ * ranges can share them.
+ */
+static int send_batched(int fd, struct mmsghdr *msgs, struct pacer *pacer, int step,
+        const lane_t *grads, int first, int count, int segs) {
+    int end = first + count;
+    int batch = tx_batch;
+
+    if (pacing_mode == PACING_BUCKET) {
+        if (segs > tx_burst) segs = tx_burst;
+        batch = tx_burst / segs;
+    }
+
+    for (int frag_id = first; frag_id < end; frag_id++) {
+        tx_headers[frag_id][3] = htonl(step);
+        tx_headers[frag_id][4] = htonl(tx_exps ? tx_exps[frag_id] : 0);
+        tx_iovs[frag_id][1].iov_base = (void *)(grads + frag_id * GRADIENT_SIZE);
+    }
+
+    int frag_id = first;
+    while (frag_id < end) {
+        int nmsgs = 0;
+        int batch_first = frag_id;
+        while (nmsgs < batch && frag_id < end) {
+            int nsegs = end - frag_id < segs ? end - frag_id : segs;
+            struct msghdr *hdr = &msgs[nmsgs].msg_hdr;
+
+            memset(hdr, 0, sizeof(*hdr));
+            hdr->msg_name = &dest_addr;
+            hdr->msg_namelen = sizeof(dest_addr);
+            hdr->msg_iov = tx_iovs[frag_id];
+            hdr->msg_iovlen = 2 * nsegs;
+
+            frag_id += nsegs;
+            nmsgs++;
+        }
+
+        pacer_wait(pacer, frag_id - batch_first);
+
+        int sent = 0;
+        while (sent < nmsgs) {
+            int ret = sendmmsg(fd, msgs + sent, nmsgs - sent, 0);
+            if (ret < 0) {
+                if (errno == EINTR) continue;
+                perror("sendmmsg");
+                return -1;
+            }
+            sent += ret;
+        }
+    }
+
+    return 0;
+}
+
+static int transmit_on(int fd, struct mmsghdr *msgs, struct pacer *pacer, double rate,
+        int step, const lane_t *grads, int first, int count) {
+    if (pacing_mode != PACING_OFF)
+        pacer_start(pacer, rate);
+
+    if (tx_mode == TX_MODE_GSO) {
+        int segs = GSO_MAX_BYTES / TX_PAYLOAD_SIZE;
+        if (segs > GSO_MAX_SEGS) segs = GSO_MAX_SEGS;
+        return send_batched(fd, msgs, pacer, step, grads, first, count, segs);
+    }
+    if (tx_mode == TX_MODE_SENDMMSG)
+        return send_batched(fd, msgs, pacer, step, grads, first, count, 1);
+    return send_sendto(fd, pacer, step, grads, first, count);
+}
+
+struct tx_worker {
+    pthread_t thread;
+    int fd;
+    int cpu;
+    int first;
+    int count;
+    int ret;
+    double pps;
+    unsigned long round; // last tx_round this thread ran
+    struct pacer pacer;
+    struct mmsghdr msgs[TX_BATCH_MAX];
+};
+
+static struct tx_worker tx_workers[TX_THREADS_MAX];
+static int tx_threads = 0;
+static pthread_mutex_t tx_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t tx_start = PTHREAD_COND_INITIALIZER;
+static pthread_cond_t tx_finish = PTHREAD_COND_INITIALIZER;
+static unsigned long tx_round = 0;
+static int tx_pending = 0;
+static bool tx_stop = false;
+static int tx_job_step;
+static const lane_t *tx_job_grads;
+
+static void *tx_worker_loop(void *arg) {
+    struct tx_worker *w = arg;
+
+    if (w->cpu >= 0) {
+        cpu_set_t set;
+        CPU_ZERO(&set);
+        CPU_SET(w->cpu, &set);
+        if (pthread_setaffinity_np(pthread_self(), sizeof(set), &set) != 0)
+            fprintf(stderr, "Failed to pin sender thread to CPU %d\n", w->cpu);
+    }
+
+    pthread_mutex_lock(&tx_lock);
+    for (;;) {
+        while (!tx_stop && w->round == tx_round)
+            pthread_cond_wait(&tx_start, &tx_lock);
+        if (tx_stop)
+            break;
+
+        w->round = tx_round;
+        int step = tx_job_step;
+        const lane_t *grads = tx_job_grads;
+        pthread_mutex_unlock(&tx_lock);
+
+        w->ret = 0;
+        if (w->count > 0) {
+            double start = now_sec();
+            w->ret = transmit_on(w->fd, w->msgs, &w->pacer, pacing_rate / tx_threads,
+                    step, grads, w->first, w->count);
+            double elapsed = now_sec() - start;
+            if (w->ret == 0 && elapsed > 0)
+                w->pps = w->count / elapsed;
+        }
+
+        pthread_mutex_lock(&tx_lock);
+        if (--tx_pending == 0)
+            pthread_cond_signal(&tx_finish);
+    }
+    pthread_mutex_unlock(&tx_lock);
+
+    return NULL;
+}
+
+/*
+ * Splits [first, first + count) into one contiguous shard per thread and
+ * blocks until every shard is on the wire.
+ */
+static int pool_transmit(int step, const lane_t *grads, int first, int count) {
+    int share = (count + tx_threads - 1) / tx_threads;
+    int end = first + count;
+
+    pthread_mutex_lock(&tx_lock);
+    for (int t = 0; t < tx_threads; t++) {
+        int lo = first + t * share;
+        int hi = lo + share < end ? lo + share : end;
+        tx_workers[t].first = lo;
+        tx_workers[t].count = hi > lo ? hi - lo : 0;
+    }
+    tx_job_step = step;
+    tx_job_grads = grads;
+    tx_pending = tx_threads;
+    tx_round++;
+    pthread_cond_broadcast(&tx_start);
+    while (tx_pending > 0)
+        pthread_cond_wait(&tx_finish, &tx_lock);
+    pthread_mutex_unlock(&tx_lock);
+
+    for (int t = 0; t < tx_threads; t++)
+        if (tx_workers[t].ret < 0)
+            return -1;
+    return 0;
+}
+
+static int transmit(int step, const lane_t *grads, int first, int count) {
+    if (tx_threads > 1 && count >= TX_POOL_MIN)
+        return pool_transmit(step, grads, first, count);
+    return transmit_on(sockfd, tx_msgs, &tx_pacer, pacing_rate, step, grads, first, count);
+}
+
+void close_sender_pool() {
+    if (tx_threads == 0)
+        return;
+
+    pthread_mutex_lock(&tx_lock);
+    tx_stop = true;
+    pthread_cond_broadcast(&tx_start);
+    pthread_mutex_unlock(&tx_lock);
+
+    for (int t = 0; t < tx_threads; t++) {
+        pthread_join(tx_workers[t].thread, NULL);
+        close(tx_workers[t].fd);
+    }
+
+    pthread_mutex_lock(&tx_lock);
+    tx_threads = 0;
+    tx_pending = 0;
+    tx_stop = false;
+    pthread_mutex_unlock(&tx_lock);
+}
+
+/*
+ * Starts nthreads sender threads, each with its own socket (and so its
+ * own source port, which RSS on the receiver hashes to different RX
+ * queues), pinned round robin to cpus. Pinning also spreads the threads
+ * over TX queues through XPS. Call after init_sender; returns the number
+ * of threads running.
+ */
+int init_sender_pool(int nthreads, const int *cpus, int ncpus) {
+    close_sender_pool();
+
+    if (sockfd < 0) {
+        fprintf(stderr, "Socket not initialized\n");
+        return -1;
+    }
+    if (nthreads > TX_THREADS_MAX) nthreads = TX_THREADS_MAX;
+    if (nthreads <= 1)
+        return 1;
+
+    for (int t = 0; t < nthreads; t++) {
+        struct tx_worker *w = &tx_workers[t];
+
+        w->fd = open_socket(tx_ifname);
+        if (w->fd < 0)
+            break;
+
+        if (tx_mode == TX_MODE_GSO) {
+            int gso_size = TX_PAYLOAD_SIZE;
+            setsockopt(w->fd, SOL_UDP, UDP_SEGMENT, &gso_size, sizeof(gso_size));
+        }
+
+        w->cpu = ncpus > 0 ? cpus[t % ncpus] : -1;
+        w->pps = 0;
+        // tx_round outlives the pool, a thread starting at 0 would run the
+        // last job of the previous pool again
+        pthread_mutex_lock(&tx_lock);
+        w->round = tx_round;
+        pthread_mutex_unlock(&tx_lock);
+        if (pthread_create(&w->thread, NULL, tx_worker_loop, w) != 0) {
+            perror("pthread_create");
+            close(w->fd);
+            break;
+        }
+        tx_threads++;
+    }
+
+    if (tx_threads == 1)
+        close_sender_pool();
+    return tx_threads > 1 ? tx_threads : 1;
+}
+
+/*
+ * Writes the packet rate of every sender thread during its last shard
+ * into out and returns the number of threads (0 without a pool).
+ */
+int get_thread_pps(double *out, int max) {
+    int n = tx_threads < max ? tx_threads : max;
+    for (int t = 0; t < n; t++)
+        out[t] = tx_workers[t].pps;
+    return n;
+}
+
+/*
+ * Paces every send to rate_mbps, split evenly over the sender threads.
+ * PACING_BUCKET runs a token bucket in the senders and hands tx_burst
+ * packets to each syscall. There is no fq mode here: packets to DUMMY_IP
+ * are redirected by the TC egress hook before any root qdisc sees them.
+ * A send starts slot / slots of a burst late, so the bursts of the
+ * `slots` children of one parent interleave. Call after init_sender_pool;
+ * returns the mode in use.
+ */
+int init_pacing(int mode, double rate_mbps, int burst, int slot, int slots) {
+    if (sockfd < 0) {
+        fprintf(stderr, "Socket not initialized\n");
+        return -1;
+    }
+
+    if (mode == PACING_OFF || rate_mbps <= 0) {
+        pacing_mode = PACING_OFF;
+        pacing_rate = 0;
+        pacing_offset = 0;
+        return PACING_OFF;
+    }
+
+    if (burst < 1) burst = 1;
+    if (burst > TX_BATCH_MAX) burst = TX_BATCH_MAX;
+    if (slots < 1) slots = 1;
+
+    pacing_rate = rate_mbps * 1e6 / 8;
+    tx_burst = burst;
+    double burst_sec = burst * (TX_PAYLOAD_SIZE + WIRE_OVERHEAD) / pacing_rate;
+    pacing_offset = (slot % slots) * burst_sec / slots;
+
+    pacing_mode = PACING_BUCKET;
+    return pacing_mode;
+}
+
+/*
+ * Sends the fragments of the current iteration that are not done yet,
+ * in contiguous runs, from the buffer of the last send_fragments call.
+ * Duplicates are dropped by hcheck; if the fragment already went up the
+ * tree, the aggregator forwards it again or serves the finished result.
+ */
+static int resend_missing(int step) {
+    if (sockfd < 0 || !tx_grads || tx_step != step)
+        return 0;
+
+    int resent = 0;
+    int frag_id = frag_first;
+    while (frag_id < frag_end) {
+        if (updated[frag_id]) {
+            frag_id++;
+            continue;
+        }
+
+        int first = frag_id;
+        while (frag_id < frag_end && !updated[frag_id])
+            frag_id++;
+
+        if (transmit(step, tx_grads, first, frag_id - first) < 0)
+            break;
+        resent += frag_id - first;
+    }
+
+    retx_stats[RETX_STAT_RESENT] += resent;
+    return resent;
+}
+
+/*
+ * Sends fragments [first, first + count) of grads, where grads always
+ * points at the start of the whole FRAGMENT_SIZE * GRADIENT_SIZE buffer
+ * of LANE_BITS wide lanes.
+ */
+int send_fragments(int step, const lane_t *grads, int first, int count) {
+    if (sockfd < 0) {
+        fprintf(stderr, "Socket not initialized\n");
+        return -1;
+    }
+
+    if (first < 0 || count <= 0 || first + count > FRAGMENT_SIZE)
+        return -1;
+
+    // kept for retransmits until the iteration is done
+    tx_grads = grads;
+    tx_step = step;
+
+    double start = now_sec();
+    int ret = transmit(step, grads, first, count);
+    double elapsed = now_sec() - start;
+    if (ret == 0 && elapsed > 0)
+        tx_pps = count / elapsed;
+
+    return ret;
+}
+
+int send_all_fragments(int step, const lane_t *grads) {
+    return send_fragments(step, grads, frag_first, frag_count);
+}
+
+/*
+ * Fills out[RETX_STAT_NUM]: retransmit timeouts and fragments resent by
+ * this worker, followed by the STAT_* counters of the local aggregator
+ * summed over all CPUs (left at 0 when stats_map is not pinned).
+ */
+int get_retransmit_stats(uint64_t *out) {
+    static int stats_fd = -1;
+
+    out[RETX_STAT_TIMEOUTS] = retx_stats[RETX_STAT_TIMEOUTS];
+    out[RETX_STAT_RESENT] = retx_stats[RETX_STAT_RESENT];
+    for (int key = 0; key < STAT_NUM; key++)
+        out[2 + key] = 0;
+
+    if (stats_fd < 0)
+        stats_fd = bpf_obj_get(stats_path);
+    if (stats_fd < 0)
+        return RETX_STAT_NUM;
+
+    int ncpus = libbpf_num_possible_cpus();
+    if (ncpus <= 0)
+        return RETX_STAT_NUM;
+
+    uint64_t *values = calloc(ncpus, sizeof(uint64_t));
+    if (!values)
+        return RETX_STAT_NUM;
+
+    for (__u32 key = 0; key < STAT_NUM; key++) {
+        if (bpf_map_lookup_elem(stats_fd, &key, values) < 0)
+            continue;
+        for (int cpu = 0; cpu < ncpus; cpu++)
+            out[2 + key] += values[cpu];
+    }
+
+    free(values);
+    return RETX_STAT_NUM;
+}
+
+void close_map_reader() {
+    if (aggmap_mmap) {
+        munmap(aggmap_mmap, aggmap_mmap_size);
+        aggmap_mmap = NULL;
+    }
+    map_read_mode = MAP_READ_LOOKUP;
+}
+
 void close_socket() {
+    close_sender_pool();
     if (sockfd >= 0) {
         close(sockfd);
         sockfd = -1;
@@ -18,7 +18,7 @@ int broadcast(struct __sk_buff *skb) {
     unsigned char maclist[CHILDREN_NUM * 6] = { CHILDREN_MAC };
     unsigned char smac[6] = { HOST_MAC };
     __u32 children[CHILDREN_NUM] = { CHILDREN_IP };
-    __u32 if_index = 2;
+    __u32 if_index = IF_INDEX;
 
     if (udp + 1 > (struct udphdr *)data_end)
          return TC_ACT_OK;
@@ -73,7 +73,7 @@ int local(struct __sk_buff *skb) {
     struct ethhdr *eth = data;
     struct iphdr *ip = (struct iphdr *)(eth + 1);
     struct udphdr *udp = (struct udphdr *)(ip + 1);
-    __u32 if_index = 2;
+    __u32 if_index = IF_INDEX;
 
     if (udp + 1 > (struct udphdr *)data_end)
          return TC_ACT_OK;
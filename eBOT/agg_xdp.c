@@ -12,9 +12,37 @@ struct {
     __type(key, __u32);
     __type(value, struct agg_map);
     __uint(max_entries, FRAGMENT_SIZE);
+    __uint(map_flags, BPF_F_MMAPABLE);
     __uint(pinning, LIBBPF_PIN_BY_NAME);
 } aggregator_map SEC(".maps");
 
+struct {
+    __uint(type, BPF_MAP_TYPE_RINGBUF);
+    __uint(max_entries, 1 << 22);
+    __uint(pinning, LIBBPF_PIN_BY_NAME);
+} completion_map SEC(".maps");
+
+struct {
+    __uint(type, BPF_MAP_TYPE_PERCPU_ARRAY);
+    __type(key, __u32);
+    __type(value, __u64);
+    __uint(max_entries, STAT_NUM);
+    __uint(pinning, LIBBPF_PIN_BY_NAME);
+} stats_map SEC(".maps");
+
+static __always_inline void notify_done(__u32 frag_id, __u32 iter)
+{
+    struct agg_done rec = { .fid = frag_id, .iter = iter };
+    bpf_ringbuf_output(&completion_map, &rec, sizeof(rec), 0);
+}
+
+static __always_inline void count_stat(__u32 key)
+{
+    __u64 *val = bpf_map_lookup_elem(&stats_map, &key);
+    if (val)
+        (*val)++;
+}
+
 //struct {
 //    __uint(type, BPF_MAP_TYPE_XSKMAP);
 //    __uint(max_entries, 64);   // max #queues
@@ -59,25 +87,35 @@ int aggregator(struct xdp_md *ctx) {
     if (bcast > 0 && ip->saddr == htonl(HOST_IP))
         return XDP_PASS;
 
-    // send back for pkt lost
-//    if (map->iter == iter + 1) {
-//        payload->hid = htonl(HOST_ID);
-//        for (__u32 i = 0; i < GRADIENT_SIZE; i++)
-//            payload->grads[i] = htonl(map->grads[i]);
-//
-//        ip->daddr = ip->saddr;
-//        ip->saddr = htonl(HOST_IP);
-//        ip->ttl--;
-//        compute_ipv4_csum(ip);
-//        compute_udp_csum(udp, ip->saddr, ip->daddr);
-//        __memcpy(eth->h_dest, eth->h_source, 6);
-//        __memcpy(eth->h_source, hmac, 6);
-//        return XDP_TX;
-//    }
+    // send back for pkt lost: a child retransmitted a fragment that is
+    // already finished here, serve the result again. Results coming down
+    // from our parent and our own worker's retransmits are not answered.
+    if (map->iter == iter + 1 && host_id != HOST_ID &&
+            (PARENT_NUM == 0 || host_id != PARENT_ID) &&
+            ip->saddr != htonl(HOST_IP)) {
+        payload->hid = htonl(HOST_ID);
+        payload->bcast = 0;
+        payload->exp = map->exp;
+        for (__u32 i = 0; i < GRADIENT_SIZE; i++)
+            payload->grads[i] = map->grads[i];
+
+        ip->daddr = ip->saddr;
+        ip->saddr = htonl(HOST_IP);
+        ip->ttl--;
+        compute_ipv4_csum(ip);
+        compute_udp_csum(udp, ip->saddr, ip->daddr);
+        __memcpy(eth->h_dest, eth->h_source, 6);
+        __memcpy(eth->h_source, hmac, 6);
+        count_stat(STAT_SERVED);
+        return XDP_TX;
+    }
     
     if (map->iter != iter)
         return XDP_DROP;
 
+    // a retransmit after the local sum went up the tree
+    __u8 reforward = map->childcnt > CHILDREN_NUM && host_id != PARENT_ID;
+
     // aggregation
     if (map->childcnt <= CHILDREN_NUM) {
         map->lock = 1;
@@ -87,14 +125,20 @@ int aggregator(struct xdp_md *ctx) {
             if (worker_id == host_id) {
                 if (map->hcheck[worker_id]) {
 		            map->lock = 0;
+		            count_stat(STAT_DUPLICATE);
 		            return XDP_DROP;
 		        }
                 map->hcheck[worker_id] = 1;
                 break;
             }
         }
+
+        if (map->childcnt == 0)
+            map->exp = payload->exp;
+        else if (map->exp != payload->exp)
+            count_stat(STAT_EXP_MISMATCH);
         
-        // upadate local grads
+        // upadate local grads, narrow lanes are sign extended
         for (int i = 0; i < GRADIENT_SIZE; i++)
             map->lgrads[i] += payload->grads[i];
     	
@@ -125,6 +169,7 @@ int aggregator(struct xdp_md *ctx) {
             payload->bcast = 0;
             map->lflag = 1;
 	        map->lock = 0;
+            notify_done(frag_id, map->iter);
             
             return XDP_PASS; // forward to TC hook for multicast
         }
@@ -138,6 +183,7 @@ int aggregator(struct xdp_md *ctx) {
             for (int i = 0; i < WORKER_NUM; i++)
                 map->hcheck[i] = 0;
             
+            map->exp = payload->exp;
             for (int i = 0; i < GRADIENT_SIZE; i++) {
                 map->grads[i] = payload->grads[i];
                 map->lgrads[i] = 0;
@@ -146,12 +192,16 @@ int aggregator(struct xdp_md *ctx) {
             payload->bcast = 0;
             map->lflag = 1;
 	        map->lock = 0;
+            notify_done(frag_id, map->iter);
             
             return XDP_PASS;
         }
 
         // children to parent
         if (PARENT_NUM > 0) {
+            if (reforward)
+                count_stat(STAT_REFORWARD);
+
             for (int i = 0; i < GRADIENT_SIZE; i++)
                 payload->grads[i] = map->lgrads[i];
 
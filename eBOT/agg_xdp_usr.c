@@ -68,12 +68,16 @@ int main(int argc, char **argv) {
 		//.attach_mode = XDP_MODE_UNSPEC,
 		.attach_mode = XDP_MODE_SKB,
 		.xdp_flags = 0,
-        .ifname    = "ens3",
+        .ifname    = argc > 1 ? argv[1] : "ens3",
         .filename  = "eBOT/agg_xdp.o",
         .progname  = "aggregator"
 	};
 
 	cfg.ifindex = if_nametoindex(cfg.ifname);
+	if (!cfg.ifindex) {
+		fprintf(stderr, "Unknown interface '%s'\n", cfg.ifname);
+		return EXIT_FAIL_OPTION;
+	}
 
 	DECLARE_LIBBPF_OPTS(bpf_object_open_opts, bpf_opts);
 	DECLARE_LIBXDP_OPTS(xdp_program_opts, xdp_opts,
@@ -1,7 +1,9 @@
+import os
 import json
-import random
 from typing import Optional
-from utils import load_config
+from models import MODEL_CLASSES
+from topology import allreduce_bytes, plan_topology
+from utils import fragment_count, load_config
 
 
 def load_nodes(config_path: str) -> tuple:
@@ -11,31 +13,32 @@ def load_nodes(config_path: str) -> tuple:
     return config, nodes
 
 
-def run_bate_algorithm(nodes: list) -> dict:
-    N = len(nodes)
-    B = [random.randint(10, 10) for _ in range(N)]
-    B.sort(reverse=True)
-    
-    Bnorm = [0] * N
-    graph = {i: [] for i in range(N)}
+def size_fragments(train_config: dict):
+    """Derives fragment_size from the parameter count of the chosen model.
 
-    def degree(node: int) -> int:
-        return sum(1 for u, vs in graph.items() if u == node for _ in vs) + \
-               sum(1 for vs in graph.values() for v in vs if v == node)
+    "auto" (or no value) sizes the aggregator map to the fragments
+    the model needs plus one for the evaluation counts. An explicit value
+    is kept as long as both fit.
+    With "gradient_size": "auto" the lanes per packet depend on the MTUs of
+    the nodes, so both sizes are left for the coordinator to resolve from
+    the smallest MTU the agents report.
+    """
+    model_type = train_config["model_type"]
+    param_count = MODEL_CLASSES[model_type]().num_gradients
+    train_config["param_count"] = param_count
 
-    Bnorm[0] = B[0]
-    for v in range(1, N):
-        u = Bnorm.index(max(Bnorm))
-        graph[u].append(v)
-        Bnorm[u] = B[u] / (degree(u) + 1)
-        Bnorm[v] = B[v] / (degree(v) + 1)
+    fragment_size = train_config.get("fragment_size", "auto")
+    if train_config["gradient_size"] != "auto":
+        fragment_size = fragment_count(param_count, train_config["gradient_size"], fragment_size)
+    train_config["fragment_size"] = fragment_size
+    return fragment_size
 
-    return graph
 
 def build_clients(nodes: list, graph: dict) -> dict:
+    nodes_by_id = {node["id"]: node for node in nodes}
 
     def get_node(node_id: int) -> Optional[dict]:
-        return next((node for node in nodes if node["id"] == node_id), None)
+        return nodes_by_id.get(node_id)
 
     clients = {}
     for u, children in graph.items():
@@ -51,7 +54,8 @@ def build_clients(nodes: list, graph: dict) -> dict:
             "children": []
         })
 
-        for v in children:
+        # children send in turns ordered by host_id, see init_pacing()
+        for slot, v in enumerate(sorted(children)):
             node_v = get_node(v)
             if not node_v:
                 continue
@@ -68,6 +72,8 @@ def build_clients(nodes: list, graph: dict) -> dict:
                 }
             else:
                 clients[addr_v]["parent"] = node_u
+            clients[addr_v]["sibling_index"] = slot
+            clients[addr_v]["siblings"] = len(children)
 
     return clients
 
@@ -91,8 +97,32 @@ def save_configs(config: dict, clients: dict):
 
 def main():
     config, nodes = load_nodes("main_config.json")
-    graph = run_bate_algorithm(nodes)
-    print("Generated graph:", graph)
+    fragment_size = size_fragments(config["train_config"])
+    if fragment_size == "auto":
+        fragment_size = "MTU-sized"
+    print(
+        f"{config['train_config']['model_type']}: "
+        f"{config['train_config']['param_count']:,} parameters, "
+        f"{fragment_size} fragments"
+    )
+
+    topology_config = config.get("topology_config", {})
+    matrix_path = topology_config.get("link_matrix", "link_matrix.json")
+    measured = None
+    if os.path.exists(matrix_path):
+        measured = load_config(matrix_path)
+        print(f"Using {len(measured['links'])} links measured at {measured['measured_at']}")
+
+    graph, estimate = plan_topology(
+        nodes, topology_config, allreduce_bytes(config["train_config"]), measured
+    )
+    config["topology"] = estimate
+    print("Generated graph:", graph if len(graph) <= 32 else f"{len(graph)} nodes")
+    print(
+        f"{estimate['strategy']}: "
+        f"expected {estimate['aggregation_time']*1e3:.2f}ms per iteration, "
+        f"depth {estimate['depth']}, bottleneck node {estimate['bottleneck_node']}"
+    )
 
     clients = build_clients(nodes, graph)
     save_configs(config, clients)
@@ -0,0 +1,137 @@
+"""
+Pairwise UDP link probes for the topology planner.
+
+Every agent runs a `ProbeSink` during a measurement. It echoes pings and
+counts the bytes of data packets per sender. `probe_peer` first measures
+the RTT against a peer's sink, then sends data packets at full speed for
+`duration` seconds, and finally asks the sink how much arrived. The
+bandwidth is what the receiver saw, so drops on the way count against it.
+
+All packets start with PROBE_HEADER: type, probe id, sequence number and
+two 64-bit values (a send timestamp, or bytes and nanoseconds in STATS).
+"""
+import time
+import random
+import socket
+import struct
+import threading
+import statistics
+
+PROBE_PING = 0
+PROBE_DATA = 1
+PROBE_FIN = 2
+PROBE_STATS = 3
+
+PROBE_HEADER = struct.Struct("!BIIQQ")
+PROBE_PAYLOAD = 1400
+PING_COUNT = 10
+PROBE_TIMEOUT = 0.2
+READY_TIMEOUT = 5.0
+RCVBUF_SIZE = 16 * 1024 * 1024
+
+
+class ProbeSink:
+    """Echoes pings and counts data packets on a UDP port."""
+
+    def __init__(self, port: int, ip: str = "0.0.0.0"):
+        self.port = port
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+        self._sock.bind((ip, port))
+        self._sock.settimeout(0.1)
+        # (addr, probe_id) -> [bytes, packets, first_ns, last_ns]
+        self._counts = {}
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self._sock.close()
+
+    def _serve(self):
+        buf = bytearray(65536)
+        while self._running:
+            try:
+                n, addr = self._sock.recvfrom_into(buf)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if n < PROBE_HEADER.size:
+                continue
+
+            kind, probe_id, seq, _, _ = PROBE_HEADER.unpack_from(buf)
+            if kind == PROBE_PING:
+                self._sock.sendto(buf[:n], addr)
+            elif kind == PROBE_DATA:
+                now = time.monotonic_ns()
+                count = self._counts.setdefault((addr[0], probe_id), [0, 0, now, now])
+                count[0] += n
+                count[1] += 1
+                count[3] = now
+            elif kind == PROBE_FIN:
+                nbytes, packets, first, last = self._counts.get((addr[0], probe_id), [0, 0, 0, 0])
+                reply = PROBE_HEADER.pack(PROBE_STATS, probe_id, packets, nbytes, last - first)
+                self._sock.sendto(reply, addr)
+
+
+def _request(sock: socket.socket, addr: tuple, packet: bytes, kind: int, probe_id: int,
+             seq, timeout: float) -> tuple:
+    """Sends packet until the matching reply arrives or timeout passes.
+
+    A seq of None matches any sequence number.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        sock.sendto(packet, addr)
+        try:
+            while True:
+                data = sock.recv(PROBE_HEADER.size)
+                reply = PROBE_HEADER.unpack_from(data)
+                if reply[0] == kind and reply[1] == probe_id and seq in (None, reply[2]):
+                    return reply
+        except socket.timeout:
+            continue
+    raise TimeoutError(f"no reply from {addr[0]}:{addr[1]}")
+
+
+def probe_peer(ip: str, port: int, duration: float = 2.0,
+               payload_size: int = PROBE_PAYLOAD) -> dict:
+    """Measures RTT and throughput from this node to the sink at ip:port."""
+    addr = (ip, port)
+    probe_id = random.getrandbits(32)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(PROBE_TIMEOUT)
+    try:
+        # the first ping also waits for the peer's sink to come up
+        rtts = []
+        for seq in range(PING_COUNT):
+            start = time.monotonic_ns()
+            ping = PROBE_HEADER.pack(PROBE_PING, probe_id, seq, start, 0)
+            _request(sock, addr, ping, PROBE_PING, probe_id, seq,
+                     READY_TIMEOUT if seq == 0 else PROBE_TIMEOUT * 5)
+            rtts.append(time.monotonic_ns() - start)
+
+        packet = bytearray(payload_size)
+        sent = 0
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            for _ in range(64):
+                PROBE_HEADER.pack_into(packet, 0, PROBE_DATA, probe_id, sent, 0, 0)
+                sock.sendto(packet, addr)
+                sent += 1
+
+        fin = PROBE_HEADER.pack(PROBE_FIN, probe_id, 0, 0, 0)
+        _, _, received, nbytes, elapsed_ns = _request(
+            sock, addr, fin, PROBE_STATS, probe_id, None, READY_TIMEOUT
+        )
+    finally:
+        sock.close()
+
+    return {
+        "bandwidth_mbps": nbytes * 8 / elapsed_ns * 1e3 if elapsed_ns > 0 else 0.0,
+        "rtt_us": statistics.median(rtts) / 1e3,
+        "loss": 1 - received / sent if sent else 0.0,
+    }
@@ -1,8 +1,42 @@
+import bisect
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 class BaseModel(nn.Module):
+    @property
+    def grad_arena(self) -> torch.Tensor:
+        return getattr(self, "_grad_arena", None)
+
+    def enable_grad_arena(self) -> torch.Tensor:
+        """Makes every p.grad a view into one preallocated flat buffer.
+
+        Autograd accumulates in place into existing grads, so as long as grads
+        are zeroed instead of set to None the views survive every step and
+        get_gradients/set_gradients become zero-copy.
+        """
+        params = [p for p in self.parameters() if p.requires_grad]
+        numel = sum(p.numel() for p in params)
+        arena = torch.zeros(numel, dtype=params[0].dtype, device=params[0].device)
+
+        offset = 0
+        for p in params:
+            p.grad = arena[offset:offset+p.numel()].view_as(p)
+            offset += p.numel()
+
+        self._grad_arena = arena
+        return arena
+
+    @property
+    def num_gradients(self) -> int:
+        return sum(p.numel() for p in self.parameters() if p.requires_grad)
+
+    def zero_grad(self, set_to_none: bool = True):
+        if self.grad_arena is not None:
+            self.grad_arena.zero_()
+            return
+        super().zero_grad(set_to_none=set_to_none)
+
     def get_weights(self):
         return {k: v.cpu() for k, v in self.state_dict().items()}
 
@@ -10,6 +44,9 @@ class BaseModel(nn.Module):
         self.load_state_dict(weights)
 
     def get_gradients(self, flatten: bool = True) -> torch.Tensor:
+        if flatten and self.grad_arena is not None:
+            return self.grad_arena.cpu()
+
         grads = [p.grad.detach().cpu() for p in self.parameters() if p.grad is not None]
         if not grads:
             return torch.tensor([])
@@ -20,7 +57,11 @@ class BaseModel(nn.Module):
         return grads
     
     def set_gradients(self, flat_grads: torch.Tensor, flatten: bool = True):
-        if flatten:
+        arena = self.grad_arena
+        if flatten and arena is not None:
+            if flat_grads.data_ptr() != arena.data_ptr():
+                arena.copy_(flat_grads[:arena.numel()])
+        elif flatten:
             offset = 0
             for p in self.parameters():
                 if p.grad is not None:
@@ -32,6 +73,28 @@ class BaseModel(nn.Module):
                     if p.grad is not None and g is not None:
                         p.grad.copy_(g)
 
+    def set_gradients_range(self, flat_grads: torch.Tensor, start: int, end: int):
+        """Copies flat_grads[start:end] into the grads that cover that range."""
+        arena = self.grad_arena
+        if arena is not None:
+            if flat_grads.data_ptr() != arena.data_ptr():
+                arena[start:end].copy_(flat_grads[start:end])
+            return
+
+        if getattr(self, "_grad_offsets", None) is None:
+            params = [p for p in self.parameters() if p.grad is not None]
+            offsets = [0]
+            for p in params[:-1]:
+                offsets.append(offsets[-1] + p.numel())
+            self._grad_params, self._grad_offsets = params, offsets
+
+        idx = max(bisect.bisect_right(self._grad_offsets, start) - 1, 0)
+        for p, offset in zip(self._grad_params[idx:], self._grad_offsets[idx:]):
+            if offset >= end:
+                break
+            lo, hi = max(start, offset), min(end, offset + p.numel())
+            p.grad.view(-1)[lo-offset:hi-offset].copy_(flat_grads[lo:hi])
+
 
 class ConvNet(BaseModel):
     """Small ConvNet for MNIST."""
@@ -245,3 +308,9 @@ class ResNet52(BaseModel):
 
         return x
 
+
+MODEL_CLASSES = {
+    "convnet": ConvNet,
+    "resnet18": ResNet18,
+    "resnet52": ResNet52
+}
@@ -0,0 +1,138 @@
+"""
+Per-phase timing of the training step.
+
+The workers wrap their phases in `profiler.phase(name)` and report
+per-pass values such as the fragments returned by one poll with
+`profiler.count(name, value)`. Both do nothing until worker.py enables
+the profiler (`"profile": true` in local_config.json), so the hot path
+only pays for a method call.
+
+At the end of a run, `summary()` tabulates every phase and counter and
+`export_chrome_trace()` writes the events in the Chrome trace format,
+which chrome://tracing and https://ui.perfetto.dev open.
+"""
+import json
+import time
+import numpy as np
+
+
+class _Phase:
+    __slots__ = ("_events", "_name", "_start")
+
+    def __init__(self, events: list, name: str):
+        self._events = events
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self._events.append((self._name, self._start, time.perf_counter_ns() - self._start))
+        return False
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class Profiler:
+
+    def __init__(self):
+        self.enabled = False
+        # (name, start_ns, duration_ns)
+        self.events = []
+        # (name, time_ns, value)
+        self.counters = []
+
+    def enable(self):
+        self.enabled = True
+
+    def phase(self, name: str):
+        """Context manager that times one occurrence of `name`."""
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self.events, name)
+
+    def record(self, name: str, start: float, end: float):
+        """Adds a phase timed with time.perf_counter() by the caller."""
+        if self.enabled:
+            self.events.append((name, int(start * 1e9), int((end - start) * 1e9)))
+
+    def count(self, name: str, value: int):
+        if self.enabled:
+            self.counters.append((name, time.perf_counter_ns(), value))
+
+    def iterate(self, name: str, iterable):
+        """Yields from iterable, timing every next() as `name`."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter_ns()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            if self.enabled:
+                self.events.append((name, start, time.perf_counter_ns() - start))
+            yield item
+
+    def summary(self, total_phases: tuple = ("data", "step")) -> str:
+        """Table of every phase in ms, with its share of the time spent in
+        `total_phases`."""
+        durations = {}
+        for name, _, duration in self.events:
+            durations.setdefault(name, []).append(duration)
+        total = sum(sum(durations.get(name, [])) for name in total_phases) or 1
+
+        lines = [
+            f"{'phase':<20} {'calls':>7} {'total ms':>10} {'mean ms':>9} "
+            f"{'p50 ms':>9} {'p99 ms':>9} {'share':>7}"
+        ]
+        for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+            values = np.array(values) / 1e6
+            lines.append(
+                f"{name:<20} {len(values):>7} {values.sum():>10.1f} {values.mean():>9.3f} "
+                f"{np.percentile(values, 50):>9.3f} {np.percentile(values, 99):>9.3f} "
+                f"{values.sum() * 1e6 / total:>7.1%}"
+            )
+
+        counters = {}
+        for name, _, value in self.counters:
+            counters.setdefault(name, []).append(value)
+        for name, values in sorted(counters.items()):
+            values = np.array(values)
+            lines.append(
+                f"{name}: {len(values)} passes, mean {values.mean():.1f}, "
+                f"p50 {np.percentile(values, 50):.0f}, max {values.max()}"
+            )
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path: str, pid: int = 0):
+        origin = min(
+            [start for _, start, _ in self.events] + [t for _, t, _ in self.counters],
+            default=0,
+        )
+        trace = [
+            {"name": name, "ph": "X", "pid": pid, "tid": 0,
+             "ts": (start - origin) / 1e3, "dur": duration / 1e3}
+            for name, start, duration in self.events
+        ]
+        trace += [
+            {"name": name, "ph": "C", "pid": pid, "ts": (t - origin) / 1e3,
+             "args": {name: value}}
+            for name, t, value in self.counters
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+profiler = Profiler()
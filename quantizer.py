@@ -0,0 +1,247 @@
+"""
+Fixed-point gradient quantization for the eBPF all-reduce.
+
+The kernel aggregator sums integer lanes, so gradients are scaled and
+rounded before they are sent. Both quantizers do scale -> clamp -> round
+chunk by chunk through a small float scratch that stays in cache, writing
+into a persistent page-aligned staging buffer that send_all_fragments reads
+directly. The padding past the model's gradients is zeroed once and never
+rebuilt.
+
+`FixedPointQuantizer` fills 32-bit lanes at the global SCALE_FACTOR.
+`BlockQuantizer` fills 16 or 8-bit lanes scaled by 2**exp, with one exponent
+per fragment. Every worker derives the exponents of the next step from the
+same aggregated sums, so they agree without an extra round trip.
+
+Values are clamped to lane_max / worker_num, so the sum over all workers
+still fits into a lane. With error feedback the part lost to rounding and
+clamping is kept in a residual and added to the next step's gradients.
+"""
+import mmap
+import torch
+
+# per-fragment exponents stay within these bounds
+EXP_MIN = -32
+EXP_MAX = 64
+
+LANE_DTYPES = {32: torch.int32, 16: torch.int16, 8: torch.int8}
+
+
+def lane_limit(lane_bits: int, worker_num: int = 1) -> float:
+    """Largest float32 a worker may round into a lane so that the sum over
+    worker_num workers still fits into lane_bits."""
+    limit = (2 ** (lane_bits - 1) - 1) // max(1, worker_num)
+    value = torch.tensor(float(limit), dtype=torch.float32)
+    if value.item() > limit:
+        value = torch.nextafter(value, torch.zeros(()))
+    return value.item()
+
+
+def _staging_buffer(total_size: int, dtype: torch.dtype) -> tuple:
+    # anonymous mappings are page aligned and zero filled
+    buf = mmap.mmap(-1, total_size * torch.tensor([], dtype=dtype).element_size())
+    return buf, torch.frombuffer(buf, dtype=dtype)
+
+
+class FixedPointQuantizer:
+
+    def __init__(self, total_size: int, scale_factor: float, chunk_size: int = 1 << 16,
+                 worker_num: int = 1, error_feedback: bool = False):
+        self.total_size = total_size
+        self.scale_factor = scale_factor
+        self.chunk_size = chunk_size
+        self.limit = lane_limit(32, worker_num)
+
+        self._mmap, self.staging = _staging_buffer(total_size, torch.int32)
+        self._scratch = torch.empty(chunk_size, dtype=torch.float32)
+        self._residual = torch.zeros(total_size) if error_feedback else None
+        self._numel = 0
+
+    def quantize(self, grads: torch.Tensor) -> torch.Tensor:
+        """Writes round(clamp(grads * scale)) into the staging buffer."""
+        grads = grads.view(-1)
+        numel = grads.numel()
+        if numel > self.total_size:
+            raise ValueError(
+                f"{numel} gradients do not fit into {self.total_size} lanes"
+            )
+
+        self.quantize_range(grads, 0, numel)
+
+        # only lanes used by a previous, larger tensor need clearing
+        if numel < self._numel:
+            self.staging[numel:self._numel].zero_()
+        self._numel = numel
+
+        return self.staging
+
+    def quantize_range(self, grads: torch.Tensor, start: int, end: int) -> torch.Tensor:
+        """Quantizes grads[start:end] into the same lanes of the staging buffer."""
+        grads = grads.view(-1)
+        residual = self._residual
+        for lo in range(start, end, self.chunk_size):
+            hi = min(lo + self.chunk_size, end)
+            tmp = self._scratch[:hi-lo]
+            if residual is not None:
+                torch.add(grads[lo:hi], residual[lo:hi], out=tmp)
+                residual[lo:hi].copy_(tmp)
+                tmp.mul_(self.scale_factor)
+            else:
+                torch.mul(grads[lo:hi], self.scale_factor, out=tmp)
+            tmp.clamp_(-self.limit, self.limit).round_()
+            self.staging[lo:hi].copy_(tmp)
+            if residual is not None:
+                residual[lo:hi].sub_(tmp.div_(self.scale_factor))
+        self._numel = max(self._numel, end)
+
+        return self.staging
+
+    def dequantize(self, src: torch.Tensor, out: torch.Tensor, divisor: float = 1.0,
+                   start: int = 0, end: int = None) -> torch.Tensor:
+        """Writes src[start:end] / (scale * divisor) into `out` without temporaries.
+
+        `src` is either flat or holds one (possibly strided) row per fragment,
+        e.g. a view into the mmaped aggregator_map. In the latter case `start`
+        has to be a fragment boundary.
+        """
+        flat = out.view(-1)
+        end = flat.numel() if end is None else end
+        inv_scale = 1.0 / (self.scale_factor * divisor)
+        if src.dim() == 1:
+            for lo in range(start, end, self.chunk_size):
+                hi = min(lo + self.chunk_size, end)
+                flat[lo:hi].copy_(src[lo:hi]).mul_(inv_scale)
+            return out
+
+        width = src.shape[1]
+        step = max(1, self.chunk_size // width) * width
+        for lo in range(start, end, step):
+            hi = min(lo + step, end)
+            row, rows = lo // width, (hi - lo) // width
+            mid = lo + rows * width
+            if rows:
+                flat[lo:mid].view(rows, width).copy_(src[row:row+rows]).mul_(inv_scale)
+            if mid < hi:
+                flat[mid:hi].copy_(src[row+rows, :hi-mid]).mul_(inv_scale)
+        return out
+
+
+class BlockQuantizer:
+    """Narrow lanes with a power-of-two scale per fragment."""
+
+    def __init__(self, gradient_size: int, fragment_size: int, lane_bits: int,
+                 worker_num: int, exp_init: int, chunk_size: int = 1 << 16,
+                 error_feedback: bool = False):
+        self.gradient_size = gradient_size
+        self.fragment_size = fragment_size
+        self.total_size = gradient_size * fragment_size
+        self.lane_bits = lane_bits
+        self.worker_num = worker_num
+        self.limit = lane_limit(lane_bits, worker_num)
+        # the exponents aim for aggregated sums up to half the lane range
+        self._target_bits = ((2 ** (lane_bits - 1) - 1) // 2).bit_length()
+
+        # whole fragments per chunk, so every chunk starts on a row
+        self.chunk_size = max(1, chunk_size // gradient_size) * gradient_size
+
+        self._mmap, self.staging = _staging_buffer(self.total_size, LANE_DTYPES[lane_bits])
+        self.exponents = torch.full((fragment_size,), exp_init, dtype=torch.int32)
+        self._scales = torch.ldexp(torch.ones(fragment_size), self.exponents)
+        self._scratch = torch.empty(self.chunk_size, dtype=torch.float32)
+        self._residual = torch.zeros(self.total_size) if error_feedback else None
+        self._numel = 0
+
+    def _mul_rows(self, buf: torch.Tensor, row: int, factors: torch.Tensor):
+        """Multiplies lanes starting at fragment `row` by one factor per fragment."""
+        width = self.gradient_size
+        rows = buf.numel() // width
+        if rows:
+            buf[:rows*width].view(rows, width).mul_(factors[row:row+rows, None])
+        if rows * width < buf.numel():
+            buf[rows*width:].mul_(factors[row+rows])
+
+    def quantize(self, grads: torch.Tensor) -> torch.Tensor:
+        """Writes round(clamp(grads * 2**exp)) into the staging buffer."""
+        grads = grads.view(-1)
+        numel = grads.numel()
+        if numel > self.total_size:
+            raise ValueError(
+                f"{numel} gradients do not fit into {self.total_size} lanes"
+            )
+
+        self.quantize_range(grads, 0, numel)
+
+        if numel < self._numel:
+            self.staging[numel:self._numel].zero_()
+        self._numel = numel
+
+        return self.staging
+
+    def quantize_range(self, grads: torch.Tensor, start: int, end: int) -> torch.Tensor:
+        """Quantizes grads[start:end], `start` being a fragment boundary."""
+        grads = grads.view(-1)
+        residual = self._residual
+        for lo in range(start, end, self.chunk_size):
+            hi = min(lo + self.chunk_size, end)
+            row = lo // self.gradient_size
+            tmp = self._scratch[:hi-lo]
+            if residual is not None:
+                torch.add(grads[lo:hi], residual[lo:hi], out=tmp)
+                residual[lo:hi].copy_(tmp)
+            else:
+                tmp.copy_(grads[lo:hi])
+            self._mul_rows(tmp, row, self._scales)
+            tmp.clamp_(-self.limit, self.limit).round_()
+            self.staging[lo:hi].copy_(tmp)
+            if residual is not None:
+                # scales are powers of two, dividing them out again is exact
+                self._mul_rows(tmp, row, self._scales.reciprocal())
+                residual[lo:hi].sub_(tmp)
+        self._numel = max(self._numel, end)
+
+        return self.staging
+
+    def dequantize(self, src: torch.Tensor, out: torch.Tensor, divisor: float = 1.0,
+                   start: int = 0, end: int = None) -> torch.Tensor:
+        """Writes src[start:end] / (2**exp * divisor) into `out`.
+
+        `src` holds the 32-bit sums of every fragment, flat or one (possibly
+        strided) row per fragment, and `start` is a fragment boundary. The
+        fragments covered also get their exponents for the next step.
+        """
+        width = self.gradient_size
+        if src.dim() == 1:
+            src = src.view(-1, width)
+
+        flat = out.view(-1)
+        end = flat.numel() if end is None else end
+        factors = self._scales.reciprocal().div_(divisor)
+        for lo in range(start, end, self.chunk_size):
+            hi = min(lo + self.chunk_size, end)
+            row, rows = lo // width, (hi - lo) // width
+            mid = lo + rows * width
+            if rows:
+                flat[lo:mid].view(rows, width).copy_(src[row:row+rows])\
+                    .mul_(factors[row:row+rows, None])
+            if mid < hi:
+                flat[mid:hi].copy_(src[row+rows, :hi-mid]).mul_(factors[row+rows])
+
+        self._update_exponents(src, start // width, -(-end // width))
+        return out
+
+    def _update_exponents(self, src: torch.Tensor, first: int, last: int):
+        """Shifts each exponent so the largest sum lands below half the lane range.
+
+        A sum at the clamp limit says nothing about how far the gradients
+        overshot, so saturated fragments drop by half the lane width and get
+        their exact exponent one step later. Only integer sums and exact bit
+        lengths are involved, so every worker ends up with the same exponents.
+        """
+        peak = src[first:last].abs().amax(dim=1).double()
+        _, bits = torch.frexp(peak)
+        shift = torch.where(peak > 0, self._target_bits - 1 - bits, torch.ones_like(bits))
+        saturated = peak >= self.limit * self.worker_num
+        shift = torch.where(saturated, torch.full_like(shift, -(self.lane_bits // 2)), shift)
+        exps = self.exponents[first:last]
+        exps.add_(shift.to(torch.int32)).clamp_(EXP_MIN, EXP_MAX)
+        self._scales[first:last] = torch.ldexp(torch.ones(last - first), exps)
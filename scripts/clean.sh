@@ -1,7 +1,7 @@
 #!/bin/bash
 
 fdir=`dirname $0`
-ifnet=ens3
+ifnet=${1:-ens3}
 
 #echo sudo pkill -9 agg_xdp_usr
 #sudo pkill -9 agg_xdp_usr
@@ -1,6 +1,17 @@
-# limit
-sudo tc qdisc add dev ens3 root tbf rate 100mbit burst 32kbit latency 400ms
+#!/bin/bash
+# usage: limit_bandwidth.sh [add|del] [ifname] [rate]
 
-# remove
-sudo tc qdisc del dev ens3 root
-sudo tc qdisc del dev ens3 ingress
+action=${1:-add}
+ifnet=${2:-ens3}
+rate=${3:-100mbit}
+
+if [[ $action == add ]]; then
+    # limit
+    echo sudo tc qdisc add dev $ifnet root tbf rate $rate burst 32kbit latency 400ms
+    sudo tc qdisc add dev $ifnet root tbf rate $rate burst 32kbit latency 400ms
+else
+    # remove
+    echo sudo tc qdisc del dev $ifnet root
+    sudo tc qdisc del dev $ifnet root
+    sudo tc qdisc del dev $ifnet ingress
+fi
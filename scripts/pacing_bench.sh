@@ -0,0 +1,16 @@
+#!/bin/bash
+# usage: pacing_bench.sh [ifname] [rate_mbps] [workers]
+#
+# Shapes ifname with limit_bandwidth.sh and reports drop rate and step time
+# with and without pacing. The loopback benchmark runs on lo; on the
+# cluster set "pacing" in main_config.json and compare the retransmits
+# every rank prints per epoch.
+
+filedir=`dirname $0`
+ifnet=${1:-lo}
+rate=${2:-1000}
+workers=${3:-4}
+
+$filedir/limit_bandwidth.sh add $ifnet ${rate}mbit
+(cd $filedir/.. && python3 -m benchmarks.pacing $workers $rate)
+$filedir/limit_bandwidth.sh del $ifnet
@@ -11,7 +11,7 @@ RED='\e[31m'
 GREEN='\e[32m'
 RESET='\e[0m'
 filedir=`dirname $0`
-ifnet=ens3
+ifnet=${1:-ens3}
 
 echo -e "\n${GREEN}./scripts/clean.sh${RESET} $ifnet"
 $filedir/clean.sh $ifnet
@@ -2,7 +2,7 @@
 
 filedir=`dirname $0`
 filename=eBOT/agg_tc
-ifnet=$1
+ifnet=${1:-ens3}
 
 # install tc program
 echo sudo tc qdisc add dev $ifnet clsact
@@ -2,10 +2,10 @@
 
 filedir=`dirname $0`
 filename=eBOT/agg_xdp
-ifnet=$1
+ifnet=${1:-ens3}
 
 # install xdp program
-sudo $filedir/../eBOT/agg_xdp_usr
+sudo $filedir/../eBOT/agg_xdp_usr $ifnet
 #echo sudo xdp-loader load $ifnet $filedir/../$filename.o
 #sudo xdp-loader load $ifnet $filedir/../$filename.o
 #echo sudo ip link set dev $ifnet xdp obj $filedir/../$filename.o sec xdp/aggregator
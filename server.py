@@ -3,16 +3,114 @@ import aioconsole
 import websockets
 import json
 import os
+import math
+import time
+import itertools
 from dotenv import load_dotenv
-from utils import load_config
+from telemetry import StepTelemetry
+from utils import MAX_GRADIENT_SIZE, fragment_count, gradient_size_for_mtu, load_config
 
 load_dotenv()
 
 COORD_IP = os.getenv("COORD_IP")
 COORD_PORT = os.getenv("COORD_PORT")
 
+PROBE_PORT_OFFSET = 1 # next to the aggregator's port, which XDP consumes
+PROBE_DURATION = 2.0
+PROBE_GRACE = 15.0
+LINK_MATRIX_PATH = "link_matrix.json"
+
+ACK_TIMEOUT = 10.0
+CLEAN_TIMEOUT = 60.0 # clean.sh stops the worker and detaches eBPF
+READY_TIMEOUT = 600.0 # building and attaching eBPF, loading datasets
+EBPF_STATES = ("ebpf_attached", "map_pinned")
+STATE_NAMES = {
+    "ebpf_attached": "eBPF attached",
+    "map_pinned": "map pinned",
+    "worker_ready": "worker ready",
+    "ebpf_failed": "eBPF failed",
+    "worker_exited": "worker exited",
+}
+# the state that ends the wait for another one early
+FAILED_STATES = {
+    "ebpf_attached": "ebpf_failed",
+    "map_pinned": "ebpf_failed",
+    "worker_ready": "worker_exited",
+}
+
 config = load_config("system_config.json")
 clients = set()
+link_results = []
+telemetry = StepTelemetry()
+
+# every request carries an id that the agent's ack echoes
+event_ids = itertools.count(1)
+pending_acks = {}
+# client address -> states reported since the last launch
+node_states = {}
+states_changed = asyncio.Condition()
+
+
+async def handle_event(websocket, event: dict) -> bool:
+    event_type = event.get("event")
+    data = event.get("data")
+    addr = websocket.remote_address[0]
+
+    if event_type == "ack":
+        future = pending_acks.pop(event.get("id"), None)
+        if future is not None and not future.done():
+            future.set_result(data)
+        return True
+
+    if event_type == "status":
+        details = "".join(f", {k} {v}" for k, v in data.items() if k != "state")
+        print(f"\nClient {addr}: {STATE_NAMES.get(data['state'], data['state'])}{details}")
+        async with states_changed:
+            node_states.setdefault(addr, set()).add(data["state"])
+            states_changed.notify_all()
+        return True
+
+    if event_type == "logs":
+        for entry in data["lines"]:
+            print(f"[{addr} {entry['name']}] {entry['line']}")
+        return True
+
+    if event_type == "process_started":
+        print(f"\nClient {addr}: started {data['name']} (pid {data['pid']})")
+        return True
+
+    if event_type == "process_exit":
+        print(
+            f"\nClient {addr}: {data['name']} (pid {data['pid']}) exited with "
+            f"{data['code']} after {data['runtime']:.1f}s"
+        )
+        if data["name"] == "worker":
+            async with states_changed:
+                node_states.setdefault(addr, set()).add("worker_exited")
+                states_changed.notify_all()
+        return True
+
+    if event_type == "telemetry":
+        new, recovered = telemetry.add(addr, data["records"])
+        for straggler in sorted(new):
+            print(f"\nClient {straggler}: straggling")
+        for straggler in sorted(recovered):
+            print(f"\nClient {straggler}: caught up")
+        return True
+
+    if event_type == "link_probe":
+        link_results.append(data)
+        if "error" in data:
+            print(f"\nLink {data['src']} -> {data['dst']}: {data['error']}")
+        else:
+            print(
+                f"\nLink {data['src']} -> {data['dst']}: "
+                f"{data['bandwidth_mbps']:,.0f} Mbit/s, "
+                f"rtt {data['rtt_us']:.0f}us, loss {data['loss']:.2%}"
+            )
+        return True
+
+    return False
 
 
 async def handle_client(websocket):
@@ -20,68 +118,252 @@ async def handle_client(websocket):
     print(f"\nNew client connected: {websocket.remote_address}")
     try:
         async for message in websocket:
-            print(f"\n\nClient {websocket.remote_address}: {message}")
+            try:
+                event = json.loads(message)
+            except json.JSONDecodeError:
+                event = None
+            if not isinstance(event, dict) or not await handle_event(websocket, event):
+                print(f"\n\nClient {websocket.remote_address}: {message}")
     except websockets.exceptions.ConnectionClosed:
         pass
     finally:
         print(f"\nClient {websocket.remote_address} disconnected.")
         clients.remove(websocket)
- 
+        node_states.pop(websocket.remote_address[0], None)
+
+
+async def request(client, event_type: str, data: any = "", timeout: float = ACK_TIMEOUT) -> dict:
+    """Sends an event and waits for the agent's ack.
+
+    Returns the ack's data, or {"ok": False, ...} when the agent does not
+    answer in time or the connection drops.
+    """
+    event_id = next(event_ids)
+    future = asyncio.get_running_loop().create_future()
+    pending_acks[event_id] = future
+    try:
+        await client.send(json.dumps({"event": event_type, "data": data, "id": event_id}))
+        return await asyncio.wait_for(future, timeout)
+    except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed) as e:
+        return {"ok": False, "message": f"{event_type}: {type(e).__name__}"}
+    finally:
+        pending_acks.pop(event_id, None)
 
-async def _send_to_clients(event_type: str, data: any, targets: list):
+
+async def _send_to_clients(event_type: str, data: any, targets: list,
+                           timeout: float = ACK_TIMEOUT) -> bool:
+    """Requests event_type from every target, returns True if all acked it."""
     if not targets:
-        return
+        return True
 
-    event = json.dumps({"event": event_type, "data": data})
-    await asyncio.gather(*(client.send(event) for client in targets))
+    replies = await asyncio.gather(
+        *(request(client, event_type, data, timeout) for client in targets)
+    )
+    for client, reply in zip(targets, replies):
+        print(f"\nClient {client.remote_address[0]}: {reply.get('message', '')}")
+    return all(reply.get("ok") for reply in replies)
 
 
-async def broadcast(event_type: str, data: any = ""):
-    await _send_to_clients(event_type, data, clients)
+async def broadcast(event_type: str, data: any = "") -> bool:
+    return await _send_to_clients(event_type, data, list(clients))
 
 
-async def multicast(event_type: str, data: any = ""):
+def configured_clients() -> tuple:
+    """Connected clients of system_config.json and the addresses missing."""
     config = load_config("system_config.json")
     allowed_addrs = set(config.get("clients", {}).keys())
-    
+
     targets = [
         client for client in clients
         if client.remote_address[0] in allowed_addrs
     ]
-    await _send_to_clients(event_type, data, targets)
+    missing = allowed_addrs - {client.remote_address[0] for client in targets}
+    return targets, missing
+
+
+async def multicast(event_type: str, data: any = "") -> bool:
+    targets, _ = configured_clients()
+    return await _send_to_clients(event_type, data, targets)
+
+
+async def wait_ready(addrs: list, states: tuple, timeout: float = READY_TIMEOUT) -> bool:
+    """Waits until every address has reported all of `states`, giving up
+    early once any of them reports a failure."""
+    def ready() -> bool:
+        return all(set(states) <= node_states.get(addr, set()) for addr in addrs)
+
+    def failed() -> list:
+        failures = {FAILED_STATES[state] for state in states}
+        return [addr for addr in addrs if node_states.get(addr, set()) & failures]
+
+    try:
+        async with states_changed:
+            await asyncio.wait_for(states_changed.wait_for(lambda: ready() or failed()), timeout)
+        if failed():
+            print(f"\nNot ready, failed on: {', '.join(failed())}")
+            return False
+        return True
+    except asyncio.TimeoutError:
+        for addr in addrs:
+            waiting = [STATE_NAMES[state] for state in states
+                       if state not in node_states.get(addr, set())]
+            if waiting:
+                print(f"\nClient {addr} not ready: waiting for {', '.join(waiting)}")
+        return False
+
+
+async def reset_states(addrs: list, states: tuple):
+    async with states_changed:
+        for addr in addrs:
+            node_states.setdefault(addr, set()).difference_update(states)
+
+
+async def resolve_packet_size(targets: list, train_cfg: dict) -> dict:
+    """One gradient_size and fragment_size for the whole fabric, None if an
+    agent could not report its MTU.
+
+    Parent and child have to agree on the packet layout, so "auto" sizes
+    packets to the smallest MTU of the agents (or `mtu`, if smaller).
+    """
+    gradient_size = train_cfg["gradient_size"]
+    if gradient_size == "auto":
+        ifname = train_cfg.get("ifname", "ens3")
+        replies = await asyncio.gather(
+            *(request(client, "read_mtu", {"ifname": ifname}) for client in targets)
+        )
+        failed = [client.remote_address[0] for client, reply in zip(targets, replies)
+                  if not reply.get("ok")]
+        if failed:
+            print(f"\nNo MTU from: {', '.join(failed)}")
+            return None
+
+        mtu = min([reply["mtu"] for reply in replies] + [train_cfg.get("mtu", math.inf)])
+        gradient_size = gradient_size_for_mtu(
+            mtu, train_cfg.get("lane_bits", 32),
+            train_cfg.get("max_gradient_size", MAX_GRADIENT_SIZE),
+        )
+        print(f"\nFabric MTU {mtu}: {gradient_size} gradients per packet")
+
+    fragment_size = train_cfg.get("fragment_size", "auto")
+    if "param_count" in train_cfg:
+        fragment_size = fragment_count(train_cfg["param_count"], gradient_size, fragment_size)
+    return {"gradient_size": gradient_size, "fragment_size": fragment_size}
 
 
 async def update_local_config():
     config = load_config("system_config.json")
     train_cfg = config.get("train_config", {})
-    
+    client_cfgs = config.get("clients", {})
+    targets = [client for client in clients if client.remote_address[0] in client_cfgs]
+    if not targets:
+        return
+
+    sizes = await resolve_packet_size(targets, train_cfg)
+    if sizes is None:
+        return
+
     tasks = []
-    for client in clients:
+    for client in targets:
         addr = client.remote_address[0]
-        client_cfg = config.get("clients", {}).get(addr, {})
-        
-        if client_cfg:
-            update_data = {
-                **client_cfg,
-                **train_cfg,
-                "ip": addr,
-            }
-            event = json.dumps({"event": "update_local_config", "data": update_data})
-            task = asyncio.create_task(client.send(event))
-            tasks.append(task)
-    
-    if tasks:
-        await asyncio.gather(*tasks)
+        update_data = {
+            **client_cfgs[addr],
+            **train_cfg,
+            **sizes,
+            "ip": addr,
+        }
+        tasks.append(_send_to_clients("update_local_config", update_data, [client]))
+    await asyncio.gather(*tasks)
 
 
 async def run_ebpf_progs():
-    await multicast("run_ebpf_progs")
+    targets, missing = configured_clients()
+    addrs = [client.remote_address[0] for client in targets]
+    await reset_states(addrs, EBPF_STATES + ("ebpf_failed",))
+
+    start_time = time.perf_counter()
+    if not await _send_to_clients("run_ebpf_progs", "", targets):
+        return
+    if await wait_ready(addrs, EBPF_STATES):
+        print(f"\neBPF ready on {len(addrs)} nodes after {time.perf_counter() - start_time:.1f}s")
+
+
+async def launch_workers(targets: list, event_type: str, data: any = ""):
+    """Sends event_type, which (re)starts the workers on targets, and
+    releases them together once all are ready."""
+    addrs = [client.remote_address[0] for client in targets]
+    await reset_states(addrs, ("worker_ready", "worker_exited"))
+    start_time = time.perf_counter()
+    if not await _send_to_clients(event_type, data, targets):
+        return
+    if not await wait_ready(addrs, ("worker_ready",)):
+        return
+
+    await _send_to_clients("release_training", "", targets)
+    print(f"\nTraining released on {len(addrs)} nodes after {time.perf_counter() - start_time:.1f}s")
+
 
 async def run_train_progs(prog_type: str):
-    await multicast(f"run_{prog_type}_train")
+    targets, missing = configured_clients()
+    if missing:
+        print(f"\nNot launching, clients missing: {', '.join(sorted(missing))}")
+        return
+
+    addrs = [client.remote_address[0] for client in targets]
+    if prog_type == "ebpf" and not await wait_ready(addrs, EBPF_STATES, ACK_TIMEOUT):
+        print("\nRun the eBPF programs first.")
+        return
+
+    telemetry.start()
+    await launch_workers(targets, f"run_{prog_type}_train")
 
 async def clean_progs():
-    await broadcast("clean_progs")
+    await _send_to_clients("clean_progs", "", list(clients), CLEAN_TIMEOUT)
+
+async def select_clients() -> list:
+    addr = (await aioconsole.ainput("Client address (empty for all): ")).strip()
+    targets = [client for client in clients if not addr or client.remote_address[0] == addr]
+    if not targets:
+        print(f"\nNo client {addr} connected.")
+    return targets
+
+async def process_status():
+    await broadcast("list_procs")
+
+async def kill_process():
+    targets = await select_clients()
+    name = (await aioconsole.ainput("Process name (worker, ebpf, clean): ")).strip()
+    if targets and name:
+        await _send_to_clients("kill_proc", {"name": name}, targets, CLEAN_TIMEOUT)
+
+async def restart_process():
+    targets = await select_clients()
+    name = (await aioconsole.ainput("Process name (worker, ebpf, clean): ")).strip()
+    if not targets or not name:
+        return
+    if name == "worker":
+        # stop it first so its exit does not count against the new one,
+        # which waits at the barrier again
+        await _send_to_clients("kill_proc", {"name": name}, targets, CLEAN_TIMEOUT)
+        await launch_workers(targets, "restart_proc", {"name": name})
+    else:
+        await _send_to_clients("restart_proc", {"name": name}, targets, CLEAN_TIMEOUT)
+
+async def show_telemetry():
+    rows = telemetry.summary()
+    if not rows:
+        print("\nNo step telemetry yet.")
+        return
+
+    print(f"\n{'node':>15} {'rank':>4} {'step':>6} {'p50':>9} {'p95':>9} {'p99':>9} "
+          f"{'compute':>9} {'wait':>9} {'MB/s':>9}")
+    for row in rows:
+        print(
+            f"{row['node']:>15} {row['rank']:>4} {row['step']:>6} "
+            f"{row['p50']*1e3:7.1f}ms {row['p95']*1e3:7.1f}ms {row['p99']*1e3:7.1f}ms "
+            f"{row['compute']*1e3:7.1f}ms {row['wait']*1e3:7.1f}ms "
+            f"{row['bandwidth']/1e6:9.1f}" + ("  straggler" if row["straggler"] else "")
+        )
+    print(f"Time series in {telemetry.path}")
 
 async def ping():
     if not clients:
@@ -93,6 +375,68 @@ async def ping():
 async def kill_agents():
     await broadcast("kill_agent")
 
+
+def pair_rounds(members: list) -> list:
+    """Round robin schedule: every pair meets once, nobody twice per round."""
+    members = list(members)
+    if len(members) % 2:
+        members.append(None)
+
+    rounds = []
+    for _ in range(len(members) - 1):
+        half = len(members) // 2
+        pairs = zip(members[:half], reversed(members[half:]))
+        rounds.append([(a, b) for a, b in pairs if a is not None and b is not None])
+        members = [members[0], members[-1]] + members[1:-1]
+    return rounds
+
+
+async def measure_links(duration: float = PROBE_DURATION):
+    """Probes every pair of configured clients in both directions at once
+    and stores the results as a link matrix for gen_system_config.py."""
+    main_config = load_config("main_config.json")
+    ids = {
+        node["addr"]: node["id"]
+        for node in main_config["node_config"] if not node.get("disabled")
+    }
+    port = main_config["train_config"]["port"] + PROBE_PORT_OFFSET
+
+    members = sorted(
+        (client for client in clients if client.remote_address[0] in ids),
+        key=lambda client: ids[client.remote_address[0]],
+    )
+    if len(members) < 2:
+        print("\nAt least two configured clients are needed to measure links.")
+        return
+
+    link_results.clear()
+    for round_id, pairs in enumerate(pair_rounds(members)):
+        # the agents ack once their probes are done
+        probes = []
+        for a, b in pairs:
+            for src, dst in ((a, b), (b, a)):
+                src_addr, dst_addr = src.remote_address[0], dst.remote_address[0]
+                probes.append(request(src, "measure_links", {
+                    "round": round_id,
+                    "id": ids[src_addr],
+                    "port": port,
+                    "duration": duration,
+                    "targets": [{"id": ids[dst_addr], "addr": dst_addr}],
+                }, timeout=duration + PROBE_GRACE))
+
+        replies = await asyncio.gather(*probes)
+        if not all(reply.get("ok") for reply in replies):
+            print(f"\nRound {round_id} incomplete, continuing without it.")
+
+    matrix = {
+        "measured_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "links": list(link_results),
+    }
+    with open(LINK_MATRIX_PATH, "w") as f:
+        f.write(json.dumps(matrix, indent=4))
+    print(f"\n{len(link_results)} links written to {LINK_MATRIX_PATH}, "
+          f"run gen_system_config.py to re-plan.")
+
 async def event_dispatcher():
     while True:
         print("\nSelect an option:")
@@ -104,8 +448,13 @@ async def event_dispatcher():
         print("6. Clean programs")
         print("7. Ping")
         print("8. Kill agents")
+        print("9. Measure links")
+        print("10. Process status")
+        print("11. Kill process")
+        print("12. Restart process")
+        print("13. Step telemetry")
         
-        choice = (await aioconsole.ainput("Enter your choice (1->8): ")).strip()
+        choice = (await aioconsole.ainput("Enter your choice (1->13): ")).strip()
         
         if choice == "1":
             await update_local_config()
@@ -123,6 +472,16 @@ async def event_dispatcher():
             await ping()
         elif choice == "8":
             await kill_agents()
+        elif choice == "9":
+            await measure_links()
+        elif choice == "10":
+            await process_status()
+        elif choice == "11":
+            await kill_process()
+        elif choice == "12":
+            await restart_process()
+        elif choice == "13":
+            await show_telemetry()
         else:
             continue
         
@@ -0,0 +1,180 @@
+"""
+Asyncio supervisor for the processes an agent launches.
+
+Every process is started under a name in its own session, so a kill
+reaches everything it spawned (make, sudo, ...). Its stdout and stderr are
+read line by line and handed to `send_event` in batches of up to
+LOG_BATCH_LINES lines, at least every LOG_BATCH_INTERVAL seconds. Starts
+and exits are reported as `process_started` and `process_exit` events,
+the latter with exit code and runtime.
+"""
+import os
+import time
+import signal
+import asyncio
+
+LOG_BATCH_LINES = 50
+LOG_BATCH_INTERVAL = 0.5
+KILL_TIMEOUT = 5.0
+
+
+class EventBatcher:
+    """Collects items and sends them as one `event_type` event with
+    {key: [items]}, once max_items are waiting or interval has passed."""
+
+    def __init__(self, send_event, event_type: str, key: str,
+                 max_items: int = LOG_BATCH_LINES, interval: float = LOG_BATCH_INTERVAL):
+        self._send_event = send_event
+        self._event_type = event_type
+        self._key = key
+        self._max_items = max_items
+        self._interval = interval
+        self._items = []
+        self._flush_task = None
+
+    async def add(self, item):
+        self._items.append(item)
+        if len(self._items) >= self._max_items:
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._interval)
+        await self.flush()
+
+    async def flush(self):
+        if not self._items:
+            return
+        items, self._items = self._items, []
+        await self._send_event(self._event_type, {self._key: items})
+
+
+class ManagedProcess:
+
+    def __init__(self, name: str, argv: list, env: dict = None, stdin: bool = False,
+                 on_line=None):
+        self.name = name
+        self.argv = argv
+        self.env = env
+        self.stdin = stdin
+        # called with each stdout line, returns True if it consumed the line
+        self.on_line = on_line
+        self.proc = None
+        self.started = None
+        self.runtime = None
+        self.exited = None
+        # the task reading its output, the loop only keeps a weak reference
+        self.watcher = None
+
+    @property
+    def running(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    def status(self) -> dict:
+        runtime = time.monotonic() - self.started if self.running else self.runtime
+        return {
+            "name": self.name,
+            "pid": self.proc.pid if self.proc else None,
+            "running": self.running,
+            "code": None if self.running or self.proc is None else self.proc.returncode,
+            "runtime": runtime,
+        }
+
+
+class ProcessSupervisor:
+
+    def __init__(self, send_event):
+        self._send_event = send_event
+        self._procs = {}
+        self._logs = EventBatcher(send_event, "logs", "lines")
+
+    def get(self, name: str) -> ManagedProcess:
+        return self._procs.get(name)
+
+    def status(self) -> list:
+        return [proc.status() for proc in self._procs.values()]
+
+    async def start(self, name: str, argv: list, env: dict = None, stdin: bool = False,
+                    on_line=None) -> ManagedProcess:
+        """Starts argv as `name`, stopping a previous process of that name."""
+        await self.kill(name)
+        managed = ManagedProcess(name, argv, env, stdin, on_line)
+        self._procs[name] = managed
+        await self._spawn(managed)
+        return managed
+
+    async def restart(self, name: str) -> ManagedProcess:
+        managed = self._procs.get(name)
+        if managed is None:
+            raise KeyError(name)
+        return await self.start(name, managed.argv, managed.env, managed.stdin, managed.on_line)
+
+    async def _spawn(self, managed: ManagedProcess):
+        env = {**os.environ, "PYTHONUNBUFFERED": "1", **(managed.env or {})}
+        managed.proc = await asyncio.create_subprocess_exec(
+            *managed.argv,
+            stdin=asyncio.subprocess.PIPE if managed.stdin else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            start_new_session=True,
+        )
+        managed.started = time.monotonic()
+        managed.exited = asyncio.get_running_loop().create_future()
+        await self._send_event("process_started", {"name": managed.name, "pid": managed.proc.pid})
+        managed.watcher = asyncio.create_task(self._watch(managed, managed.proc, managed.exited))
+
+    async def _watch(self, managed: ManagedProcess, proc, exited: asyncio.Future):
+        await asyncio.gather(
+            self._read(managed, proc.stdout, "stdout"),
+            self._read(managed, proc.stderr, "stderr"),
+        )
+        code = await proc.wait()
+        runtime = time.monotonic() - managed.started
+        if managed.proc is proc:
+            managed.runtime = runtime
+        await self._logs.flush()
+        await self._send_event("process_exit", {
+            "name": managed.name, "pid": proc.pid, "code": code, "runtime": runtime,
+        })
+        exited.set_result(code)
+
+    async def _read(self, managed: ManagedProcess, stream, stream_name: str):
+        async for raw in stream:
+            line = raw.decode(errors="replace").rstrip()
+            if stream_name == "stdout" and managed.on_line and await managed.on_line(line):
+                continue
+            await self._logs.add({"name": managed.name, "stream": stream_name, "line": line})
+
+    async def write(self, name: str, data: bytes) -> bool:
+        managed = self._procs.get(name)
+        if managed is None or not managed.running or not managed.stdin:
+            return False
+        managed.proc.stdin.write(data)
+        await managed.proc.stdin.drain()
+        return True
+
+    async def wait(self, name: str) -> int:
+        managed = self._procs[name]
+        return await managed.exited
+
+    async def kill(self, name: str, timeout: float = KILL_TIMEOUT) -> bool:
+        """SIGTERMs the process group of `name`, SIGKILLs it after timeout."""
+        managed = self._procs.get(name)
+        if managed is None or not managed.running:
+            return False
+
+        pgid = managed.proc.pid
+        try:
+            os.killpg(pgid, signal.SIGTERM)
+            await asyncio.wait_for(asyncio.shield(managed.exited), timeout)
+        except asyncio.TimeoutError:
+            os.killpg(pgid, signal.SIGKILL)
+            await managed.exited
+        except ProcessLookupError:
+            pass
+        return True
+
+    async def close(self):
+        await asyncio.gather(*(self.kill(name) for name in list(self._procs)))
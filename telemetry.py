@@ -0,0 +1,116 @@
+"""
+Per-step telemetry of the training workers, kept by server.py.
+
+Under an agent, worker.py prints one record per step (utils.STEP_FIELDS)
+and the agent forwards them in batches. For every node the last `window`
+records are kept for rolling p50/p95/p99 step times, and every record is
+appended to a CSV time series, one file per launch.
+
+In a synchronous all-reduce all nodes finish a step at about the same
+time. A slow node shows up as long compute and push times on itself and
+as long waits on everybody else, so a node is flagged as a straggler when
+its median busy time (compute + push) exceeds `factor` times the median
+over all nodes.
+"""
+import os
+import csv
+import time
+import statistics
+from collections import deque
+
+from utils import STEP_FIELDS
+
+TELEMETRY_DIR = "telemetry"
+TELEMETRY_WINDOW = 200
+STRAGGLER_FACTOR = 1.25
+STRAGGLER_MIN_STEPS = 10
+
+
+def percentiles(values: list) -> tuple:
+    """p50, p95 and p99 of values."""
+    if len(values) == 1:
+        return values[0], values[0], values[0]
+    q = statistics.quantiles(values, n=100, method="inclusive")
+    return q[49], q[94], q[98]
+
+
+class StepTelemetry:
+
+    def __init__(self, directory: str = TELEMETRY_DIR, window: int = TELEMETRY_WINDOW,
+                 factor: float = STRAGGLER_FACTOR):
+        self._directory = directory
+        self._window = window
+        self._factor = factor
+        self._file = None
+        self._writer = None
+        self.path = None
+        # client address -> last `window` records
+        self.steps = {}
+        self.stragglers = set()
+
+    def start(self):
+        """Starts a new time series, dropping the windows of the last run."""
+        self.close()
+        self.steps.clear()
+        self.stragglers.clear()
+        os.makedirs(self._directory, exist_ok=True)
+        self.path = os.path.join(self._directory, f"steps-{time.strftime('%Y%m%d-%H%M%S')}.csv")
+        self._file = open(self.path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(("time", "node") + STEP_FIELDS)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def add(self, addr: str, records: list) -> tuple:
+        """Adds the records of one node, returns the (new, recovered) stragglers."""
+        now = time.time()
+        window = self.steps.setdefault(addr, deque(maxlen=self._window))
+        for record in records:
+            window.append(dict(zip(STEP_FIELDS, record)))
+            if self._writer is not None:
+                self._writer.writerow([f"{now:.3f}", addr] + list(record))
+        if self._file is not None:
+            self._file.flush()
+        return self._update_stragglers()
+
+    def _update_stragglers(self) -> tuple:
+        busy = {
+            addr: statistics.median(r["compute"] + r["push"] for r in window)
+            for addr, window in self.steps.items() if len(window) >= STRAGGLER_MIN_STEPS
+        }
+        if len(busy) < 2:
+            return set(), set()
+
+        cluster = statistics.median(busy.values())
+        stragglers = {addr for addr, t in busy.items() if t > self._factor * cluster}
+        new, recovered = stragglers - self.stragglers, self.stragglers - stragglers
+        self.stragglers = stragglers
+        return new, recovered
+
+    def summary(self) -> list:
+        """Rolling statistics of every node, in seconds and bytes per second."""
+        rows = []
+        for addr, window in sorted(self.steps.items()):
+            if not window:
+                continue
+            records = list(window)
+            step_times = [r["compute"] + r["push"] + r["wait"] for r in records]
+            comm_times = [r["push"] + r["wait"] for r in records]
+            p50, p95, p99 = percentiles(step_times)
+            comm = statistics.median(comm_times)
+            rows.append({
+                "node": addr,
+                "rank": records[-1]["rank"],
+                "step": records[-1]["step"],
+                "p50": p50,
+                "p95": p95,
+                "p99": p99,
+                "compute": statistics.median(r["compute"] for r in records),
+                "wait": statistics.median(r["wait"] for r in records),
+                "bandwidth": records[-1]["bytes"] / comm if comm > 0 else 0.0,
+                "straggler": addr in self.stragglers,
+            })
+        return rows
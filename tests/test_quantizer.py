@@ -0,0 +1,62 @@
+"""
+Simulated all-reduce through the quantizers: every worker quantizes its own
+gradients, the lanes are summed as 32-bit integers the way agg_map does it,
+and every worker dequantizes the same sums.
+"""
+import pytest
+import torch
+
+from quantizer import BlockQuantizer, FixedPointQuantizer
+
+GRADIENT_SIZE = 64
+FRAGMENT_SIZE = 16
+WORKER_NUM = 4
+STEPS = 16
+SCALE_FACTOR = 1e6
+# largest error per fragment, relative to the fragment's largest mean
+# gradient, once the exponents have settled
+MAX_REL_ERROR = {32: 1e-4, 16: 2e-3, 8: 0.2}
+
+
+def make_quantizers(lane_bits: int) -> list:
+    if lane_bits == 32:
+        return [
+            FixedPointQuantizer(GRADIENT_SIZE * FRAGMENT_SIZE, SCALE_FACTOR, worker_num=WORKER_NUM)
+            for _ in range(WORKER_NUM)
+        ]
+    return [
+        BlockQuantizer(GRADIENT_SIZE, FRAGMENT_SIZE, lane_bits, WORKER_NUM, exp_init=16)
+        for _ in range(WORKER_NUM)
+    ]
+
+
+def allreduce(quantizers: list, grads: list) -> list:
+    sums = torch.zeros(GRADIENT_SIZE * FRAGMENT_SIZE, dtype=torch.int32)
+    for quantizer, g in zip(quantizers, grads):
+        sums += quantizer.quantize(g).to(torch.int32)
+    return [
+        quantizer.dequantize(sums.clone(), torch.empty_like(g), divisor=len(grads))
+        for quantizer, g in zip(quantizers, grads)
+    ]
+
+
+@pytest.mark.parametrize("lane_bits", [32, 16, 8])
+def test_allreduce_error(lane_bits):
+    gen = torch.Generator().manual_seed(0)
+    # gradient magnitudes differ by orders of magnitude between fragments
+    magnitude = torch.logspace(-2, 0, FRAGMENT_SIZE).repeat_interleave(GRADIENT_SIZE)
+    quantizers = make_quantizers(lane_bits)
+
+    for _ in range(STEPS):
+        grads = [torch.randn(magnitude.shape, generator=gen) * magnitude for _ in range(WORKER_NUM)]
+        results = allreduce(quantizers, grads)
+        if lane_bits < 32:
+            for quantizer in quantizers[1:]:
+                assert torch.equal(quantizer.exponents, quantizers[0].exponents)
+
+    mean = torch.stack(grads).mean(dim=0).view(FRAGMENT_SIZE, GRADIENT_SIZE)
+    for result in results:
+        assert torch.equal(result, results[0])
+    error = (results[0].view(FRAGMENT_SIZE, GRADIENT_SIZE) - mean).abs().amax(dim=1)
+    rel_error = error / mean.abs().amax(dim=1)
+    assert rel_error.max().item() < MAX_REL_ERROR[lane_bits]
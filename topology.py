@@ -0,0 +1,214 @@
+"""
+Aggregation tree planner for gen_system_config.py.
+
+Every node runs a worker and an aggregator, so a plan is just a tree over
+the nodes: {parent_id: [child_id, ...]} rooted at the first node. The
+strategies differ in how they pick a parent for the next node:
+
+* `bate`: the node with the highest bandwidth per link (BATE).
+* `kary`: a balanced `fanout`-ary tree, fastest nodes closest to the root.
+* `greedy`: the parent whose own transfer time plus distance to the root
+  grows the least.
+* `auto`: all of the above, keeping the tree with the lowest estimate.
+
+Each node is placed in O(log N), so thousands of nodes take milliseconds.
+
+The estimate assumes the aggregators stream fragments, as agg_xdp.c does:
+every link carries the whole model once towards the root and once back,
+all of them at the same time. A node with k children and a parent thus
+moves (k + 1) models in each direction, and the slowest node sets the
+pace. The deepest root to leaf path adds its latency twice on top.
+"""
+import heapq
+import math
+
+from utils import MAX_GRADIENT_SIZE, PACKET_OVERHEAD, gradient_size_for_mtu
+
+STRATEGIES = ("bate", "kary", "greedy")
+AUTO_FANOUTS = (1, 2, 3, 4, 6, 8, 12, 16)
+
+DEFAULT_BANDWIDTH_MBPS = 10000
+DEFAULT_LATENCY_US = 50
+
+
+class LinkModel:
+    """Per-node bandwidth and per-link latency from main_config.json.
+
+    `measured` is a link matrix as written by server.py, with one
+    {"src", "dst", "bandwidth_mbps", "rtt_us"} entry per probed direction.
+    A node's measured uplink is the fastest rate it sent at, its downlink
+    the fastest rate it received at. A single UDP probe rarely fills a
+    fast NIC, so these only lower the configured rates. A link's latency
+    becomes half its RTT.
+    """
+
+    def __init__(self, nodes: list, topology_config: dict, measured: dict = None):
+        default_bw = topology_config.get("default_bandwidth_mbps", DEFAULT_BANDWIDTH_MBPS)
+        self.default_latency = topology_config.get("default_latency_us", DEFAULT_LATENCY_US) * 1e-6
+
+        # bytes per second in each direction
+        self.uplink = {}
+        self.downlink = {}
+        for node in nodes:
+            bw = node.get("bandwidth_mbps", default_bw)
+            self.uplink[node["id"]] = node.get("uplink_mbps", bw) * 1e6 / 8
+            self.downlink[node["id"]] = node.get("downlink_mbps", bw) * 1e6 / 8
+
+        self.latency = {}
+        for link in topology_config.get("links", []):
+            u, v = link["nodes"]
+            self.latency[(min(u, v), max(u, v))] = link["latency_us"] * 1e-6
+
+        if measured:
+            self._apply_measurements(measured["links"])
+
+    def _apply_measurements(self, links: list):
+        uplink, downlink, latency = {}, {}, {}
+        for link in links:
+            src, dst = link["src"], link["dst"]
+            if src not in self.uplink or dst not in self.uplink or "error" in link:
+                continue
+            rate = link["bandwidth_mbps"] * 1e6 / 8
+            uplink[src] = max(uplink.get(src, 0.0), rate)
+            downlink[dst] = max(downlink.get(dst, 0.0), rate)
+            key = (min(src, dst), max(src, dst))
+            latency[key] = min(latency.get(key, math.inf), link["rtt_us"] * 1e-6 / 2)
+
+        for node_id, rate in uplink.items():
+            if rate > 0:
+                self.uplink[node_id] = min(self.uplink[node_id], rate)
+        for node_id, rate in downlink.items():
+            if rate > 0:
+                self.downlink[node_id] = min(self.downlink[node_id], rate)
+        self.latency.update(latency)
+
+    def bandwidth(self, node_id: int) -> float:
+        return min(self.uplink[node_id], self.downlink[node_id])
+
+    def link_latency(self, u: int, v: int) -> float:
+        return self.latency.get((min(u, v), max(u, v)), self.default_latency)
+
+    def node_time(self, node_id: int, links: int, message_bytes: float) -> float:
+        """Seconds node_id needs to move message_bytes over `links` links each way."""
+        load = links * message_bytes
+        return max(load / self.uplink[node_id], load / self.downlink[node_id])
+
+
+def _by_bandwidth(nodes: list, model: LinkModel) -> list:
+    # the first node stays the root, the rest fastest first
+    root, rest = nodes[0]["id"], [node["id"] for node in nodes[1:]]
+    return [root] + sorted(rest, key=lambda node_id: -model.bandwidth(node_id))
+
+
+def plan_bate(nodes: list, model: LinkModel, message_bytes: float) -> dict:
+    order = _by_bandwidth(nodes, model)
+    graph = {node_id: [] for node_id in order}
+    degree = {node_id: 0 for node_id in order}
+
+    heap = [(-model.bandwidth(order[0]), order[0])]
+    for v in order[1:]:
+        _, u = heapq.heappop(heap)
+        graph[u].append(v)
+        degree[u] += 1
+        degree[v] += 1
+        heapq.heappush(heap, (-model.bandwidth(u) / (degree[u] + 1), u))
+        heapq.heappush(heap, (-model.bandwidth(v) / (degree[v] + 1), v))
+
+    return graph
+
+
+def plan_kary(nodes: list, model: LinkModel, message_bytes: float, fanout: int = 2) -> dict:
+    order = _by_bandwidth(nodes, model)
+    graph = {node_id: [] for node_id in order}
+    for i, v in enumerate(order[1:], start=1):
+        graph[order[(i - 1) // fanout]].append(v)
+    return graph
+
+
+def plan_greedy(nodes: list, model: LinkModel, message_bytes: float) -> dict:
+    order = _by_bandwidth(nodes, model)
+    graph = {node_id: [] for node_id in order}
+    links = {order[0]: 0}
+    depth = {order[0]: 0.0}
+
+    # cost of one more child under u, estimated with the default latency
+    def cost(u: int) -> float:
+        return model.node_time(u, links[u] + 1, message_bytes) \
+            + 2 * (depth[u] + model.default_latency)
+
+    heap = [(cost(order[0]), order[0])]
+    for v in order[1:]:
+        _, u = heapq.heappop(heap)
+        graph[u].append(v)
+        links[u] += 1
+        links[v] = 1
+        depth[v] = depth[u] + model.link_latency(u, v)
+        heapq.heappush(heap, (cost(u), u))
+        heapq.heappush(heap, (cost(v), v))
+
+    return graph
+
+
+def estimate_time(graph: dict, root: int, model: LinkModel, message_bytes: float) -> dict:
+    """Expected seconds per all-reduce of message_bytes over graph."""
+    bottleneck, bottleneck_time = root, 0.0
+    max_depth, max_latency = 0, 0.0
+    stack = [(root, 0, 0.0, 0)]
+    while stack:
+        u, depth, latency, parents = stack.pop()
+        node_time = model.node_time(u, len(graph[u]) + parents, message_bytes)
+        if node_time > bottleneck_time:
+            bottleneck, bottleneck_time = u, node_time
+        max_depth = max(max_depth, depth)
+        max_latency = max(max_latency, latency)
+        for v in graph[u]:
+            stack.append((v, depth + 1, latency + model.link_latency(u, v), 1))
+
+    return {
+        "aggregation_time": bottleneck_time + 2 * max_latency,
+        "bottleneck_node": bottleneck,
+        "depth": max_depth,
+    }
+
+
+def plan_topology(nodes: list, topology_config: dict, message_bytes: float,
+                  measured: dict = None) -> tuple:
+    """Builds the tree for `strategy` and returns (graph, estimate)."""
+    model = LinkModel(nodes, topology_config, measured)
+    strategy = topology_config.get("strategy", "auto")
+    fanout = topology_config.get("fanout", "auto")
+    root = nodes[0]["id"]
+
+    candidates = []
+    if strategy in ("bate", "auto"):
+        candidates.append(("bate", plan_bate(nodes, model, message_bytes)))
+    if strategy in ("greedy", "auto"):
+        candidates.append(("greedy", plan_greedy(nodes, model, message_bytes)))
+    if strategy in ("kary", "auto"):
+        fanouts = [k for k in AUTO_FANOUTS if k < max(2, len(nodes))] \
+            if fanout == "auto" else [fanout]
+        for k in fanouts:
+            candidates.append((f"kary-{k}", plan_kary(nodes, model, message_bytes, k)))
+    if not candidates:
+        raise ValueError(f"unknown strategy {strategy}, expected auto or one of {STRATEGIES}")
+
+    best = None
+    for name, graph in candidates:
+        estimate = estimate_time(graph, root, model, message_bytes)
+        estimate["strategy"] = name
+        if best is None or estimate["aggregation_time"] < best[1]["aggregation_time"]:
+            best = (graph, estimate)
+    return best
+
+
+def allreduce_bytes(train_config: dict) -> int:
+    """Bytes one node sends per all-reduce, packet headers included."""
+    lane_bits = train_config.get("lane_bits", 32)
+    gradient_size = train_config["gradient_size"]
+    if gradient_size == "auto":
+        max_gradient_size = train_config.get("max_gradient_size", MAX_GRADIENT_SIZE)
+        gradient_size = gradient_size_for_mtu(
+            train_config.get("mtu", 1500), lane_bits, max_gradient_size
+        )
+    fragments = math.ceil(train_config["param_count"] / gradient_size)
+    return fragments * (gradient_size * lane_bits // 8 + PACKET_OVERHEAD)
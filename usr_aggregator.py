@@ -0,0 +1,792 @@
+"""
+Userspace reference implementation of the eBOT aggregator.
+
+`UsrAggregator` runs the per-fragment state machine of `aggregator()` in
+eBOT/agg_xdp.c on a plain UDP socket, and `UsrAggLib` exposes the same
+`init_socket`/`send_all_fragments`/`busy_polling` surface as
+eBOT/agg_map_lib.c. Both speak the `struct agg_payload` wire format, so
+EbpfWorker can run on hosts without XDP/TC (dev boxes, CI) and several
+workers on one host can run a full all-reduce over loopback.
+
+Run `python3 usr_aggregator.py <workers> [fanout] [tx_mode] [drop_rate]
+[tx_threads]` for a loopback all-reduce check; a drop rate > 0 exercises the
+retransmits.
+"""
+import os
+import sys
+import time
+import queue
+import socket
+import struct
+import threading
+import numpy as np
+
+from ctypes import POINTER, c_int, c_uint8, cast
+from types import SimpleNamespace
+
+LOOPBACK_IP = "127.0.0.1"
+RCVBUF_SIZE = 64 * 1024 * 1024
+
+# transmit paths, same ids as in agg_map_lib.c
+TX_MODE_SENDTO = 0
+TX_MODE_SENDMMSG = 1
+TX_MODE_GSO = 2
+GSO_MAX_SEGS = 64
+GSO_MAX_BYTES = 65000
+TX_THREADS_MAX = 64
+TX_POOL_MIN = 256
+TX_BATCH_MAX = 1024
+PACING_OFF = 0
+PACING_BUCKET = 1
+PACING_FQ = 2
+PACING_SPIN_SEC = 100e-6
+WIRE_OVERHEAD = 14 + 20 + 8
+SO_MAX_PACING_RATE = 47
+SOL_UDP = 17
+UDP_SEGMENT = 103
+DONE_TIMEOUT = 0.01
+
+# aggregator counters, same ids as enum agg_stat in agg_common.h.tmpl
+STAT_SERVED = 0
+STAT_REFORWARD = 1
+STAT_DUPLICATE = 2
+STAT_EXP_MISMATCH = 3
+STAT_NUM = 4
+RETX_STAT_NUM = 2 + STAT_NUM
+
+
+LANE_DTYPES = {32: "=i4", 16: "=i2", 8: "i1"}
+HEADER_DTYPE = np.dtype([
+    ("hid", ">u4"),
+    ("fid", ">u4"),
+    ("bcast", ">u4"),
+    ("iter", ">u4"),
+    ("exp", ">i4"),
+])
+
+
+def payload_dtype(gradient_size: int, lane_bits: int = 32) -> np.dtype:
+    # header fields are network order, grads are copied raw (host order)
+    return np.dtype(HEADER_DTYPE.descr + [
+        ("grads", LANE_DTYPES[lane_bits], (gradient_size,)),
+    ])
+
+
+def _runs(frag_ids: np.ndarray) -> list:
+    """Coalesces sorted fragment ids into [first, last + 1) runs."""
+    if len(frag_ids) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(frag_ids) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(frag_ids)]))
+    return [(int(frag_ids[i]), int(frag_ids[j-1]) + 1) for i, j in zip(starts, ends)]
+
+
+def _set_pacing_rate(sock: socket.socket, rate: float):
+    sock.setsockopt(socket.SOL_SOCKET, SO_MAX_PACING_RATE, struct.pack("=Q", int(rate)))
+
+
+def _sleep_until(deadline: float):
+    delay = deadline - time.perf_counter()
+    if delay > PACING_SPIN_SEC:
+        time.sleep(delay - PACING_SPIN_SEC / 2)
+    while time.perf_counter() < deadline:
+        pass
+
+
+class Pacer:
+    """Token bucket of `struct pacer` in eBOT/agg_map_lib.c, in bytes/s."""
+
+    def __init__(self):
+        self.rate = 0.0
+        self.tokens = 0.0
+        self.last = 0.0
+
+    def start(self, rate: float, offset: float):
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = time.perf_counter() + offset
+
+    def wait(self, nbytes: float):
+        if self.rate <= 0:
+            return
+        now = time.perf_counter()
+        if now > self.last:
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, nbytes)
+            self.last = now
+        if self.tokens < nbytes:
+            ready = self.last + (nbytes - self.tokens) / self.rate
+            _sleep_until(ready)
+            self.tokens = nbytes
+            self.last = ready
+        self.tokens -= nbytes
+
+
+def tree_topology(rank: int, world_size: int, fanout: int) -> tuple:
+    """Returns (parent_id, children_ids) of `rank` in a k-ary tree rooted at 0."""
+    fanout = max(1, fanout)
+    parent = (rank - 1) // fanout if rank > 0 else None
+    first = rank * fanout + 1
+    children = list(range(first, min(first + fanout, world_size)))
+    return parent, children
+
+
+class UsrAggregator:
+    """Per-host aggregator, equivalent to agg_xdp.o attached on one node."""
+
+    def __init__(self, host_id: int, parent_id, children: list, worker_num: int,
+                 gradient_size: int, fragment_size: int, port: int,
+                 ip: str = LOOPBACK_IP, drop_rate: float = 0.0, lane_bits: int = 32,
+                 rcvbuf: int = RCVBUF_SIZE):
+        self.host_id = host_id
+        self.parent_id = host_id if parent_id is None else parent_id
+        self.parent_num = 0 if parent_id is None else 1
+        self.children = list(children)
+        self.children_num = len(self.children)
+        self.worker_num = worker_num
+        self.gradient_size = gradient_size
+        self.fragment_size = fragment_size
+        self.port = port
+        self.ip = ip
+
+        # struct agg_map, one row per fragment
+        self.lock = np.zeros(fragment_size, dtype=np.uint8)
+        self.hcheck = np.zeros((fragment_size, worker_num), dtype=np.uint8)
+        self.lflag = np.zeros(fragment_size, dtype=np.uint8)
+        self.iter = np.zeros(fragment_size, dtype=np.uint32)
+        self.childcnt = np.zeros(fragment_size, dtype=np.uint32)
+        self.lgrads = np.zeros((fragment_size, gradient_size), dtype=np.int32)
+        self.grads = np.zeros((fragment_size, gradient_size), dtype=np.int32)
+        self.exp = np.zeros(fragment_size, dtype=np.int32)
+
+        # completion records, like completion_map of agg_xdp.c
+        self.done = queue.SimpleQueue()
+        self.stats = np.zeros(STAT_NUM, dtype=np.uint64)
+
+        # incoming packets dropped on purpose to test loss recovery
+        self.drop_rate = drop_rate
+        self._rng = np.random.default_rng(host_id)
+
+        self._dtype = payload_dtype(gradient_size, lane_bits)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self._sock.bind((ip, self.addr_of(host_id)[1]))
+        self._sock.settimeout(0.1)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def addr_of(self, node_id: int) -> tuple:
+        return (self.ip, self.port + node_id)
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self._sock.close()
+
+    def _serve(self):
+        buf = bytearray(self._dtype.itemsize)
+        while self._running:
+            try:
+                n = self._sock.recv_into(buf)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if n < self._dtype.itemsize:
+                continue
+            if self.drop_rate and self._rng.random() < self.drop_rate:
+                continue
+            pkt = np.frombuffer(buf, dtype=self._dtype, count=1)[0]
+            self._aggregate(pkt)
+
+    def _send(self, node_id: int, fid: int, bcast: int, step: int, grads: np.ndarray):
+        pkt = np.zeros(1, dtype=self._dtype)
+        pkt["hid"] = self.host_id
+        pkt["fid"] = fid
+        pkt["bcast"] = bcast
+        pkt["iter"] = step
+        pkt["exp"] = self.exp[fid]
+        # sums are narrowed back to the lane width like in agg_xdp.c
+        pkt["grads"][0] = grads.astype(pkt["grads"].dtype)
+        self._sock.sendto(pkt.tobytes(), self.addr_of(node_id))
+
+    def _broadcast(self, fid: int, step: int, grads: np.ndarray):
+        for idx, child_id in enumerate(self.children):
+            self._send(child_id, fid, idx + 1, step, grads)
+
+    def _aggregate(self, pkt):
+        host_id = int(pkt["hid"])
+        frag_id = int(pkt["fid"])
+        step = int(pkt["iter"])
+
+        if frag_id >= self.fragment_size:
+            return
+
+        # send back for pkt lost
+        if self.iter[frag_id] == step + 1 and host_id != self.host_id and \
+                (self.parent_num == 0 or host_id != self.parent_id):
+            self.stats[STAT_SERVED] += 1
+            self._send(host_id, frag_id, 0, step, self.grads[frag_id])
+            return
+
+        if self.iter[frag_id] != step:
+            return
+
+        reforward = self.childcnt[frag_id] > self.children_num and host_id != self.parent_id
+
+        # aggregation
+        if self.childcnt[frag_id] <= self.children_num:
+            self.lock[frag_id] = 1
+            if host_id < self.worker_num:
+                if self.hcheck[frag_id, host_id]:
+                    self.lock[frag_id] = 0
+                    self.stats[STAT_DUPLICATE] += 1
+                    return
+                self.hcheck[frag_id, host_id] = 1
+
+            if self.childcnt[frag_id] == 0:
+                self.exp[frag_id] = pkt["exp"]
+            elif self.exp[frag_id] != pkt["exp"]:
+                self.stats[STAT_EXP_MISMATCH] += 1
+
+            self.lgrads[frag_id] += pkt["grads"]
+            self.childcnt[frag_id] += 1
+            self.lock[frag_id] = 0
+
+        if self.childcnt[frag_id] < self.children_num + 1:
+            return
+
+        # parameter server to children
+        if self.host_id == self.parent_id:
+            self._finish(frag_id, self.lgrads[frag_id])
+            self._broadcast(frag_id, step, self.grads[frag_id])
+            return
+
+        # aggregator to children
+        if host_id == self.parent_id:
+            self.exp[frag_id] = pkt["exp"]
+            self._finish(frag_id, pkt["grads"])
+            self._broadcast(frag_id, step, self.grads[frag_id])
+            return
+
+        # children to parent
+        if self.parent_num > 0:
+            if reforward:
+                self.stats[STAT_REFORWARD] += 1
+            self._send(self.parent_id, frag_id, 0, step, self.lgrads[frag_id])
+
+    def _finish(self, frag_id: int, grads: np.ndarray):
+        self.lock[frag_id] = 1
+        self.childcnt[frag_id] = 0
+        self.iter[frag_id] += 1
+        self.hcheck[frag_id] = 0
+        self.grads[frag_id] = grads
+        self.lgrads[frag_id] = 0
+        self.lflag[frag_id] = 1
+        self.lock[frag_id] = 0
+        self.done.put((frag_id, int(self.iter[frag_id])))
+
+
+class UsrAggLib:
+    """Drop-in replacement for the ctypes handle of eBOT/agg_map_lib.so."""
+
+    def __init__(self, host_id: int, parent_id, children: list, worker_num: int,
+                 gradient_size: int, fragment_size: int, port: int,
+                 ip: str = LOOPBACK_IP, drop_rate: float = 0.0, lane_bits: int = 32,
+                 rcvbuf: int = RCVBUF_SIZE):
+        self.gradient_size = gradient_size
+        self.fragment_size = fragment_size
+        self.lane_bits = lane_bits
+        self._agg = UsrAggregator(host_id, parent_id, children, worker_num,
+                                  gradient_size, fragment_size, port, ip,
+                                  drop_rate, lane_bits, rcvbuf)
+        self._all_grads = np.zeros(fragment_size * gradient_size, dtype=np.int32)
+        self._updated = np.zeros(fragment_size, dtype=bool)
+        self._frag_first = 0
+        self._frag_count = fragment_size
+        self._polling_iter = None
+        self._dtype = payload_dtype(gradient_size, lane_bits)
+        self._sock = None
+        self._tx_exps = None
+        self._tx_mode = TX_MODE_SENDTO
+        self._tx_pps = 0.0
+        self._pool = []
+        self._pool_done = queue.Queue()
+        self._pacing_mode = PACING_OFF
+        self._pacing_rate = 0.0
+        self._pacing_offset = 0.0
+        self._tx_burst = 0
+        self._pacer = Pacer()
+        self._notify_spin = None
+        self._tx_grads = None
+        self._tx_step = None
+        self._retx_timeout = 0.0
+        self._retx_max_timeout = 0.0
+        self._retx_limit = 0
+        self._retx_stats = np.zeros(2, dtype=np.uint64)
+
+    @property
+    def aggregator(self) -> UsrAggregator:
+        return self._agg
+
+    def get_aggmap_fd(self) -> int:
+        return 0
+
+    def get_aggmap(self, agg_fd: int, frag_id: int) -> SimpleNamespace:
+        agg = self._agg
+        return SimpleNamespace(
+            lock=agg.lock[frag_id],
+            hcheck=agg.hcheck[frag_id].copy(),
+            lflag=agg.lflag[frag_id],
+            iter=agg.iter[frag_id],
+            childcnt=agg.childcnt[frag_id],
+            lgrads=agg.lgrads[frag_id].copy(),
+            grads=agg.grads[frag_id].copy(),
+        )
+
+    def init_map_reader(self, agg_fd: int) -> int:
+        # the userspace map lives in this process, polling copies out of it
+        return 0
+
+    def close_map_reader(self):
+        pass
+
+    def init_notifier(self, agg_fd: int, spin_us: int) -> int:
+        self._notify_spin = spin_us * 1e-6
+        return 0
+
+    def close_notifier(self):
+        self._notify_spin = None
+
+    def _wait_done(self, prev_iter: int, max_ready: int) -> np.ndarray:
+        agg = self._agg
+        frag_ids = []
+        spin_end = time.perf_counter() + self._notify_spin
+        while len(frag_ids) < max_ready:
+            try:
+                frag_id, it = agg.done.get_nowait()
+            except queue.Empty:
+                if frag_ids:
+                    break
+                if time.perf_counter() < spin_end:
+                    continue
+                try:
+                    frag_id, it = agg.done.get(timeout=DONE_TIMEOUT)
+                except queue.Empty:
+                    # quiet for a while, fall back to one sweep
+                    done = ~self._updated & (agg.lock == 0) & (agg.lflag == 1) & \
+                        (agg.iter == np.uint32(prev_iter + 1))
+                    return np.flatnonzero(done)[:max_ready]
+
+            if it == prev_iter + 1 and not self._updated[frag_id]:
+                frag_ids.append(frag_id)
+
+        return np.array(frag_ids, dtype=np.int64)
+
+    def set_lane_exponents(self, exps):
+        if exps is not None and not isinstance(exps, np.ndarray):
+            exps = np.ctypeslib.as_array(exps, shape=(self.fragment_size,))
+        self._tx_exps = exps
+
+    def set_fragment_range(self, first: int, count: int) -> int:
+        self._frag_first = min(max(0, first), self.fragment_size - 1)
+        self._frag_count = min(max(1, count), self.fragment_size - self._frag_first)
+        self._polling_iter = None
+        return self._frag_count
+
+    def set_fragment_count(self, count: int) -> int:
+        return self.set_fragment_range(0, count)
+
+    def init_retransmit(self, timeout_us: int, max_timeout_us: int, limit: int):
+        self._retx_timeout = timeout_us * 1e-6
+        self._retx_max_timeout = max(max_timeout_us, timeout_us) * 1e-6
+        self._retx_limit = limit
+
+    def get_retransmit_stats(self, out) -> int:
+        if not isinstance(out, np.ndarray):
+            out = np.ctypeslib.as_array(out, shape=(RETX_STAT_NUM,))
+        out[:2] = self._retx_stats
+        out[2:] = self._agg.stats
+        return RETX_STAT_NUM
+
+    def _arm_deadline(self, progressed: bool):
+        # before the first fragment is done a slow peer looks like a loss
+        self._retx_rounds = 0
+        timeout = self._retx_timeout if progressed else self._retx_max_timeout
+        self._retx_deadline = time.perf_counter() + timeout
+
+    def _check_deadline(self, prev_iter: int) -> int:
+        now = time.perf_counter()
+        if now < self._retx_deadline:
+            return 0
+
+        if self._retx_limit > 0 and self._retx_rounds >= self._retx_limit:
+            print(f"Iteration {prev_iter}: {int((~self._updated).sum())} fragments "
+                  f"lost after {self._retx_rounds} retransmits")
+            return -1
+
+        self._retx_stats[0] += 1
+        self._resend_missing(prev_iter)
+        timeout = self._retx_timeout * 2 ** min(self._retx_rounds + 1, 16)
+        self._retx_deadline = now + min(timeout, self._retx_max_timeout)
+        self._retx_rounds += 1
+        return 0
+
+    def _resend_missing(self, step: int):
+        if self._tx_grads is None or self._tx_step != step:
+            return
+
+        missing = np.flatnonzero(~self._updated)
+        for first, last in _runs(missing):
+            self._dispatch(step, self._tx_grads, first, last)
+        self._retx_stats[1] += len(missing)
+
+    def get_grads_buffer(self):
+        return self._all_grads.ctypes.data_as(POINTER(c_int))
+
+    def poll_fragments(self, agg_fd: int, prev_iter: int, ready, max_ready: int) -> int:
+        if self._polling_iter != prev_iter:
+            # fragments outside the active range never arrive, count them as done
+            self._updated.fill(True)
+            self._updated[self._frag_first:self._frag_first + self._frag_count] = False
+            self._polling_iter = prev_iter
+            self._arm_deadline(False)
+        if not isinstance(ready, np.ndarray):
+            ready = np.ctypeslib.as_array(ready, shape=(max_ready,))
+
+        agg = self._agg
+        all_grads = self._all_grads.reshape(self.fragment_size, self.gradient_size)
+        while not self._updated.all():
+            if self._notify_spin is not None:
+                frag_ids = self._wait_done(prev_iter, max_ready)
+            else:
+                done = ~self._updated & (agg.lock == 0) & (agg.lflag == 1) & \
+                    (agg.iter == np.uint32(prev_iter + 1))
+                frag_ids = np.flatnonzero(done)[:max_ready]
+            if len(frag_ids):
+                all_grads[frag_ids] = agg.grads[frag_ids]
+                agg.lflag[frag_ids] = 0
+                self._updated[frag_ids] = True
+                ready[:len(frag_ids)] = frag_ids
+                if self._retx_timeout > 0:
+                    self._arm_deadline(True)
+                return len(frag_ids)
+            if self._retx_timeout > 0 and self._check_deadline(prev_iter) < 0:
+                return -1
+            time.sleep(5e-6)
+
+        return 0
+
+    def busy_polling(self, agg_fd: int, prev_iter: int):
+        ready = np.zeros(self.fragment_size, dtype=np.int32)
+        while (count := self.poll_fragments(agg_fd, prev_iter, ready, self.fragment_size)) != 0:
+            if count < 0:
+                return None
+
+        return self.get_grads_buffer()
+
+    def init_socket(self, ifname) -> int:
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        return 0
+
+    def init_sender(self, mode: int, batch: int) -> int:
+        if self._sock is None:
+            print("Socket not initialized")
+            return -1
+
+        self._tx_headers = np.zeros(self.fragment_size, dtype=HEADER_DTYPE)
+        self._tx_headers["hid"] = self._agg.host_id
+        self._tx_headers["fid"] = np.arange(self.fragment_size)
+
+        if mode == TX_MODE_GSO:
+            try:
+                self._sock.setsockopt(SOL_UDP, UDP_SEGMENT, self._dtype.itemsize)
+            except OSError as e:
+                print(f"UDP_SEGMENT: {e}")
+                mode = TX_MODE_SENDMMSG
+
+        self._tx_mode = mode
+        self._tx_batch = max(1, batch)
+        return mode
+
+    def get_tx_pps(self) -> float:
+        return self._tx_pps
+
+    def send_all_fragments(self, step: int, grads) -> int:
+        return self.send_fragments(step, grads, self._frag_first, self._frag_count)
+
+    def send_fragments(self, step: int, grads, first: int, count: int) -> int:
+        if self._sock is None:
+            print("Socket not initialized")
+            return -1
+
+        if first < 0 or count <= 0 or first + count > self.fragment_size:
+            return -1
+        last = first + count
+
+        total_size = self.fragment_size * self.gradient_size
+        if not isinstance(grads, np.ndarray):
+            # the pointer type says int, the buffer holds lane_bits wide lanes
+            nbytes = total_size * self.lane_bits // 8
+            grads = np.ctypeslib.as_array(cast(grads, POINTER(c_uint8)), shape=(nbytes,))
+        grads = grads.view(LANE_DTYPES[self.lane_bits])
+        grads = grads.reshape(self.fragment_size, self.gradient_size)
+
+        # kept for retransmits until the iteration is done
+        self._tx_grads = grads
+        self._tx_step = step
+
+        start_time = time.perf_counter()
+        self._dispatch(step, grads, first, last)
+        elapsed = time.perf_counter() - start_time
+        if elapsed > 0:
+            self._tx_pps = count / elapsed
+
+        return 0
+
+    def _dispatch(self, step: int, grads: np.ndarray, first: int, last: int):
+        if len(self._pool) < 2 or last - first < TX_POOL_MIN:
+            self._transmit(self._sock, self._pacer, self._pacing_rate, step, grads, first, last)
+            return
+
+        # one contiguous shard per thread, like pool_transmit()
+        share = -(-(last - first) // len(self._pool))
+        for t, worker in enumerate(self._pool):
+            lo = min(first + t * share, last)
+            worker.jobs.put((step, grads, lo, min(lo + share, last)))
+        errors = [self._pool_done.get() for _ in self._pool]
+        error = next((e for e in errors if e is not None), None)
+        if error is not None:
+            raise error
+
+    def _tx_worker_loop(self, worker: SimpleNamespace):
+        if worker.cpu >= 0:
+            try:
+                os.sched_setaffinity(threading.get_native_id(), {worker.cpu})
+            except OSError as e:
+                print(f"Failed to pin sender thread to CPU {worker.cpu}: {e}")
+
+        while (job := worker.jobs.get()) is not None:
+            step, grads, first, last = job
+            error = None
+            start_time = time.perf_counter()
+            try:
+                if last > first:
+                    self._transmit(worker.sock, worker.pacer, self._pacing_rate / len(self._pool),
+                                   step, grads, first, last)
+            except OSError as e:
+                error = e
+            elapsed = time.perf_counter() - start_time
+            if error is None and last > first and elapsed > 0:
+                worker.pps = (last - first) / elapsed
+            self._pool_done.put(error)
+
+    def init_sender_pool(self, nthreads: int, cpus, ncpus: int) -> int:
+        self.close_sender_pool()
+        if self._sock is None:
+            print("Socket not initialized")
+            return -1
+
+        nthreads = min(nthreads, TX_THREADS_MAX)
+        if nthreads <= 1:
+            return 1
+
+        for t in range(nthreads):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if self._tx_mode == TX_MODE_GSO:
+                sock.setsockopt(SOL_UDP, UDP_SEGMENT, self._dtype.itemsize)
+            worker = SimpleNamespace(
+                sock=sock, cpu=cpus[t % ncpus] if ncpus > 0 else -1,
+                jobs=queue.Queue(), pps=0.0, pacer=Pacer(),
+            )
+            worker.thread = threading.Thread(
+                target=self._tx_worker_loop, args=(worker,), daemon=True
+            )
+            worker.thread.start()
+            self._pool.append(worker)
+
+        return nthreads
+
+    def close_sender_pool(self):
+        for worker in self._pool:
+            worker.jobs.put(None)
+        for worker in self._pool:
+            worker.thread.join()
+            worker.sock.close()
+        self._pool = []
+
+    def get_thread_pps(self, out, max_threads: int) -> int:
+        n = min(len(self._pool), max_threads)
+        for t in range(n):
+            out[t] = self._pool[t].pps
+        return n
+
+    def init_pacing(self, mode: int, rate_mbps: float, burst: int, slot: int, slots: int) -> int:
+        if self._sock is None:
+            print("Socket not initialized")
+            return -1
+
+        socks = [self._sock] + [worker.sock for worker in self._pool]
+        if mode == PACING_OFF or rate_mbps <= 0:
+            self._pacing_mode = PACING_OFF
+            self._pacing_rate = 0.0
+            self._pacing_offset = 0.0
+            for sock in socks:
+                _set_pacing_rate(sock, 2**64 - 1)
+            return PACING_OFF
+
+        burst = min(max(1, burst), TX_BATCH_MAX)
+        slots = max(1, slots)
+        self._pacing_rate = rate_mbps * 1e6 / 8
+        self._tx_burst = burst
+        burst_sec = burst * (self._dtype.itemsize + WIRE_OVERHEAD) / self._pacing_rate
+        self._pacing_offset = (slot % slots) * burst_sec / slots
+
+        if mode == PACING_FQ:
+            try:
+                _set_pacing_rate(self._sock, self._pacing_rate)
+                for worker in self._pool:
+                    _set_pacing_rate(worker.sock, self._pacing_rate / len(self._pool))
+            except OSError as e:
+                print(f"SO_MAX_PACING_RATE: {e}")
+                mode = PACING_BUCKET
+
+        self._pacing_mode = mode
+        return mode
+
+    def _transmit(self, sock: socket.socket, pacer: Pacer, rate: float, step: int,
+                  grads: np.ndarray, first: int, last: int):
+        dest_addr = self._agg.addr_of(self._agg.host_id)
+        packet_bytes = self._dtype.itemsize + WIRE_OVERHEAD
+        if self._pacing_mode != PACING_OFF:
+            pacer.start(rate if self._pacing_mode == PACING_BUCKET else 0.0,
+                        self._pacing_offset)
+            if self._pacing_mode == PACING_FQ:
+                _sleep_until(pacer.last)
+
+        if self._tx_mode == TX_MODE_SENDTO:
+            payload = np.zeros(1, dtype=self._dtype)
+            payload["hid"] = self._agg.host_id
+            payload["bcast"] = 0
+            payload["iter"] = step
+            for frag_id in range(first, last):
+                pacer.wait(packet_bytes)
+                payload["fid"] = frag_id
+                payload["exp"] = 0 if self._tx_exps is None else self._tx_exps[frag_id]
+                payload["grads"][0] = grads[frag_id]
+                sock.sendto(payload.tobytes(), dest_addr)
+            return
+
+        # python has no sendmmsg, so the batched modes gather prebuilt
+        # headers and grads per sendmsg() and GSO packs several of them
+        segs = 1
+        if self._tx_mode == TX_MODE_GSO:
+            segs = min(GSO_MAX_SEGS, GSO_MAX_BYTES // self._dtype.itemsize)
+        if self._pacing_mode == PACING_BUCKET:
+            segs = min(segs, self._tx_burst)
+        headers = self._tx_headers
+        headers["iter"][first:last] = step
+        if self._tx_exps is not None:
+            headers["exp"][first:last] = self._tx_exps[first:last]
+        for lo in range(first, last, segs):
+            hi = min(lo + segs, last)
+            bufs = []
+            for frag_id in range(lo, hi):
+                bufs += [headers[frag_id:frag_id+1], grads[frag_id]]
+            pacer.wait((hi - lo) * packet_bytes)
+            sock.sendmsg(bufs, [], 0, dest_addr)
+
+    def close_socket(self):
+        self.close_sender_pool()
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._agg.close()
+
+    def free_buffer(self, ptr):
+        pass
+
+
+def run_allreduce(rank: int, world_size: int, fanout: int, steps: int,
+                  gradient_size: int, fragment_size: int, port: int,
+                  tx_mode: int, drop_rate: float, tx_threads: int, barrier, results,
+                  pacing: tuple = (PACING_OFF, 0.0, 8), rcvbuf: int = RCVBUF_SIZE):
+    parent, children = tree_topology(rank, world_size, fanout)
+    lib = UsrAggLib(rank, parent, children, world_size,
+                    gradient_size, fragment_size, port, drop_rate=drop_rate, rcvbuf=rcvbuf)
+    lib.init_socket(b"lo")
+    lib.init_sender(tx_mode, 64)
+    lib.init_sender_pool(tx_threads, [], 0)
+    # siblings of the same parent take turns, like sibling_index/siblings
+    siblings = len(tree_topology(parent, world_size, fanout)[1]) if parent is not None else 1
+    lib.init_pacing(*pacing, (rank - 1) % fanout if parent is not None else 0, siblings)
+    lib.init_notifier(0, 50)
+    lib.init_retransmit(200000, 2000000, 0)
+    barrier.wait()
+
+    total_size = gradient_size * fragment_size
+    latencies = []
+    for step in range(steps):
+        grads = np.full(total_size, rank + step, dtype=np.int32)
+        expected = sum(r + step for r in range(world_size))
+
+        start_time = time.perf_counter()
+        lib.send_all_fragments(step, grads)
+        ptr = lib.busy_polling(0, step)
+        latencies.append(time.perf_counter() - start_time)
+
+        agg = np.ctypeslib.as_array(ptr, shape=(total_size,))
+        assert (agg == expected).all(), f"rank {rank} step {step}: wrong sum"
+        barrier.wait()
+
+    stats = np.zeros(RETX_STAT_NUM, dtype=np.uint64)
+    lib.get_retransmit_stats(stats)
+    thread_pps = [0.0] * TX_THREADS_MAX
+    thread_pps = thread_pps[:lib.get_thread_pps(thread_pps, TX_THREADS_MAX)]
+    lib.close_socket()
+    results[rank] = (latencies, lib.get_tx_pps(), thread_pps, stats.tolist())
+
+
+def main():
+    import multiprocessing as mp
+
+    world_size = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    fanout = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    tx_mode = int(sys.argv[3]) if len(sys.argv) > 3 else TX_MODE_GSO
+    drop_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    tx_threads = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+    steps, gradient_size, fragment_size, port = 10, 350, 1000, 41234
+
+    manager = mp.Manager()
+    results = manager.dict()
+    barrier = mp.Barrier(world_size)
+    procs = [
+        mp.Process(target=run_allreduce, args=(rank, world_size, fanout, steps,
+                   gradient_size, fragment_size, port, tx_mode, drop_rate, tx_threads,
+                   barrier, results))
+        for rank in range(world_size)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    for rank in sorted(results.keys()):
+        latencies, tx_pps, thread_pps, stats = results[rank]
+        lat = np.array(latencies)
+        print(
+            f"Rank {rank}: "
+            f"p50 {np.percentile(lat, 50)*1e3:.3f}ms, "
+            f"p99 {np.percentile(lat, 99)*1e3:.3f}ms, "
+            f"tx {tx_pps:,.0f} pkt/s, "
+            f"timeouts {stats[0]}, resent {stats[1]}, served {stats[2]}, "
+            f"reforwarded {stats[3]}, duplicates {stats[4]}, "
+            f"exp mismatches {stats[5]}"
+        )
+        if thread_pps:
+            print("  threads: " + ", ".join(f"{pps:,.0f}" for pps in thread_pps) + " pkt/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,19 @@
 import os
 import json
 import io
+import math
+
+# IPv4 + UDP + agg_payload header in front of the gradient lanes
+PACKET_OVERHEAD = 20 + 8 + 20
+# lanes per packet the verifier still accepts for the aggregator() loops
+MAX_GRADIENT_SIZE = 2048
+# fragments after the model's that EbpfWorker.all_reduce_counts reduces
+COUNT_FRAGMENTS = 1
+# printed by worker.py under an agent once it can start training
+WORKER_READY = "@@worker_ready"
+# per-step timing line of worker.py under an agent: STEP_RECORD, then STEP_FIELDS
+STEP_RECORD = "@@step"
+STEP_FIELDS = ("rank", "step", "compute", "push", "wait", "bytes")
 
 
 def load_config(fname: str) -> dict:
@@ -11,65 +24,93 @@ def load_config(fname: str) -> dict:
     except json.JSONDecodeError:
         return content
 
-def evaluate(model, test_loader):
+
+def read_mtu(ifname: str) -> int:
+    with open(f"/sys/class/net/{ifname}/mtu", "r") as f:
+        return int(f.read())
+
+
+def read_link_speed(ifname: str):
+    """Link speed in Mbit/s, None when the driver does not report one."""
+    try:
+        with open(f"/sys/class/net/{ifname}/speed", "r") as f:
+            speed = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return speed if speed > 0 else None
+
+
+def format_step_record(rank: int, step: int, compute: float, push: float, wait: float,
+                       nbytes: int) -> str:
+    return f"{STEP_RECORD} {rank} {step} {compute:.6f} {push:.6f} {wait:.6f} {nbytes}"
+
+
+def parse_step_record(line: str) -> list:
+    """Values of a format_step_record line, in STEP_FIELDS order."""
+    rank, step, compute, push, wait, nbytes = line.split()[1:]
+    return [int(rank), int(step), float(compute), float(push), float(wait), int(nbytes)]
+
+
+def gradient_size_for_mtu(mtu: int, lane_bits: int = 32,
+                          max_gradient_size: int = MAX_GRADIENT_SIZE) -> int:
+    """Largest number of lanes whose packet still fits into one MTU."""
+    return min((mtu - PACKET_OVERHEAD) * 8 // lane_bits, max_gradient_size)
+
+
+def fragment_count(param_count: int, gradient_size: int, fragment_size="auto") -> int:
+    """Fragments needed for param_count gradients and the COUNT_FRAGMENTS of
+    the evaluation counts, checking a fixed fragment_size."""
+    needed = math.ceil(param_count / gradient_size) + COUNT_FRAGMENTS
+    if fragment_size == "auto":
+        return needed
+    if fragment_size < needed:
+        raise ValueError(
+            f"{param_count} parameters and the evaluation counts need {needed} fragments, "
+            f"fragment_size is {fragment_size}"
+        )
+    return fragment_size
+
+def evaluate(model, test_loader, worker=None, step: int = 0) -> float:
+    """Accuracy in percent over test_loader. With a worker, every rank scores
+    its own shard and the counts are summed through the worker's backend,
+    `step` being the round of the worker's next aggregate()."""
     import torch
     model.eval()
+    device = next(model.parameters()).device
     correct = 0
     total = 0
-    with torch.no_grad():
-        for batch_idx, (data, target) in enumerate(test_loader):
-            # This is only set to finish evaluation faster.
-            if batch_idx * len(data) > 1024:
-                break
-            
-            outputs = model(data)
-            _, predicted = torch.max(outputs.data, 1)
+    with torch.inference_mode():
+        for data, target in test_loader:
+            outputs = model(data.to(device))
+            correct += (outputs.argmax(dim=1) == target.to(device)).sum().item()
             total += target.size(0)
-            correct += (predicted == target).sum().item()
-        
+    model.train()
+
+    if worker is not None:
+        correct, total = worker.all_reduce_counts(step, [correct, total])
     return 100.0 * correct / total
 
-def prepare_data(data_type: str, rank: int, world_size: int):
-    import torch
-    from torchvision import datasets, transforms
-    from torch.utils.data import DataLoader, Dataset
-    from filelock import FileLock
-    
-    with FileLock(os.path.expanduser("~/data.lock")):
-        batch_size = 16
-        if data_type == "mnist":
-            transform = transforms.Compose([
-                transforms.ToTensor(), 
-                transforms.Normalize((0.1307,), (0.3081,))
-            ])
-            full_dataset = datasets.MNIST("~/data", train=True, download=True, transform=transform)
-            test_dataset = datasets.MNIST("~/data", train=False, transform=transform)
-        elif data_type == "cifar10":
-            transform = transforms.Compose([
-                transforms.Resize(224),
-                transforms.ToTensor(),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-            ])
-            full_dataset = datasets.CIFAR10("~/data", train=True, download=True, transform=transform)
-            test_dataset = datasets.CIFAR10("~/data", train=False, transform=transform)
-        
-        sampler = torch.utils.data.distributed.DistributedSampler(
-            full_dataset,
-            num_replicas=world_size,
-            rank=rank
-        )
-        dataloader = DataLoader(
-            full_dataset,
-            batch_size=batch_size,
-            sampler=sampler,
-            shuffle=False
-        )
-        testloader = DataLoader(
-            test_dataset,
-            batch_size=batch_size,
-            shuffle=False,
-        )
-    
+def prepare_data(data_type: str, rank: int, world_size: int, batch_size: int = 16,
+                 num_workers: int = 0, pin_memory: bool = False, prefetch_factor: int = 2,
+                 data_dir: str = "~/data", eval_batch_size: int = 128,
+                 eval_sharded: bool = True):
+    """Training loader over the shard of rank and the test loader over the
+    test shard of rank (the whole test set unless eval_sharded), both read
+    from the preprocessed cache of datacache."""
+    from datacache import MemmapBatches, distributed_loader, shard_loader
+
+    loader_args = {
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+        "prefetch_factor": prefetch_factor,
+    }
+    full_dataset = MemmapBatches(data_type, data_dir, train=True)
+    test_dataset = MemmapBatches(data_type, data_dir, train=False)
+    dataloader = distributed_loader(full_dataset, rank, world_size, batch_size, **loader_args)
+    if eval_sharded:
+        testloader = shard_loader(test_dataset, rank, world_size, eval_batch_size, **loader_args)
+    else:
+        testloader = shard_loader(test_dataset, 0, 1, eval_batch_size, **loader_args)
     return dataloader, testloader
 
 def print_model_info(model):
@@ -6,9 +6,10 @@ import torch.nn as nn
 import torch.optim as optim
 from dotenv import load_dotenv
 
-from utils import evaluate, load_config, prepare_data
-from models import ConvNet, SimpleCNN, ResNet18, ResNet52
-from workers import EbpfWorker, TorchDDPWorker, TorchTCPWorker
+from utils import WORKER_READY, evaluate, format_step_record, load_config, prepare_data
+from profiler import profiler
+from models import MODEL_CLASSES
+from workers import EbpfWorker, TorchDDPWorker, TorchTCPWorker, UsrEbpfWorker
 
 load_dotenv()
 
@@ -17,22 +18,39 @@ master_port = 29500
 
 config = load_config("local_config.json")
 
-rank = config["id"]
-world_size = config["worker_num"]
+rank = int(os.getenv("RANK", config["id"]))
+world_size = int(os.getenv("WORLD_SIZE", config["worker_num"]))
 model_type = config["model_type"]
 learning_rate = config["learning_rate"]
+grad_arena = config.get("grad_arena", False)
+profile = config.get("profile", False)
+profile_dir = config.get("profile_dir", "profile")
+batch_size = config.get("batch_size", 16)
+data_workers = config.get("data_workers", 2)
+prefetch_factor = config.get("prefetch_factor", 2)
+pin_memory = config.get("pin_memory", "auto")
+data_dir = config.get("data_dir", "~/data")
+eval_mode = config.get("eval_mode", "sharded")
+eval_batch_size = config.get("eval_batch_size", 128)
 
 worker_type = sys.argv[1]
+# under an agent, every step is reported for the coordinator's telemetry
+telemetry = bool(os.getenv("AGENT_TELEMETRY"))
+
+
+def wait_for_release():
+    """Under an agent, reports readiness and blocks until the coordinator
+    has seen every node ready."""
+    if os.getenv("AGENT_BARRIER"):
+        print(WORKER_READY, flush=True)
+        sys.stdin.readline()
 
 
 if __name__ == "__main__":
     torch.manual_seed(42 + rank)
+    if profile:
+        profiler.enable()
 
-    MODEL_CLASSES = {
-        "convnet": ConvNet,
-        "resnet18": ResNet18,
-        "resnet52": ResNet52
-    }
     DATASETS = {
         "convnet": "mnist",
         "resnet18": "cifar10",
@@ -41,13 +59,26 @@ if __name__ == "__main__":
     WORKER_CLASSES = {
         "ebpf": EbpfWorker,
         "torch_ddp": TorchDDPWorker,
-        "torch_tcp": TorchTCPWorker
+        "torch_tcp": TorchTCPWorker,
+        "ebpf_usr": UsrEbpfWorker
     }
 
     model_class = MODEL_CLASSES[model_type]()
-    dataloader, testloader = prepare_data(DATASETS[model_type], rank, world_size)
+    if grad_arena:
+        model_class.enable_grad_arena()
+    if pin_memory == "auto":
+        pin_memory = torch.cuda.is_available()
+    dataloader, testloader = prepare_data(
+        DATASETS[model_type], rank, world_size, batch_size,
+        num_workers=data_workers, pin_memory=pin_memory, prefetch_factor=prefetch_factor,
+        data_dir=data_dir, eval_batch_size=eval_batch_size,
+        eval_sharded=eval_mode == "sharded",
+    )
     worker = WORKER_CLASSES[worker_type](model_class)
+    # workers may switch the arena on themselves (e.g. gradient buckets)
+    grad_arena = model_class.grad_arena is not None
 
+    wait_for_release()
     device = worker.setup(rank, world_size, master_ip, master_port)
     
     model = worker.model
@@ -57,24 +88,46 @@ if __name__ == "__main__":
     print("Running synchronous parameter server training.")
 
     epochs = 1
+    # rounds of the backend, counted across epochs: the aggregator only
+    # accepts each one once
+    step = 0
     for epoch in range(epochs):
         total_loss = 0.0
         total_time = 0.0
 
-        for batch_idx, (inputs, labels) in enumerate(dataloader):
+        for batch_idx, (inputs, labels) in enumerate(profiler.iterate("data", dataloader)):
             start_time = time.perf_counter()
             
-            inputs, labels = inputs.to(device), labels.to(device)
-            optimizer.zero_grad()
-            model.zero_grad()
-            outputs = model(inputs)
-            
-            loss = criterion(outputs, labels)
-            loss.backward()
-
-            worker.aggregate(batch_idx)
-
-            optimizer.step()
+            # pinned batches are copied while the forward pass is queued
+            inputs = inputs.to(device, non_blocking=pin_memory)
+            labels = labels.to(device, non_blocking=pin_memory)
+            # zero in place so p.grad stays a view into the arena
+            optimizer.zero_grad(set_to_none=not grad_arena)
+            model.zero_grad(set_to_none=not grad_arena)
+            with profiler.phase("forward"):
+                outputs = model(inputs)
+                loss = criterion(outputs, labels)
+
+            with profiler.phase("backward"):
+                loss.backward()
+
+            backward_time = time.perf_counter()
+            with profiler.phase("aggregate"):
+                worker.aggregate(step)
+            aggregate_time = time.perf_counter()
+
+            with profiler.phase("optimizer_step"):
+                optimizer.step()
+            profiler.record("step", start_time, time.perf_counter())
+
+            if telemetry:
+                comm = aggregate_time - backward_time
+                compute = time.perf_counter() - start_time - comm
+                print(format_step_record(
+                    rank, step, compute, worker.push_time, comm - worker.push_time,
+                    worker.bytes_per_step,
+                ), flush=True)
+            step += 1
 
             total_loss += loss.item()
             avg_loss = total_loss / len(dataloader)
@@ -90,11 +143,31 @@ if __name__ == "__main__":
                     f"Elapsed time: {elapsed:.6f}s"
                  )
 
+        if rank == 0 and hasattr(worker, "tx_pps"):
+            print(f"Last push: {worker.tx_pps:,.0f} packets/s")
+            for i, pps in enumerate(getattr(worker, "tx_thread_pps", [])):
+                print(f"  sender thread {i}: {pps:,.0f} packets/s")
+
+        if hasattr(worker, "retransmit_stats"):
+            stats = ", ".join(f"{k}: {v}" for k, v in worker.retransmit_stats.items())
+            print(f"Rank {rank} retransmits: {stats}")
+
+        with profiler.phase("evaluate"):
+            if eval_mode == "sharded":
+                accuracy = evaluate(model, testloader, worker, step)
+            elif rank == 0:
+                accuracy = evaluate(model, testloader)
         if rank == 0:
-            accuracy = evaluate(model, testloader)
             print(
                     f"Epoch [{epoch+1}/{epochs}] "
                     f"Average Loss: {avg_loss:.4f}, "
                     f"Accuracy: {accuracy:.6f}, "
                     f"Avg. Batch Time: {avg_time:.6f}s"
                  )
+
+    if profile:
+        os.makedirs(profile_dir, exist_ok=True)
+        trace_path = os.path.join(profile_dir, f"trace-rank{rank}.json")
+        profiler.export_chrome_trace(trace_path, pid=rank)
+        print(f"Rank {rank} profile, trace in {trace_path}:")
+        print(profiler.summary())
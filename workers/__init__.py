@@ -2,3 +2,4 @@ from .base_worker import BaseWorker
 from .ebpf_worker import EbpfWorker
 from .torch_ddp_worker import TorchDDPWorker
 from .torch_tcp_worker import TorchTCPWorker
+from .usr_ebpf_worker import UsrEbpfWorker
@@ -1,15 +1,38 @@
 from abc import ABC, abstractmethod
+import torch
+import torch.distributed as dist
 from models import BaseModel
 
 
 class BaseWorker(ABC):
     def __init__(self, model: BaseModel):
         self._model = model
+        # seconds the last aggregate() spent sending, the rest was waiting
+        self.push_time = 0.0
 
     @property
     def model(self) -> BaseModel:
         return self._model
 
+    @property
+    def bytes_per_step(self) -> int:
+        """Gradient bytes this worker contributes to every all-reduce."""
+        return sum(
+            p.numel() * p.element_size() for p in self._model.parameters() if p.requires_grad
+        )
+
+    def all_reduce_counts(self, step: int, counts: list) -> list:
+        """Sums non-negative integers over all workers, e.g. for evaluation.
+
+        `step` is the round of the next aggregate(), which the counts must
+        not use up: the eBPF backends sum them on fragments of their own.
+        The torch backends reduce on their process group.
+        """
+        device = next(self._model.parameters()).device
+        totals = torch.tensor(counts, dtype=torch.int64, device=device)
+        dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+        return totals.tolist()
+
     @abstractmethod
     def aggregate(self, step: int):
         pass
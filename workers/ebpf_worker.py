@@ -1,17 +1,21 @@
+import math
 import time
 import struct
 import socket
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 
-from ctypes import cdll, cast, c_bool, c_int, c_void_p, c_char_p,\
-    Structure, POINTER
-from utils import evaluate, load_config, prepare_data
+from ctypes import cdll, cast, c_bool, c_int, c_double, c_size_t, c_uint8,\
+    c_uint64, c_void_p, c_char_p, Structure, POINTER
+from utils import PACKET_OVERHEAD, evaluate, load_config, prepare_data
+from profiler import profiler
 from workers import BaseWorker
 from models import BaseModel
+from quantizer import BlockQuantizer, FixedPointQuantizer
 
 config = load_config("local_config.json")
 
@@ -19,7 +23,30 @@ WORKER_NUM = config["worker_num"]
 GRADIENT_SIZE = config["gradient_size"]
 FRAGMENT_SIZE = config["fragment_size"]
 SCALE_FACTOR = config["scale_factor"]
-ifname = "ens3"
+ifname = config.get("ifname", "ens3")
+
+MAP_READ_MMAP = 2
+NOTIFY = config.get("notify", False)
+NOTIFY_SPIN_US = config.get("notify_spin_us", 50)
+TX_MODE = config.get("tx_mode", "sendto")
+TX_BATCH = config.get("tx_batch", 64)
+TX_THREADS = config.get("tx_threads", 1)
+TX_CPUS = config.get("tx_cpus", [])
+TX_THREADS_MAX = 64
+PACING = config.get("pacing", "off")
+PACING_RATE_MBPS = config.get("pacing_rate_mbps", 0)
+PACING_BURST = config.get("pacing_burst", 8)
+BUCKET_FRAGMENTS = config.get("bucket_fragments", 0)
+LANE_BITS = config.get("lane_bits", 32)
+LANE_EXP = config.get("lane_exp", 16)
+ERROR_FEEDBACK = config.get("error_feedback", False)
+RETRANSMIT_TIMEOUT_US = config.get("retransmit_timeout_us", 0)
+RETRANSMIT_MAX_TIMEOUT_US = config.get("retransmit_max_timeout_us", 0)
+RETRANSMIT_LIMIT = config.get("retransmit_limit", 0)
+# counters filled by get_retransmit_stats, worker side first
+RETRANSMIT_STATS = (
+    "timeouts", "resent", "served", "reforwarded", "duplicates", "exp_mismatches"
+)
 
 
 class AggregatorMap(Structure):
@@ -31,13 +58,47 @@ class AggregatorMap(Structure):
                     ("childcnt", c_int), 
                     ("lgrads", c_int * GRADIENT_SIZE),
                     ("grads", c_int * GRADIENT_SIZE),
+                    ("exp", c_int),
                 ]
 
 
+def fragment_ranges(frag_ids: np.ndarray) -> list:
+    """Coalesces fragment ids into sorted [first, last + 1) runs."""
+    frag_ids = np.sort(frag_ids)
+    breaks = np.flatnonzero(np.diff(frag_ids) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(frag_ids)]))
+    return [(int(frag_ids[i]), int(frag_ids[j-1]) + 1) for i, j in zip(starts, ends)]
+
+
 class EbpfWorker(BaseWorker):
-    
+    # the TC egress hook redirects packets before a root fq qdisc sees them,
+    # and before GSO super-packets are segmented
+    PACING_MODES = {"off": 0, "bucket": 1}
+    TX_MODES = {"sendto": 0, "sendmmsg": 1}
+
     def __init__(self, model: BaseModel, clib_path: str = "./eBOT/agg_map_lib.so"):
         super().__init__(model)
+        num_gradients = model.num_gradients
+        if num_gradients > FRAGMENT_SIZE * GRADIENT_SIZE:
+            raise ValueError(
+                f"{num_gradients} gradients do not fit into {FRAGMENT_SIZE} fragments"
+            )
+        # fragments past the model's gradients are never sent
+        self._num_fragments = max(1, math.ceil(num_gradients / GRADIENT_SIZE))
+        # all_reduce_counts runs on the fragments after them, which count
+        # their own iterations
+        self._count_step = 0
+
+        self._init_quantizer(WORKER_NUM)
+        self._buckets = None
+        if BUCKET_FRAGMENTS > 0:
+            self._init_buckets(BUCKET_FRAGMENTS)
+
+        self._clib = None
+        if clib_path is None:
+            return
+
         self._clib = cdll.LoadLibrary(clib_path)
         self._clib.get_aggmap.argtypes = [c_int, c_int]
         self._clib.get_aggmap.restype = AggregatorMap
@@ -51,51 +112,390 @@ class EbpfWorker(BaseWorker):
         self._clib.send_all_fragments.argtypes = [c_int, POINTER(c_int)]
         self._clib.send_all_fragments.restype = c_int
 
-        # init
+        self._clib.send_fragments.argtypes = [c_int, POINTER(c_int), c_int, c_int]
+        self._clib.send_fragments.restype = c_int
+
+        self._clib.get_grads_buffer.argtypes = []
+        self._clib.get_grads_buffer.restype = POINTER(c_int)
+
+        self._clib.poll_fragments.argtypes = [c_int, c_int, POINTER(c_int), c_int]
+        self._clib.poll_fragments.restype = c_int
+
+        self._clib.init_sender.argtypes = [c_int, c_int]
+        self._clib.init_sender.restype = c_int
+
+        self._clib.get_tx_pps.argtypes = []
+        self._clib.get_tx_pps.restype = c_double
+
+        self._clib.init_map_reader.argtypes = [c_int]
+        self._clib.init_map_reader.restype = c_int
+
+        self._clib.get_aggmap_mmap.argtypes = []
+        self._clib.get_aggmap_mmap.restype = c_void_p
+
+        self._clib.get_aggmap_stride.argtypes = []
+        self._clib.get_aggmap_stride.restype = c_size_t
+
+        self._clib.init_notifier.argtypes = [c_int, c_int]
+        self._clib.init_notifier.restype = c_int
+
+        self._clib.set_lane_exponents.argtypes = [POINTER(c_int)]
+        self._clib.set_lane_exponents.restype = None
+
+        self._clib.set_fragment_count.argtypes = [c_int]
+        self._clib.set_fragment_count.restype = c_int
+
+        self._clib.set_fragment_range.argtypes = [c_int, c_int]
+        self._clib.set_fragment_range.restype = c_int
+
+        self._clib.init_retransmit.argtypes = [c_int, c_int, c_int]
+        self._clib.init_retransmit.restype = None
+
+        self._clib.get_retransmit_stats.argtypes = [POINTER(c_uint64)]
+        self._clib.get_retransmit_stats.restype = c_int
+
+        self._clib.init_sender_pool.argtypes = [c_int, POINTER(c_int), c_int]
+        self._clib.init_sender_pool.restype = c_int
+
+        self._clib.get_thread_pps.argtypes = [POINTER(c_double), c_int]
+        self._clib.get_thread_pps.restype = c_int
+
+        self._clib.init_pacing.argtypes = [c_int, c_double, c_int, c_int, c_int]
+        self._clib.init_pacing.restype = c_int
+
+        self._init_clib()
+
+    def _init_quantizer(self, world_size: int):
+        """Sizes the lane headroom, the averaging divisor and the digits of
+        all_reduce_counts for world_size workers."""
+        self._world_size = world_size
+        if LANE_BITS < 32:
+            self._quantizer = BlockQuantizer(
+                GRADIENT_SIZE, FRAGMENT_SIZE, LANE_BITS, world_size, LANE_EXP,
+                error_feedback=ERROR_FEEDBACK,
+            )
+        else:
+            self._quantizer = FixedPointQuantizer(
+                FRAGMENT_SIZE * GRADIENT_SIZE, SCALE_FACTOR,
+                worker_num=world_size, error_feedback=ERROR_FEEDBACK,
+            )
+
+    def __del__(self):
+        if self._clib is not None:
+            self._clib.close_notifier()
+            self._clib.close_map_reader()
+            self._clib.close_socket()
+
+    def _init_clib(self):
         self._clib.init_socket(ifname.encode("utf-8"))
+
+        tx_mode = TX_MODE
+        if tx_mode not in self.TX_MODES:
+            print(f"tx_mode {tx_mode} does not apply to this worker, using sendmmsg")
+            tx_mode = "sendmmsg"
+        mode = self._clib.init_sender(self.TX_MODES[tx_mode], TX_BATCH)
+        if mode != self.TX_MODES[tx_mode]:
+            print(f"tx_mode {tx_mode} unavailable, using mode {mode}")
+
+        if TX_THREADS > 1:
+            cpus = (c_int * len(TX_CPUS))(*TX_CPUS)
+            threads = self._clib.init_sender_pool(TX_THREADS, cpus, len(TX_CPUS))
+            if threads != TX_THREADS:
+                print(f"Started {threads} of {TX_THREADS} sender threads")
+
+        if PACING != "off":
+            pacing = PACING
+            if pacing not in self.PACING_MODES:
+                print(f"pacing {pacing} does not apply to this worker, using bucket")
+                pacing = "bucket"
+            # "auto" is resolved by the agent, unresolved it means unpaced
+            rate = PACING_RATE_MBPS if PACING_RATE_MBPS != "auto" else 0
+            mode = self._clib.init_pacing(
+                self.PACING_MODES[pacing], rate, PACING_BURST,
+                config.get("sibling_index", 0), config.get("siblings", 1),
+            )
+            if mode != self.PACING_MODES[pacing]:
+                print(f"pacing {pacing} unavailable, using mode {mode}")
+
+        self._clib.set_fragment_count(self._num_fragments)
+        if LANE_BITS < 32:
+            exps = self._quantizer.exponents
+            self._clib.set_lane_exponents(cast(c_void_p(exps.data_ptr()), POINTER(c_int)))
+
         self._aggmap_fd = self._clib.get_aggmap_fd()
+        self._map_grads = None
+        if self._clib.init_map_reader(self._aggmap_fd) == MAP_READ_MMAP:
+            self._map_grads = self._view_aggmap_grads()
+
+        if NOTIFY and self._clib.init_notifier(self._aggmap_fd, NOTIFY_SPIN_US) < 0:
+            print("Completion notifications unavailable, polling aggregator_map")
+
+        self._clib.init_retransmit(
+            RETRANSMIT_TIMEOUT_US, RETRANSMIT_MAX_TIMEOUT_US, RETRANSMIT_LIMIT
+        )
+
+    def _view_aggmap_grads(self) -> torch.Tensor:
+        """Views the grads of every fragment in the mmaped aggregator_map."""
+        stride = self._clib.get_aggmap_stride()
+        raw = (c_uint8 * (stride * FRAGMENT_SIZE)).from_address(self._clib.get_aggmap_mmap())
+        dtype = np.dtype({
+            "names": ["grads"],
+            "formats": [(np.int32, (GRADIENT_SIZE,))],
+            "offsets": [AggregatorMap.grads.offset],
+            "itemsize": stride,
+        })
+        aggmap = np.ndarray(shape=(FRAGMENT_SIZE,), dtype=dtype, buffer=raw)
+        return torch.from_numpy(aggmap["grads"])
+
+    @property
+    def num_fragments(self) -> int:
+        """Fragments sent per step, the model's gradients rounded up."""
+        return self._num_fragments
+
+    @property
+    def bytes_per_step(self) -> int:
+        """Bytes sent per step, packet headers included."""
+        return self._num_fragments * (GRADIENT_SIZE * LANE_BITS // 8 + PACKET_OVERHEAD)
+
+    @property
+    def tx_pps(self) -> float:
+        """Packets per second of the last send_all_fragments call."""
+        return self._clib.get_tx_pps()
+
+    @property
+    def tx_thread_pps(self) -> list:
+        """Packets per second of every sender thread during its last shard."""
+        pps = (c_double * TX_THREADS_MAX)()
+        n = self._clib.get_thread_pps(pps, TX_THREADS_MAX)
+        return list(pps[:n])
+
+    @property
+    def retransmit_stats(self) -> dict:
+        """Retransmit counters of this worker and its local aggregator."""
+        stats = (c_uint64 * len(RETRANSMIT_STATS))()
+        self._clib.get_retransmit_stats(stats)
+        return dict(zip(RETRANSMIT_STATS, stats))
 
-    def __del__(self):
-        self._clib.close_socket()
-    
     def setup(self, rank: int, world_size: int, master_ip: str, master_port: int) -> str:
+        # agg_xdp.c is built for worker_num children in total
+        if world_size != WORKER_NUM:
+            raise ValueError(
+                f"WORLD_SIZE {world_size} does not match worker_num {WORKER_NUM} "
+                "of the attached eBPF programs"
+            )
         return torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     def prepare_gradients(self, grads: torch.Tensor) -> torch.Tensor:
-        grads *= SCALE_FACTOR
-        grads = torch.clamp(grads, -2**31, 2**31 - 1)
-        grads_int32 = grads.to(torch.int32)
-
-        total_size = FRAGMENT_SIZE * GRADIENT_SIZE
-        if grads_int32.numel() < total_size:
-            pad_size = total_size - grads_int32.numel()
-            grads_int32 = torch.nn.functional.pad(grads_int32, (0, pad_size))
-
-        return grads_int32
+        with profiler.phase("prepare_gradients"):
+            return self._quantizer.quantize(grads)
         
-    def pull(self, step: int) -> torch.Tensor:
-        ptr = self._clib.busy_polling(self._aggmap_fd, step) # point to the same addr
-        if not hasattr(self, "_grad_buf"):
+    def _wrap_agg_buf(self, ptr):
+        if not hasattr(self, "_agg_buf"):
             total_size = FRAGMENT_SIZE * GRADIENT_SIZE
             np_arr = np.ctypeslib.as_array(ptr, shape=(total_size,))
             np_arr = np_arr.view(np.int32)
-            self._grad_buf = torch.from_numpy(np_arr)
-        return self._grad_buf.to(torch.float32) / SCALE_FACTOR 
+            self._agg_buf = torch.from_numpy(np_arr)
+        return self._agg_buf
+
+    def pull(self, step: int, out: torch.Tensor = None, divisor: float = 1.0) -> torch.Tensor:
+        with profiler.phase("busy_polling"):
+            ptr = self._clib.busy_polling(self._aggmap_fd, step) # point to the same addr
+        if not ptr:
+            raise RuntimeError(f"Step {step}: fragments lost after {RETRANSMIT_LIMIT} retransmits")
+        agg_buf = self._wrap_agg_buf(ptr)
+        if out is None:
+            out = torch.empty(self._num_fragments * GRADIENT_SIZE, dtype=torch.float32)
+        with profiler.phase("dequantize"):
+            return self._quantizer.dequantize(agg_buf, out, divisor)
+
+    def pull_stream(self, step: int, out: torch.Tensor, divisor: float = 1.0):
+        """Yields (start, end) ranges of `out` as soon as they are aggregated.
+
+        Each range is already dequantized when it is yielded, so callers can
+        copy it into the model (or step the optimizer for the parameters it
+        covers) while the remaining fragments are still on the wire.
+        """
+        # fragments are dequantized straight out of the map when it is mmaped
+        agg_buf = self._map_grads
+        if agg_buf is None:
+            agg_buf = self._wrap_agg_buf(self._clib.get_grads_buffer())
+            agg_buf = agg_buf.view(FRAGMENT_SIZE, GRADIENT_SIZE)
+        if not hasattr(self, "_ready"):
+            self._ready = np.zeros(FRAGMENT_SIZE, dtype=np.int32)
+            self._ready_c = self._ready.ctypes.data_as(POINTER(c_int))
+
+        numel = out.numel()
+        while True:
+            with profiler.phase("busy_polling"):
+                count = self._clib.poll_fragments(
+                    self._aggmap_fd, step, self._ready_c, FRAGMENT_SIZE
+                )
+            if count < 0:
+                raise RuntimeError(f"Step {step}: fragments lost after {RETRANSMIT_LIMIT} retransmits")
+            if count == 0:
+                break
+            profiler.count("fragments_polled", count)
+
+            for first, last in fragment_ranges(self._ready[:count]):
+                start = first * GRADIENT_SIZE
+                end = min(last * GRADIENT_SIZE, numel)
+                if start >= end:
+                    continue
+                with profiler.phase("dequantize"):
+                    self._quantizer.dequantize(agg_buf, out, divisor, start, end)
+                yield start, end
     
     def push(self, step: int, grads: torch.Tensor):
         ptr = grads.data_ptr()
         grads_c = cast(c_void_p(ptr), POINTER(c_int))
-        self._clib.send_all_fragments(step, grads_c)
+        with profiler.phase("send_all_fragments"):
+            self._clib.send_all_fragments(step, grads_c)
 
-    def all_reduce(self, step: int, grads: torch.Tensor) -> torch.Tensor:
+    def all_reduce(self, step: int, grads: torch.Tensor, out: torch.Tensor = None,
+                   divisor: float = 1.0) -> torch.Tensor:
         grads_int32 = self.prepare_gradients(grads)
         self.push(step, grads_int32)
-        return self.pull(step)
+        return self.pull(step, out, divisor)
 
-    def aggregate(self, step: int):
-        grads_flat = self._model.get_gradients()
-        agg_buf = self.all_reduce(step, grads_flat)
-        agg_buf.div_(WORKER_NUM)
-        self._model.set_gradients(agg_buf)
+    def all_reduce_counts(self, step: int, counts: list) -> list:
+        """Sums non-negative integers over all workers on the aggregation path.
+
+        The counts bypass the quantizer and are written straight into the
+        staging buffer as digits small enough that the sum over all workers
+        still fits a lane, since sums travel the tree narrowed to lane_bits.
+        Only the fragments after the model's are sent, under iteration
+        numbers of their own, so `step` and the rounds of aggregate() are
+        left alone.
+        """
+        base = (2 ** (LANE_BITS - 1) - 1) // self._world_size + 1
+        num_digits = 1
+        while base ** num_digits < 2 ** 31:
+            num_digits += 1
+        lanes = [count // base ** i % base for count in counts for i in range(num_digits)]
 
+        first = self._num_fragments
+        count = math.ceil(len(lanes) / GRADIENT_SIZE)
+        if first + count > FRAGMENT_SIZE:
+            raise ValueError(
+                f"fragment_size {FRAGMENT_SIZE} leaves no room for the counts, "
+                f"it needs to be at least {first + count}"
+            )
+        step, self._count_step = self._count_step, self._count_step + 1
+        staging = self._quantizer.staging
+        start = first * GRADIENT_SIZE
+        staging[start:start + len(lanes)] = torch.tensor(lanes, dtype=staging.dtype)
+
+        self._clib.set_fragment_range(first, count)
+        try:
+            grads_c = cast(c_void_p(staging.data_ptr()), POINTER(c_int))
+            with profiler.phase("send_fragments"):
+                self._clib.send_fragments(step, grads_c, first, count)
+            with profiler.phase("busy_polling"):
+                ptr = self._clib.busy_polling(self._aggmap_fd, step)
+        finally:
+            self._clib.set_fragment_count(self._num_fragments)
+        if not ptr:
+            raise RuntimeError(f"Step {step}: fragments lost after {RETRANSMIT_LIMIT} retransmits")
+        sums = self._wrap_agg_buf(ptr)[start:start + len(lanes)].tolist()
+        return [
+            sum(sums[j * num_digits + i] * base ** i for i in range(num_digits))
+            for j in range(len(counts))
+        ]
+
+    def _init_buckets(self, bucket_fragments: int):
+        """Splits the fragments into buckets pushed from autograd hooks.
+
+        A bucket is a contiguous fragment range of the gradient arena. It is
+        quantized and sent as soon as every parameter overlapping it has its
+        gradient, so the last layers are on the wire while backward is still
+        running through the first ones.
+        """
+        if not hasattr(torch.Tensor, "register_post_accumulate_grad_hook"):
+            print("Gradient buckets need torch >= 2.1, pushing after backward")
+            return
+
+        if self._model.grad_arena is None:
+            self._model.enable_grad_arena()
+
+        self._buckets = [
+            (first, min(first + bucket_fragments, self._num_fragments))
+            for first in range(0, self._num_fragments, bucket_fragments)
+        ]
+        self._bucket_deps = [0] * len(self._buckets)
+        self._param_buckets = []
+
+        offset = 0
+        params = [p for p in self._model.parameters() if p.requires_grad]
+        for idx, p in enumerate(params):
+            first = offset // GRADIENT_SIZE // bucket_fragments
+            last = (offset + p.numel() - 1) // GRADIENT_SIZE // bucket_fragments
+            for bucket_id in range(first, last + 1):
+                self._bucket_deps[bucket_id] += 1
+            self._param_buckets.append(range(first, last + 1))
+            p.register_post_accumulate_grad_hook(functools.partial(self._on_grad_ready, idx))
+            offset += p.numel()
+
+        self._reset_buckets(0)
+
+    def _reset_buckets(self, step: int):
+        self._bucket_step = step
+        self._bucket_pending = list(self._bucket_deps)
+        self._bucket_sent = [False] * len(self._buckets)
+
+    def _on_grad_ready(self, idx: int, param: torch.Tensor):
+        for bucket_id in self._param_buckets[idx]:
+            self._bucket_pending[bucket_id] -= 1
+            if self._bucket_pending[bucket_id] == 0:
+                self._push_bucket(bucket_id)
+
+    def _push_bucket(self, bucket_id: int):
+        first, last = self._buckets[bucket_id]
+        arena = self._model.grad_arena
+        start, end = first * GRADIENT_SIZE, min(last * GRADIENT_SIZE, arena.numel())
+        with profiler.phase("prepare_gradients"):
+            self._quantizer.quantize_range(arena, start, end)
+
+        grads_c = cast(c_void_p(self._quantizer.staging.data_ptr()), POINTER(c_int))
+        with profiler.phase("send_fragments"):
+            self._clib.send_fragments(self._bucket_step, grads_c, first, last - first)
+        self._bucket_sent[bucket_id] = True
+
+    def _aggregate_buckets(self, step: int):
+        if step != self._bucket_step:
+            # the hooks pushed under another step number, push everything again
+            self._bucket_step = step
+            self._bucket_sent = [False] * len(self._buckets)
+
+        # parameters without grads never fire their hook
+        start_time = time.perf_counter()
+        for bucket_id, sent in enumerate(self._bucket_sent):
+            if not sent:
+                self._push_bucket(bucket_id)
+        self.push_time = time.perf_counter() - start_time
+
+        # the arena is the model's grads, nothing to copy back
+        for _ in self.pull_stream(step, self._model.grad_arena, self._world_size):
+            pass
+
+        self._reset_buckets(step + 1)
+
+    def aggregate(self, step: int):
+        if self._buckets is not None:
+            self._aggregate_buckets(step)
+            return
 
+        with profiler.phase("get_gradients"):
+            grads_flat = self._model.get_gradients()
+        # average straight into the arena (or a reused buffer) on dequantization
+        out = self._model.grad_arena
+        if out is None:
+            if getattr(self, "_grad_buf", None) is None or \
+                    self._grad_buf.numel() != grads_flat.numel():
+                self._grad_buf = torch.empty_like(grads_flat)
+            out = self._grad_buf
+        start_time = time.perf_counter()
+        self.push(step, self.prepare_gradients(grads_flat))
+        self.push_time = time.perf_counter() - start_time
+        for start, end in self.pull_stream(step, out, self._world_size):
+            with profiler.phase("set_gradients"):
+                self._model.set_gradients_range(out, start, end)
@@ -3,12 +3,25 @@ import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel
 from workers import BaseWorker
 from models import BaseModel
+from compression import check_compression, compressed_bytes, ddp_comm_hook
+from utils import load_config
+
+config = load_config("local_config.json")
+
+COMM_COMPRESSION = config.get("comm_compression", "none")
+POWERSGD_RANK = config.get("powersgd_rank", 2)
+POWERSGD_START_ITER = config.get("powersgd_start_iter", 10)
 
 
 class TorchDDPWorker(BaseWorker):
 
-    def __init__(self, model: BaseModel):
+    def __init__(self, model: BaseModel, compression: str = COMM_COMPRESSION):
         super().__init__(model)
+        self._compression = check_compression(compression)
+
+    @property
+    def bytes_per_step(self) -> int:
+        return compressed_bytes(self._model.parameters(), self._compression, POWERSGD_RANK)
 
     def setup(self, rank: int, world_size: int, master_ip: str, master_port: int) -> str:
         dist.init_process_group(
@@ -18,6 +31,9 @@ class TorchDDPWorker(BaseWorker):
             world_size=world_size
         )
         self._model = DistributedDataParallel(self._model)
+        hook = ddp_comm_hook(self._compression, POWERSGD_RANK, POWERSGD_START_ITER)
+        if hook is not None:
+            self._model.register_comm_hook(*hook)
         return torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     def aggregate(self, step: int):
@@ -1,13 +1,39 @@
+import time
+import functools
 import torch
 import torch.distributed as dist
 from workers import BaseWorker
 from models import BaseModel
+from compression import COMPRESSION_DTYPES, PowerSGD, check_compression, compressed_bytes
+from profiler import profiler
+from utils import load_config
+
+config = load_config("local_config.json")
+
+TCP_BUCKET_MB = config.get("tcp_bucket_mb", 25)
+COMM_COMPRESSION = config.get("comm_compression", "none")
+POWERSGD_RANK = config.get("powersgd_rank", 2)
+POWERSGD_START_ITER = config.get("powersgd_start_iter", 10)
 
 
 class TorchTCPWorker(BaseWorker):
-    
-    def __init__(self, model: BaseModel):
+
+    def __init__(self, model: BaseModel, bucket_mb: float = TCP_BUCKET_MB,
+                 compression: str = COMM_COMPRESSION):
         super().__init__(model)
+        self._compression = check_compression(compression)
+        # fp16/bf16 are summed in a cast copy of the gradients
+        self._dtype = COMPRESSION_DTYPES.get(compression)
+        self._buckets = None
+        self._powersgd = None
+        if compression == "powersgd":
+            self._powersgd = PowerSGD(model.parameters(), POWERSGD_RANK, POWERSGD_START_ITER)
+        elif bucket_mb > 0:
+            self._init_buckets(int(bucket_mb * 2**20))
+
+    @property
+    def bytes_per_step(self) -> int:
+        return compressed_bytes(self._model.parameters(), self._compression, POWERSGD_RANK)
 
     def setup(self, rank: int, world_size: int, master_ip: str, master_port: int) -> str:
         dist.init_process_group(
@@ -18,10 +44,123 @@ class TorchTCPWorker(BaseWorker):
         )
         return torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+    def _init_buckets(self, bucket_bytes: int):
+        """Splits the gradient arena into buckets all-reduced from autograd hooks.
+
+        A bucket is a contiguous range of whole parameters of at most
+        bucket_bytes (or one larger parameter), filled from the last
+        parameter backwards since backward produces their gradients first.
+        Its all-reduce starts asynchronously once every parameter in it has
+        its gradient. Collectives have to be issued in the same order on
+        every rank, so buckets are launched strictly in index order.
+        """
+        if self._model.grad_arena is None:
+            self._model.enable_grad_arena()
+
+        params = [p for p in self._model.parameters() if p.requires_grad]
+        offsets = [0]
+        for p in params:
+            offsets.append(offsets[-1] + p.numel())
+
+        # (start, end) in the arena, the last parameters first
+        self._buckets = []
+        self._bucket_deps = []
+        self._param_buckets = [0] * len(params)
+        element_size = self._model.grad_arena.element_size()
+        end, count = offsets[-1], 0
+        for idx in reversed(range(len(params))):
+            if count and (end - offsets[idx]) * element_size > bucket_bytes:
+                self._buckets.append((offsets[idx + 1], end))
+                self._bucket_deps.append(count)
+                end, count = offsets[idx + 1], 0
+            self._param_buckets[idx] = len(self._buckets)
+            count += 1
+        self._buckets.append((0, end))
+        self._bucket_deps.append(count)
+        if self._dtype is not None:
+            self._bucket_bufs = [
+                torch.empty(end - start, dtype=self._dtype, device=self._model.grad_arena.device)
+                for start, end in self._buckets
+            ]
+
+        if hasattr(torch.Tensor, "register_post_accumulate_grad_hook"):
+            for idx, p in enumerate(params):
+                p.register_post_accumulate_grad_hook(functools.partial(self._on_grad_ready, idx))
+        else:
+            print("Gradient buckets need torch >= 2.1, reducing after backward")
+
+        self._reset_buckets()
+
+    def _reset_buckets(self):
+        self._bucket_pending = list(self._bucket_deps)
+        self._handles = []
+
+    def _on_grad_ready(self, idx: int, param: torch.Tensor):
+        self._bucket_pending[self._param_buckets[idx]] -= 1
+        # launch every bucket that is complete and next in line
+        while len(self._handles) < len(self._buckets) and \
+                self._bucket_pending[len(self._handles)] == 0:
+            self._launch_bucket(len(self._handles))
+
+    def _launch_bucket(self, bucket_id: int):
+        start, end = self._buckets[bucket_id]
+        grads = self._model.grad_arena[start:end]
+        if self._dtype is not None:
+            with profiler.phase("compress"):
+                grads = self._bucket_bufs[bucket_id].copy_(grads).div_(dist.get_world_size())
+        with profiler.phase("all_reduce"):
+            self._handles.append(dist.all_reduce(grads, op=dist.ReduceOp.SUM, async_op=True))
+
+    def _aggregate_buckets(self, world_size: int):
+        # parameters without grads never fire their hook
+        start_time = time.perf_counter()
+        for bucket_id in range(len(self._handles), len(self._buckets)):
+            self._launch_bucket(bucket_id)
+        self.push_time = time.perf_counter() - start_time
+
+        with profiler.phase("all_reduce_wait"):
+            for handle in self._handles:
+                handle.wait()
+        if self._dtype is not None:
+            with profiler.phase("decompress"):
+                for (start, end), buf in zip(self._buckets, self._bucket_bufs):
+                    self._model.grad_arena[start:end].copy_(buf)
+        else:
+            with profiler.phase("divide"):
+                self._model.grad_arena.div_(world_size)
+        self._reset_buckets()
+
+    def _all_reduce_mean(self, grads: torch.Tensor, world_size: int):
+        if self._dtype is None:
+            with profiler.phase("all_reduce"):
+                dist.all_reduce(grads, op=dist.ReduceOp.SUM)
+            with profiler.phase("divide"):
+                grads /= world_size
+            return
+
+        with profiler.phase("compress"):
+            buf = grads.to(self._dtype).div_(world_size)
+        with profiler.phase("all_reduce"):
+            dist.all_reduce(buf, op=dist.ReduceOp.SUM)
+        with profiler.phase("decompress"):
+            grads.copy_(buf)
+
     def aggregate(self, step: int):
         world_size = dist.get_world_size()
+        if self._powersgd is not None:
+            with profiler.phase("powersgd"):
+                self._powersgd.all_reduce(world_size)
+            return
+
+        if self._buckets is not None:
+            self._aggregate_buckets(world_size)
+            return
+
+        arena = self._model.grad_arena
+        if arena is not None:
+            self._all_reduce_mean(arena, world_size)
+            return
+
         for param in self._model.parameters():
             if param.grad is not None:
-                dist.all_reduce(param.grad.data, op=dist.ReduceOp.SUM)
-                param.grad.data /= world_size
-
+                self._all_reduce_mean(param.grad.data, world_size)
@@ -0,0 +1,38 @@
+import torch
+import torch.distributed as dist
+from workers.ebpf_worker import EbpfWorker, config, GRADIENT_SIZE, FRAGMENT_SIZE, LANE_BITS
+from models import BaseModel
+from usr_aggregator import UsrAggLib, tree_topology
+
+
+class UsrEbpfWorker(EbpfWorker):
+    """EbpfWorker running on the userspace aggregator (no XDP/TC needed)."""
+    # plain UDP sockets, so a root fq qdisc can pace them and the kernel
+    # segments GSO super-packets before they reach the aggregator
+    PACING_MODES = {"off": 0, "bucket": 1, "fq": 2}
+    TX_MODES = {"sendto": 0, "sendmmsg": 1, "gso": 2}
+
+    def __init__(self, model: BaseModel, fanout: int = 2):
+        super().__init__(model, clib_path=None)
+        self._fanout = config.get("usr_fanout", fanout)
+
+    def setup(self, rank: int, world_size: int, master_ip: str, master_port: int) -> str:
+        # gloo is only used as a start barrier so that no fragment
+        # is sent before every aggregator socket is bound
+        dist.init_process_group(
+            backend="gloo",
+            init_method=f"tcp://{master_ip}:{master_port}",
+            rank=rank,
+            world_size=world_size
+        )
+        # WORLD_SIZE may override worker_num, the lanes need its headroom
+        if world_size != self._world_size:
+            self._init_quantizer(world_size)
+        parent, children = tree_topology(rank, world_size, self._fanout)
+        self._clib = UsrAggLib(
+            rank, parent, children, world_size,
+            GRADIENT_SIZE, FRAGMENT_SIZE, config["port"], lane_bits=LANE_BITS
+        )
+        self._init_clib()
+        dist.barrier()
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")